@@ -0,0 +1,117 @@
+"""比较每条消息在规则匹配上的开销：原来的多个matcher和正则，以及现在的单个matcher和查找表
+
+原来每条消息要经过3个命令matcher、1个to_me的matcher和继续对话的matcher，
+继续对话的规则还要用一个没有转义的正则检查消息是否是命令
+
+    python benchmarks/dispatch_rule.py --number 20000
+"""
+import re
+import time
+import asyncio
+import argparse
+from typing import Any
+
+from fakes import FakeBot, make_group_message_event
+from utils import load_plugin
+
+BOT_SELF_ID = 10000
+
+
+def build_old_rule_list() -> list[Any]:
+    """按原来的写法构造5个matcher的规则"""
+    from nonebot.rule import Rule, to_me, command
+    from nonebot.params import EventToMe
+    from nonebot.adapters.onebot.v11 import MessageEvent
+    from nonebot_plugin_bing_chat.common import plugin_config
+    from nonebot_plugin_bing_chat.common.utils import get_reply_user_info
+
+    matcher_in_regex = '|'.join(
+        f"""(({'|'.join(plugin_config.command_start)})({'|'.join(i)}).*)"""
+        for i in (
+            plugin_config.bingchat_command_chat,
+            plugin_config.bingchat_command_new_chat,
+            plugin_config.bingchat_command_history_chat,
+        )
+    )
+
+    async def _rule_continue_chat(
+        event: MessageEvent, to_me: bool = EventToMe()
+    ) -> bool:
+        return bool(
+            to_me
+            and event.reply
+            and not re.match(matcher_in_regex, event.message.extract_plain_text())
+            and await get_reply_user_info(event.reply.message_id) is not None
+        )
+
+    to_me_rule = to_me() if plugin_config.bingchat_to_me else Rule()
+    return [
+        command(*plugin_config.bingchat_command_chat) & to_me_rule,
+        command(*plugin_config.bingchat_command_new_chat) & to_me_rule,
+        command(*plugin_config.bingchat_command_history_chat) & to_me_rule,
+        to_me(),
+        Rule(_rule_continue_chat),
+    ]
+
+
+async def time_rule_list(
+    bot: Any, event: Any, rule_list: list[Any], number: int
+) -> float:
+    """返回一条消息依次检查所有规则的平均用时"""
+    from nonebot.rule import TrieRule
+
+    # nonebot在匹配前会为每个事件解析一次命令前缀，两种写法都要付出这部分开销
+    state: dict[Any, Any] = {}
+    TrieRule.get_value(bot, event, state)
+    start_time = time.perf_counter()
+    for _ in range(number):
+        for rule in rule_list:
+            await rule(bot, event, state.copy())
+    return (time.perf_counter() - start_time) / number
+
+
+async def run(number: int) -> None:
+    import nonebot
+    from nonebot.adapters.onebot.v11 import Adapter
+    from nonebot_plugin_bing_chat.common import plugin_data
+    from nonebot_plugin_bing_chat.onebotv11.utils import bingchat_matcher
+    from nonebot_plugin_bing_chat.common.data_model import UserInfo
+
+    bot = FakeBot(nonebot.get_adapter(Adapter), str(BOT_SELF_ID))
+    old_rule_list = build_old_rule_list()
+    new_rule_list = [bingchat_matcher.rule]
+
+    known_message_id = 1
+    plugin_data.reply_message_id_dict[known_message_id] = UserInfo(
+        platform='qq', user_id=BOT_SELF_ID + 1
+    )
+    event_dict = {
+        '无关的消息': make_group_message_event(BOT_SELF_ID + 1, 1, '今天吃什么'),
+        '长的无关消息': make_group_message_event(BOT_SELF_ID + 1, 1, '今天吃什么' * 200),
+        '命令': make_group_message_event(BOT_SELF_ID + 1, 1, '/chat 你好'),
+        '回复回答': make_group_message_event(
+            BOT_SELF_ID + 1, 1, '继续说', reply_message_id=known_message_id
+        ),
+    }
+
+    print(f'{"消息":<10}{"原来(μs)":>12}{"现在(μs)":>12}{"加速":>8}')
+    for name, event in event_dict.items():
+        old_time = await time_rule_list(bot, event, old_rule_list, number)
+        new_time = await time_rule_list(bot, event, new_rule_list, number)
+        print(
+            f'{name:<10}{old_time * 1e6:>12.1f}{new_time * 1e6:>12.1f}'
+            f'{old_time / new_time:>8.1f}x'
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000, help='每种消息重复检查的次数')
+    args = parser.parse_args()
+
+    load_plugin(bingchat_log=False)
+    asyncio.run(run(args.number))
+
+
+if __name__ == '__main__':
+    main()
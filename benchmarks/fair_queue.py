@@ -0,0 +1,91 @@
+"""模拟一个群刷屏时其他群和超级用户等待并发名额的用时
+
+一个吵闹的群一次性发出大量请求，几个安静的群和一个超级用户随后各自发出少量请求，
+每个请求占用并发名额一段固定的时间，输出每个租户的平均和最长等待时间
+
+    python benchmarks/fair_queue.py
+    python benchmarks/fair_queue.py --noisy 200 --quiet-groups 5 --concurrency 4
+"""
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+from collections import defaultdict
+
+from utils import load_plugin
+
+
+async def run(args: argparse.Namespace) -> None:
+    from nonebot_plugin_bing_chat.common.data_model import UserInfo
+    from nonebot_plugin_bing_chat.common.request_queue import RequestQueue
+
+    request_queue = RequestQueue(
+        max_concurrency=args.concurrency,
+        max_user_queue_size=args.noisy,
+        max_queue_size=args.noisy * 10,
+    )
+    wait_time_list_dict: defaultdict[str, list[float]] = defaultdict(list)
+
+    async def request(
+        user_id: int, tenant: str, weight: float = 1, priority: bool = False
+    ) -> None:
+        user_info = UserInfo(platform='qq', user_id=user_id)
+        start_time = time.perf_counter()
+        await request_queue.acquire(
+            user_info, tenant=tenant, weight=weight, priority=priority
+        )
+        wait_time_list_dict[tenant].append(time.perf_counter() - start_time)
+        try:
+            await asyncio.sleep(args.service_time)
+        finally:
+            request_queue.release(user_info)
+
+    # 吵闹的群中每个人发一条，先全部进入队列
+    task_list = [
+        asyncio.create_task(request(100000 + i, 'group:noisy'))
+        for i in range(args.noisy)
+    ]
+    await asyncio.sleep(args.service_time / 2)
+    for i in range(args.quiet_groups):
+        for j in range(args.quiet_requests):
+            task_list.append(
+                asyncio.create_task(request(200000 + i * 100 + j, f'group:quiet{i}'))
+            )
+    task_list.append(asyncio.create_task(request(1, 'private:1', priority=True)))
+    await asyncio.gather(*task_list)
+
+    print(f'{"租户":<16}{"请求数":>8}{"平均等待":>12}{"最长等待":>12}')
+    for tenant, wait_time_list in wait_time_list_dict.items():
+        print(
+            f'{tenant:<16}{len(wait_time_list):>8}'
+            f'{statistics.mean(wait_time_list) * 1000:>10.0f}ms'
+            f'{max(wait_time_list) * 1000:>10.0f}ms'
+        )
+
+    # 先进先出时安静的群要等吵闹的群全部完成，公平排队时只需要等几轮
+    num_rounds = args.noisy / args.concurrency
+    quiet_max_wait = max(
+        max(v) for k, v in wait_time_list_dict.items() if k.startswith('group:quiet')
+    )
+    assert quiet_max_wait < num_rounds * args.service_time / 2, quiet_max_wait
+    assert max(wait_time_list_dict['private:1']) < args.service_time * 1.5
+    print('\n安静的群和超级用户没有被吵闹的群饿死')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--noisy', type=int, default=100, help='吵闹的群发出的请求数')
+    parser.add_argument('--quiet-groups', type=int, default=3, help='安静的群的数量')
+    parser.add_argument('--quiet-requests', type=int, default=2, help='每个安静的群发出的请求数')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发名额')
+    parser.add_argument('--service-time', type=float, default=0.05, help='每个请求占用名额的秒数')
+    args = parser.parse_args()
+
+    load_plugin(bingchat_log=False)
+    asyncio.run(run(args))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
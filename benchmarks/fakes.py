@@ -0,0 +1,186 @@
+"""用来代替Bing和QQ的假对象
+
+FakeChatbot 代替EdgeGPT.Chatbot，可以设置延迟、限流和出错的概率
+FakeBot 代替OneBot V11的Bot，不连接任何实现端，只记录发出的消息
+"""
+import time
+import uuid
+import random
+import asyncio
+import itertools
+from typing import Any, Optional, AsyncGenerator
+from contextvars import ContextVar
+
+from utils import make_raw_response
+from EdgeGPT import _ChatHub, _Conversation
+from nonebot.adapters.onebot.v11 import Bot, Adapter, Message, GroupMessageEvent
+from nonebot.adapters.onebot.v11.event import Reply, Sender
+
+# 当前模拟的用户收到的消息和对应的message_id，FakeBot发出消息时会追加到这里
+current_reply_list: ContextVar[list[tuple[int, Message]]] = ContextVar(
+    'current_reply_list'
+)
+
+_message_id_counter = itertools.count(1)
+
+
+class FakeChatbot:
+    """和EdgeGPT.Chatbot接口相同的假Chatbot，需要在加载插件之前替换EdgeGPT.Chatbot"""
+
+    create_latency: float = 0.2
+    latency: float = 1.0
+    jitter: float = 0.5
+    throttle_rate: float = 0.0
+    error_rate: float = 0.0
+    # 连接后一直收不到任何回应的概率，模拟卡住的websocket
+    stall_rate: float = 0.0
+    stream_num_frames: int = 10
+
+    num_created = 0
+    num_asks = 0
+    num_throttled = 0
+    num_errors = 0
+    num_stalled = 0
+
+    def __init__(self) -> None:
+        # 和真实的Chatbot一样把会话信息放在chat_hub.request中，插件靠它保存和恢复会话
+        conversation = _Conversation(async_mode=True)
+        conversation.struct = {
+            'conversationId': uuid.uuid4().hex,
+            'clientId': uuid.uuid4().hex,
+            'conversationSignature': uuid.uuid4().hex,
+        }
+        self.cookies: list[dict[str, Any]] = []
+        self.proxy: Optional[str] = None
+        self.chat_hub = _ChatHub(conversation)
+
+    @classmethod
+    async def create(
+        cls,
+        cookies: Optional[list[dict[str, Any]]] = None,
+        proxy: Optional[str] = None,
+        cookie_path: Optional[str] = None,
+    ) -> 'FakeChatbot':
+        # 真实的Chatbot.create会发送HTTP请求创建会话
+        await asyncio.sleep(cls.create_latency)
+        FakeChatbot.num_created += 1
+        return cls()
+
+    @classmethod
+    def configure(cls, **kwargs: Any) -> None:
+        for key, value in kwargs.items():
+            if not hasattr(cls, key):
+                raise AttributeError(f'FakeChatbot没有{key}这个设置')
+            setattr(cls, key, value)
+
+    def _get_latency(self) -> float:
+        return max(0.0, random.gauss(self.latency, self.jitter))
+
+    def _make_response(self, prompt: str) -> dict[Any, Any]:
+        FakeChatbot.num_asks += 1
+        # 恢复的会话没有经过__init__，轮数只能从会话信息中读取
+        self.chat_hub.request.invocation_id += 1
+        num_conversation = self.chat_hub.request.invocation_id
+        if random.random() < self.error_rate:
+            FakeChatbot.num_errors += 1
+            raise Exception('模拟的网络错误')
+        if random.random() < self.throttle_rate:
+            FakeChatbot.num_throttled += 1
+            return {'type': 2, 'item': {'result': {'value': 'Throttled'}}}
+        return make_raw_response(
+            f'关于“{prompt}”的回答。这是模拟的第{num_conversation}轮回答！' * 8,
+            num_conversation,
+        )
+
+    async def ask(self, prompt: str, **kwargs: Any) -> dict[Any, Any]:
+        if random.random() < self.stall_rate:
+            FakeChatbot.num_stalled += 1
+            await asyncio.Event().wait()
+        await asyncio.sleep(self._get_latency())
+        return self._make_response(prompt)
+
+    async def ask_stream(
+        self, prompt: str, **kwargs: Any
+    ) -> AsyncGenerator[tuple[bool, Any], None]:
+        if random.random() < self.stall_rate:
+            FakeChatbot.num_stalled += 1
+            await asyncio.Event().wait()
+        latency = self._get_latency()
+        response = self._make_response(prompt)
+        answer = response['item']['messages'][1]['text']
+        for i in range(1, self.stream_num_frames + 1):
+            await asyncio.sleep(latency / self.stream_num_frames)
+            yield False, answer[: len(answer) * i // self.stream_num_frames]
+        yield True, response
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeBot(Bot):
+    """不连接实现端的Bot，调用API时只记录调用次数并返回假的message_id"""
+
+    def __init__(self, adapter: Adapter, self_id: str, send_latency: float = 0.0):
+        super().__init__(adapter, self_id)
+        self.send_latency = send_latency
+        self.api_call_count: dict[str, int] = {}
+
+    async def call_api(self, api: str, **data: Any) -> Any:
+        self.api_call_count[api] = self.api_call_count.get(api, 0) + 1
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+
+        match api:
+            case 'send_msg':
+                return {'message_id': self._record(Message(data['message']))}
+            case 'send_group_forward_msg' | 'send_private_forward_msg':
+                return {'message_id': self._record(Message('[合并转发]'))}
+            case 'get_msg':
+                return {'message_id': data.get('message_id'), 'message': []}
+            case _:
+                return None
+
+    @staticmethod
+    def _record(message: Message) -> int:
+        message_id = next(_message_id_counter)
+        if (reply_list := current_reply_list.get(None)) is not None:
+            reply_list.append((message_id, message))
+        return message_id
+
+
+def make_group_message_event(
+    user_id: int,
+    group_id: int,
+    text: str,
+    reply_message_id: Optional[int] = None,
+    self_id: int = 10000,
+) -> GroupMessageEvent:
+    """构造群消息事件，reply_message_id不为空时表示回复了机器人的这条消息"""
+    message = Message(text)
+    reply = None
+    if reply_message_id is not None:
+        reply = Reply(
+            time=int(time.time()),
+            message_type='group',
+            message_id=reply_message_id,
+            real_id=reply_message_id,
+            sender=Sender(user_id=self_id, nickname='bot'),
+            message=Message(),
+        )
+    return GroupMessageEvent(
+        time=int(time.time()),
+        self_id=self_id,
+        post_type='message',
+        sub_type='normal',
+        user_id=user_id,
+        message_type='group',
+        message_id=next(_message_id_counter),
+        message=message,
+        original_message=message,
+        raw_message=text,
+        font=0,
+        sender=Sender(user_id=user_id, nickname=f'user{user_id}'),
+        group_id=group_id,
+        to_me=reply is not None,
+        reply=reply,
+    )
@@ -0,0 +1,259 @@
+"""离线压测：用假的Chatbot代替Bing，用假的Bot代替QQ，模拟大量用户和群同时对话
+
+每个模拟的用户会先用命令开始对话，再回复机器人的消息继续对话若干轮，部分用户还会查看历史记录，
+所有事件都经过nonebot的handle_event，和真实运行时走同样的匹配和处理流程
+
+    python benchmarks/load_test.py --users 2000 --groups 200 --turns 2
+    python benchmarks/load_test.py --throttle-rate 0.01 --error-rate 0.01 --config bingchat_stream_mode=true
+    python benchmarks/load_test.py --stall-rate 0.02 --config bingchat_first_frame_timeout=2 --config bingchat_hedge_quantile=0.95
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+from typing import Any, Optional
+from collections import defaultdict
+
+import EdgeGPT
+from fakes import FakeBot, FakeChatbot, current_reply_list, make_group_message_event
+from utils import load_plugin, parse_config
+
+BOT_SELF_ID = 10000
+
+
+def percentile(sorted_list: list[float], q: float) -> float:
+    if not sorted_list:
+        return 0.0
+    return sorted_list[min(len(sorted_list) - 1, int(len(sorted_list) * q))]
+
+
+def get_rss() -> int:
+    """当前进程占用的物理内存字节数"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoopLagMonitor:
+    """定时醒来并记录比预期晚了多久，反映事件循环被阻塞的程度"""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.lag_list: list[float] = []
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def _run(self) -> None:
+        while True:
+            start_time = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lag_list.append(time.perf_counter() - start_time - self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace) -> None:
+        import nonebot
+        from nonebot.adapters.onebot.v11 import Adapter
+
+        self.args = args
+        self.bot = FakeBot(nonebot.get_adapter(Adapter), str(BOT_SELF_ID))
+        self.latency_dict: defaultdict[str, list[float]] = defaultdict(list)
+        self.failure_dict: defaultdict[str, int] = defaultdict(int)
+        self.failure_reason_dict: defaultdict[str, int] = defaultdict(int)
+
+    async def send_event(
+        self, action: str, user_id: int, text: str, reply_message_id: Optional[int]
+    ) -> Optional[int]:
+        """发送一个事件并等待处理完成，返回机器人最后一条回复的message_id"""
+        from nonebot.message import handle_event
+        from nonebot_plugin_bing_chat.common import plugin_data
+
+        event = make_group_message_event(
+            user_id=user_id,
+            group_id=user_id % self.args.groups,
+            text=text,
+            reply_message_id=reply_message_id,
+            self_id=BOT_SELF_ID,
+        )
+        reply_list: list[tuple[int, Any]] = []
+        token = current_reply_list.set(reply_list)
+        start_time = time.perf_counter()
+        try:
+            await handle_event(self.bot, event)
+        finally:
+            current_reply_list.reset(token)
+        self.latency_dict[action].append(time.perf_counter() - start_time)
+
+        # 插件记录了message_id的回复才能用来继续对话，其余的是错误或者排队已满之类的提示
+        continuable_message_id_list = [
+            i for i, _ in reply_list if i in plugin_data.reply_message_id_dict
+        ]
+        if action == 'history' and reply_list or continuable_message_id_list:
+            return (
+                continuable_message_id_list[-1] if continuable_message_id_list else None
+            )
+
+        self.failure_dict[action] += 1
+        failure_reason = (
+            reply_list[-1][1].extract_plain_text().splitlines()[0]
+            if reply_list
+            else '<没有回复>'
+        )
+        self.failure_reason_dict[failure_reason] += 1
+        return None
+
+    async def simulate_user(self, user_id: int, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            # 少量不同的问题，模拟群里常见的重复提问
+            message_id = await self.send_event(
+                'chat',
+                user_id,
+                f'/chat 问题{user_id % self.args.num_prompts}',
+                None,
+            )
+            for i in range(self.args.turns):
+                if message_id is None:
+                    break
+                message_id = await self.send_event(
+                    'message_all', user_id, f'继续问第{i + 1}个问题', message_id
+                )
+            if random.random() < self.args.history_rate:
+                await self.send_event('history', user_id, '/chat-history', None)
+
+    async def run(self) -> None:
+        import nonebot
+
+        driver = nonebot.get_driver()
+        await driver._lifespan.startup()  # type: ignore
+
+        monitor = LoopLagMonitor()
+        rss_before = get_rss()
+        monitor.start()
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        start_time = time.perf_counter()
+        await asyncio.gather(
+            *(
+                self.simulate_user(BOT_SELF_ID + 1 + i, semaphore)
+                for i in range(self.args.users)
+            )
+        )
+        elapsed = time.perf_counter() - start_time
+        monitor.stop()
+        rss_after = get_rss()
+
+        self.report(elapsed, rss_after - rss_before, monitor.lag_list)
+        await driver._lifespan.shutdown()  # type: ignore
+
+    def report(self, elapsed: float, rss_growth: int, lag_list: list[float]) -> None:
+        from nonebot_plugin_bing_chat.common import (
+            plugin_data,
+            chatbot_pool,
+            upstream_timer,
+        )
+
+        print(
+            f'{"动作":<12}{"次数":>8}{"失败":>8}'
+            f'{"p50(ms)":>10}{"p95(ms)":>10}{"p99(ms)":>10}{"max(ms)":>10}'
+        )
+        num_events = 0
+        for action, latency_list in self.latency_dict.items():
+            latency_list.sort()
+            num_events += len(latency_list)
+            print(
+                f'{action:<12}{len(latency_list):>8}{self.failure_dict[action]:>8}'
+                + ''.join(
+                    f'{percentile(latency_list, q) * 1000:>10.1f}'
+                    for q in (0.5, 0.95, 0.99, 1)
+                )
+            )
+
+        for reason, num_failures in sorted(
+            self.failure_reason_dict.items(), key=lambda i: -i[1]
+        ):
+            print(f'失败原因：{reason} x{num_failures}')
+
+        lag_list.sort()
+        print(f'\n总计：{num_events}个事件，用时{elapsed:.1f}s，{num_events / elapsed:.1f} req/s')
+        print(
+            f'上游：创建会话{FakeChatbot.num_created}次，询问{FakeChatbot.num_asks}次，'
+            f'限流{FakeChatbot.num_throttled}次，出错{FakeChatbot.num_errors}次，'
+            f'卡住{FakeChatbot.num_stalled}次'
+        )
+        print(
+            '账号记录：消息'
+            f'{sum(i.num_message for i in plugin_data.cookies_usage_dict.values())}条，'
+            '对话'
+            f'{sum(i.num_conversation for i in plugin_data.cookies_usage_dict.values())}个'
+        )
+        print(f'询问用时：{upstream_timer.stats}')
+        print(f'Bot API调用：{dict(self.bot.api_call_count)}')
+        print(f'Chatbot连接池：{chatbot_pool.stats}')
+        print(
+            f'内存：RSS增长{rss_growth / 1024 / 1024:.1f}MB，'
+            f'内存中有{len(plugin_data.user_data_dict)}个用户数据，'
+            f'{len(plugin_data.reply_message_id_dict)}个消息id'
+        )
+        print(
+            f'事件循环延迟：p50 {percentile(lag_list, 0.5) * 1000:.1f}ms，'
+            f'p99 {percentile(lag_list, 0.99) * 1000:.1f}ms，'
+            f'max {percentile(lag_list, 1) * 1000:.1f}ms'
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000, help='模拟的用户数')
+    parser.add_argument('--groups', type=int, default=200, help='模拟的群数')
+    parser.add_argument('--turns', type=int, default=2, help='每个用户回复继续对话的轮数')
+    parser.add_argument('--history-rate', type=float, default=0.1, help='查看历史记录的用户比例')
+    parser.add_argument('--num-prompts', type=int, default=500, help='不同问题的数量')
+    parser.add_argument('--concurrency', type=int, default=50, help='同时活跃的用户数')
+    parser.add_argument('--num-cookies', type=int, default=10, help='假的账号数量')
+    parser.add_argument('--latency', type=float, default=0.05, help='上游回答的平均延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.02, help='上游回答延迟的标准差（秒）')
+    parser.add_argument('--create-latency', type=float, default=0.01, help='创建会话的延迟（秒）')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='上游返回限流的概率')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='上游出错的概率')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='上游一直没有回应的概率')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--config',
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='插件的配置项，值按json解析，可以重复',
+    )
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    FakeChatbot.configure(
+        latency=args.latency,
+        jitter=args.jitter,
+        create_latency=args.create_latency,
+        throttle_rate=args.throttle_rate,
+        error_rate=args.error_rate,
+        stall_rate=args.stall_rate,
+    )
+    # 插件在创建会话时才导入EdgeGPT.Chatbot，在加载插件之前替换即可
+    EdgeGPT.Chatbot = FakeChatbot  # type: ignore
+    config = parse_config(args.config)
+    config.setdefault('bingchat_log', False)
+    load_plugin(num_cookies=args.num_cookies, **config)
+
+    asyncio.run(LoadTest(args).run())
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""比较保存完整原始响应值与只保存提取后的内容时，每轮对话占用的内存，
+并检查淘汰日志中使用的get_deep_size是否计入了回答的内容
+
+    python benchmarks/response_memory.py
+"""
+import sys
+import json
+import tracemalloc
+
+from utils import load_plugin, make_raw_response
+
+NUM_TURNS = 2000
+
+
+def measure(keep_raw: bool) -> float:
+    from nonebot_plugin_bing_chat.common.data_model import (
+        Conversation,
+        BingChatResponse,
+    )
+
+    payload_list = [
+        json.dumps(make_raw_response(f'这是第{i}个回答。' * 40, i % 20 + 1))
+        for i in range(NUM_TURNS)
+    ]
+
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    history = [
+        Conversation(
+            ask=f'问题{i}',
+            response=BingChatResponse(raw=json.loads(payload), keep_raw=keep_raw),
+        )
+        for i, payload in enumerate(payload_list)
+    ]
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(history) == NUM_TURNS
+    return (end - start) / NUM_TURNS
+
+
+def check_deep_size() -> None:
+    from nonebot_plugin_bing_chat.common.data_model import BingChatResponse
+    from nonebot_plugin_bing_chat.common.expiring_dict import get_deep_size
+
+    answer = '回' * 5000
+    response = BingChatResponse(raw=make_raw_response(answer, 1))
+    num_bytes = get_deep_size(response)
+    print(f'5000字回答的get_deep_size：{num_bytes} bytes')
+    # BingChatResponse使用__slots__，回答本身就有sys.getsizeof(answer)字节
+    assert num_bytes > sys.getsizeof(response.answer), '没有计入回答的内容'
+
+
+def main() -> None:
+    load_plugin()
+    raw_bytes = measure(keep_raw=True)
+    compact_bytes = measure(keep_raw=False)
+    print(f'保留原始响应值：{raw_bytes:10.0f} bytes/turn')
+    print(f'只保留提取内容：{compact_bytes:10.0f} bytes/turn')
+    print(f'节省：{1 - compact_bytes / raw_bytes:.1%}')
+    check_deep_size()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""检查RedisStorage在多个进程之间共用时的行为，并测量各个操作的延迟
+
+默认用fakeredis在本进程内模拟一个Redis服务器，两个RedisStorage实例代表两个bot进程；
+指定--url时连接真实的Redis
+
+    pip install fakeredis
+    python benchmarks/shared_storage.py
+    python benchmarks/shared_storage.py --url redis://localhost:6379/15
+"""
+import sys
+import time
+import asyncio
+import argparse
+from typing import Any, Callable, Awaitable
+from datetime import datetime
+
+from utils import load_plugin
+
+
+def make_client(url: str | None, server: Any) -> Any:
+    if url is not None:
+        from redis.asyncio import Redis
+
+        return Redis.from_url(url)
+    import fakeredis
+
+    return fakeredis.aioredis.FakeRedis(server=server)
+
+
+async def measure(
+    name: str, func: Callable[[int], Awaitable[Any]], number: int
+) -> None:
+    start_time = time.perf_counter()
+    for i in range(number):
+        await func(i)
+    elapsed = (time.perf_counter() - start_time) / number
+    print(f'{name:<24}{elapsed * 1e6:>10.1f}μs')
+
+
+async def run(args: argparse.Namespace) -> None:
+    from nonebot_plugin_bing_chat.common.storage import RedisStorage
+    from nonebot_plugin_bing_chat.common.data_model import Sender, UserData, UserInfo
+
+    server = None
+    if args.url is None:
+        import fakeredis
+
+        server = fakeredis.FakeServer()
+
+    # 连接真实的Redis时使用单独的前缀，不影响已有的数据
+    prefix = f'bingchat-check-{time.time_ns()}' if args.url else 'bingchat'
+
+    def make_storage() -> RedisStorage:
+        return RedisStorage(
+            url=args.url or '',
+            prefix=prefix,
+            user_data_ttl=3600,
+            reply_message_id_ttl=3600,
+            lock_timeout=args.lock_timeout,
+            client=make_client(args.url, server),
+        )
+
+    worker_a = make_storage()
+    worker_b = make_storage()
+    user_info = UserInfo(platform='qq', user_id=10001)
+
+    # 进程A发出的回答，进程B收到回复时要能找到对应的用户
+    worker_a.save_reply_message_id(1, user_info)
+    await worker_a.flush()
+    assert await worker_b.load_reply_user_info(1) == user_info
+
+    # 对话数据在两个进程之间交替写入
+    user_data = UserData(sender=Sender(user_id=10001, user_name='a'))
+    worker_a.save_user_data(user_info, user_data)
+    await worker_a.flush()
+    loaded_user_data = await worker_b.load_user_data(user_info)
+    assert loaded_user_data is not None and loaded_user_data.sender.user_name == 'a'
+
+    # 账号使用次数由所有进程汇总
+    worker_a.add_cookies_usage('a.json', '2023-05-01', 3, 1)
+    worker_b.add_cookies_usage('a.json', '2023-05-01', 2, 1)
+    await asyncio.gather(worker_a.flush(), worker_b.flush())
+    usage = (await worker_a.load_cookies_usage('2023-05-01'))['a.json']
+    assert (usage.num_message, usage.num_conversation) == (5, 2), usage
+    # 到达上限的账号在所有进程中都不再使用
+    throttled_until = datetime(2023, 5, 2)
+    worker_b.set_cookies_throttled('a.json', '2023-05-01', throttled_until)
+    await worker_b.flush()
+    usage = (await worker_a.load_cookies_usage('2023-05-01'))['a.json']
+    assert usage.throttled_until == throttled_until, usage
+
+    # 同一个用户的锁同时只能被一个进程持有，释放前写入的数据对下一个进程可见
+    token = await worker_a.acquire_user_lock(user_info)
+    waiting_task = asyncio.create_task(worker_b.acquire_user_lock(user_info))
+    await asyncio.sleep(0.2)
+    assert not waiting_task.done()
+    user_data.sender.user_name = 'b'
+    worker_a.save_user_data(user_info, user_data)
+    await worker_a.release_user_lock(user_info, token)
+    token_b = await asyncio.wait_for(waiting_task, 5)
+    loaded_user_data = await worker_b.load_user_data(user_info)
+    assert loaded_user_data is not None and loaded_user_data.sender.user_name == 'b'
+    # 过期的令牌不能释放别人的锁
+    await worker_a.release_user_lock(user_info, token)
+    assert not await worker_a._client.set(
+        worker_a._user_lock_key(user_info), 'x', nx=True
+    )
+    await worker_b.release_user_lock(user_info, token_b)
+    print('共用存储的检查全部通过\n')
+
+    number = args.number
+    await measure(
+        'save_reply_message_id',
+        lambda i: _save_and_flush(worker_a, i),
+        number,
+    )
+    await measure(
+        'load_reply_user_info', lambda i: worker_b.load_reply_user_info(i), number
+    )
+    await measure(
+        'load_user_data', lambda _: worker_b.load_user_data(user_info), number
+    )
+    await measure(
+        'acquire+release lock',
+        lambda _: _lock_round_trip(worker_a, user_info),
+        number,
+    )
+
+    await worker_a.close()
+    await worker_b.close()
+
+
+async def _save_and_flush(storage: Any, message_id: int) -> None:
+    from nonebot_plugin_bing_chat.common.data_model import UserInfo
+
+    storage.save_reply_message_id(message_id, UserInfo(platform='qq', user_id=1))
+    await storage.flush()
+
+
+async def _lock_round_trip(storage: Any, user_info: Any) -> None:
+    token = await storage.acquire_user_lock(user_info)
+    await storage.release_user_lock(user_info, token)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default=None, help='真实的Redis地址，不指定时使用fakeredis')
+    parser.add_argument('--number', type=int, default=1000, help='每个操作重复的次数')
+    parser.add_argument('--lock-timeout', type=float, default=10)
+    args = parser.parse_args()
+
+    load_plugin(bingchat_log=False)
+    asyncio.run(run(args))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""测量加载插件和启动驱动器的用时，以及加载插件时新导入的模块各自的导入用时
+
+每一轮都在新的子进程中进行，避免模块缓存影响结果
+
+    python benchmarks/startup.py --num-cookies 200 --runs 5
+    python benchmarks/startup.py --config 'bingchat_display_content_types=["image.answer"]'
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import subprocess
+from typing import Any
+from collections import defaultdict
+
+
+def child(args: argparse.Namespace) -> None:
+    """在子进程中加载插件，把各阶段的用时和新导入的模块输出到stdout"""
+    import nonebot  # noqa: F401
+    from utils import load_plugin, parse_config
+
+    config = parse_config(args.config)
+    config.setdefault('bingchat_log', False)
+    module_set = set(sys.modules)
+    start_time = time.perf_counter()
+    load_plugin(num_cookies=args.num_cookies, **config)
+    load_time = time.perf_counter() - start_time
+    new_module_list = sorted(set(sys.modules) - module_set)
+
+    startup_time = asyncio.run(_startup(nonebot.get_driver()))
+
+    print(
+        json.dumps(
+            {
+                'load_plugin': load_time,
+                'startup': startup_time,
+                'new_modules': new_module_list,
+            }
+        )
+    )
+
+
+async def _startup(driver: Any) -> float:
+    """只计算启动钩子的用时，启动后在后台进行的检查不会阻塞bot连接"""
+    start_time = time.perf_counter()
+    await driver._lifespan.startup()
+    elapsed = time.perf_counter() - start_time
+    await driver._lifespan.shutdown()
+    return elapsed
+
+
+def parse_import_time(stderr: str, module_set: set[str]) -> dict[str, float]:
+    """从-X importtime的输出中读取module_set中每个顶层包的累计导入用时（秒）"""
+    import_time_dict: dict[str, float] = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:') :].split('|')
+        # 只统计最外层的导入，避免子模块重复计入
+        if name.startswith('  ') or not cumulative.strip().isdigit():
+            continue
+        name = name.strip()
+        if name in module_set:
+            import_time_dict[name.partition('.')[0]] += int(cumulative) / 1e6
+    return import_time_dict
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--num-cookies', type=int, default=50, help='假的账号数量')
+    parser.add_argument('--runs', type=int, default=5, help='重复的轮数，结果取中位数')
+    parser.add_argument('--top', type=int, default=10, help='输出导入最慢的多少个包')
+    parser.add_argument(
+        '--config',
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='插件的配置项，值按json解析，可以重复',
+    )
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    child_args = [sys.executable, '-X', 'importtime', __file__, '--child']
+    child_args += ['--num-cookies', str(args.num_cookies)]
+    for item in args.config:
+        child_args += ['--config', item]
+
+    load_time_list: list[float] = []
+    startup_time_list: list[float] = []
+    import_time_list_dict: defaultdict[str, list[float]] = defaultdict(list)
+    for _ in range(args.runs):
+        result = subprocess.run(child_args, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(result.stderr[-2000:])
+            sys.exit(result.returncode)
+        data = json.loads(result.stdout.strip().splitlines()[-1])
+        load_time_list.append(data['load_plugin'])
+        startup_time_list.append(data['startup'])
+        for name, import_time in parse_import_time(
+            result.stderr, set(data['new_modules'])
+        ).items():
+            import_time_list_dict[name].append(import_time)
+
+    print(f'加载插件：{statistics.median(load_time_list) * 1000:.1f}ms')
+    print(f'启动驱动器：{statistics.median(startup_time_list) * 1000:.1f}ms')
+    print(f'\n加载插件时导入最慢的{args.top}个包：')
+    for name, import_time_list in sorted(
+        import_time_list_dict.items(), key=lambda i: -statistics.median(i[1])
+    )[: args.top]:
+        print(f'{name:<32}{statistics.median(import_time_list) * 1000:>8.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""benchmarks共用的工具
+
+在临时目录中初始化nonebot并加载插件，不需要真实的Bing账号
+"""
+import os
+import sys
+import json
+import tempfile
+from typing import Any
+from pathlib import Path
+
+import nonebot
+from nonebot.plugin import Plugin
+
+PLUGIN_DIRECTORY = Path(__file__).parent.parent / 'src' / 'plugins'
+
+
+def make_raw_response(
+    answer: str, num_conversation: int = 1, max_conversation: int = 20
+) -> dict[Any, Any]:
+    """构造一个和Bing返回的结构相同的响应值"""
+    source_attributions = [
+        {
+            'providerDisplayName': f'Example source {i}',
+            'seeMoreUrl': f'https://example.com/article/{i}?from=bing',
+            'searchQuery': answer[:20],
+        }
+        for i in range(5)
+    ]
+    return {
+        'type': 2,
+        'invocationId': '0',
+        'item': {
+            'messages': [
+                {
+                    'text': answer[:40],
+                    'author': 'user',
+                    'from': {'id': '0' * 16, 'name': None},
+                    'createdAt': '2023-05-01T00:00:00+00:00',
+                    'locale': 'zh-cn',
+                    'market': 'zh-cn',
+                    'messageType': 'Chat',
+                    'messageId': '00000000-0000-0000-0000-000000000000',
+                },
+                {
+                    'text': answer,
+                    'author': 'bot',
+                    'createdAt': '2023-05-01T00:00:01+00:00',
+                    'offense': 'None',
+                    'adaptiveCards': [
+                        {
+                            'type': 'AdaptiveCard',
+                            'version': '1.0',
+                            'body': [
+                                {'type': 'TextBlock', 'text': answer, 'wrap': True},
+                                {
+                                    'type': 'TextBlock',
+                                    'size': 'small',
+                                    'text': '\n'.join(
+                                        f'[{i}]: {j["seeMoreUrl"]}'
+                                        for i, j in enumerate(source_attributions)
+                                    ),
+                                    'wrap': True,
+                                },
+                            ],
+                        }
+                    ],
+                    'sourceAttributions': source_attributions,
+                    'feedback': {'tag': None, 'updatedOn': None, 'type': 'None'},
+                    'contentOrigin': 'DeepLeo',
+                    'suggestedResponses': [
+                        {
+                            'text': f'Suggested question {i}?',
+                            'author': 'user',
+                            'messageType': 'Suggestion',
+                            'offense': 'Unknown',
+                            'feedback': {
+                                'tag': None,
+                                'updatedOn': None,
+                                'type': 'None',
+                            },
+                            'contentOrigin': 'DeepLeo',
+                        }
+                        for i in range(3)
+                    ],
+                },
+            ],
+            'firstNewMessageIndex': 1,
+            'conversationId': 'conversation-id',
+            'requestId': 'request-id',
+            'conversationExpiryTime': '2023-05-01T06:00:00.0000000Z',
+            'telemetry': {'metrics': None, 'startTime': '2023-05-01T00:00:00Z'},
+            'throttling': {
+                'maxNumUserMessagesInConversation': max_conversation,
+                'numUserMessagesInConversation': num_conversation,
+            },
+            'result': {'value': 'Success', 'serviceVersion': '20230501.1'},
+        },
+    }
+
+
+def parse_config(config_list: list[str]) -> dict[str, Any]:
+    config: dict[str, Any] = {}
+    for item in config_list:
+        key, _, value = item.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except json.JSONDecodeError:
+            config[key] = value
+    return config
+
+
+def load_plugin(**config: Any) -> Plugin:
+    """在临时目录中初始化nonebot，写入一个假的cookies文件并加载插件"""
+    working_directory = Path(tempfile.mkdtemp(prefix='bingchat-benchmark-'))
+    cookies_directory = working_directory / 'data' / 'BingChat' / 'cookies'
+    cookies_directory.mkdir(parents=True)
+    for i in range(config.pop('num_cookies', 1)):
+        (cookies_directory / f'cookies{i}.json').write_text(
+            json.dumps([{'name': '_U', 'value': f'fake-{i}'}]), encoding='utf-8'
+        )
+    os.chdir(working_directory)
+
+    from nonebot.adapters.onebot.v11 import Adapter
+
+    config.setdefault('superusers', {'10000'})
+    config.setdefault('command_start', {'/'})
+    config.setdefault('log_level', 'WARNING')
+    nonebot.init(driver='~fastapi', **config)
+    nonebot.get_driver().register_adapter(Adapter)
+
+    sys.path.insert(0, str(PLUGIN_DIRECTORY))
+    plugin = nonebot.load_plugin('nonebot_plugin_bing_chat')
+    if plugin is None:
+        raise RuntimeError('无法加载nonebot_plugin_bing_chat')
+    return plugin
@@ -1,38 +1,99 @@
-import json
+import time
+import asyncio
+import importlib.util
 
 from nonebot import require, get_driver
-from nonebot.rule import Rule, to_me, command
-from nonebot.plugin.on import on_message
+from pydantic import parse_file_as
+from nonebot.log import logger
+from nonebot.typing import T_State
+from nonebot.matcher import Matcher
+from nonebot.message import run_preprocessor, run_postprocessor
 
-from .data_model import PluginData, PluginConfig
+from .display import compile_display_plan
+from .metrics import CallbackMetric
+from .metrics import registry as metrics_registry
+from .metrics import handler_seconds, register_metrics_route
+from .storage import BaseStorage, RedisStorage, MemoryStorage, SQLiteStorage
+from .upstream import PHASE_LIST, QUANTILE_LIST, UpstreamTimer
+from .data_model import (
+    UserData,
+    UserInfo,
+    FilterData,
+    PluginData,
+    CookiesUsage,
+    PluginConfig,
+)
+from .dispatcher import ROUTE_KEY, CommandRouter
+from .log_writer import ResponseLogWriter
+from .permission import PermissionFilter
+from .rate_limit import RateLimiter
+from .answer_cache import AnswerCache
+from .chatbot_pool import ChatbotPool
+from .render_cache import RenderCache
+from .expiring_dict import ExpiringLRUDict, get_deep_size
+from .request_queue import RequestQueue
+from .single_flight import SingleFlight
 
 plugin_config = PluginConfig.parse_obj(get_driver().config)
 
-plugin_data = PluginData()
+chatbot_pool = ChatbotPool(
+    max_size=plugin_config.bingchat_chatbot_pool_size,
+    idle_timeout=plugin_config.bingchat_chatbot_idle_timeout,
+    proxy=plugin_config.bingchat_proxy,
+    spare_margin=plugin_config.bingchat_spare_conversation_margin,
+    max_age=plugin_config.bingchat_conversation_max_age,
+)
 
-command_chat = on_message(
-    rule=command(*plugin_config.bingchat_command_chat)
-    & (to_me() if plugin_config.bingchat_to_me else Rule()),
-    priority=plugin_config.bingchat_priority,
-    block=plugin_config.bingchat_block,
+upstream_timer = UpstreamTimer(
+    connect_timeout=plugin_config.bingchat_connect_timeout,
+    first_frame_timeout=plugin_config.bingchat_first_frame_timeout,
+    complete_timeout=plugin_config.bingchat_complete_timeout,
+    hedge_quantile=plugin_config.bingchat_hedge_quantile,
 )
-command_new_chat = on_message(
-    rule=command(*plugin_config.bingchat_command_new_chat)
-    & (to_me() if plugin_config.bingchat_to_me else Rule()),
-    priority=plugin_config.bingchat_priority,
-    block=plugin_config.bingchat_block,
+
+request_queue = RequestQueue(
+    max_concurrency=plugin_config.bingchat_max_concurrency,
+    max_user_queue_size=plugin_config.bingchat_user_queue_size,
+    max_queue_size=plugin_config.bingchat_queue_size,
 )
-command_history_chat = on_message(
-    rule=command(*plugin_config.bingchat_command_history_chat)
-    & (to_me() if plugin_config.bingchat_to_me else Rule()),
-    priority=plugin_config.bingchat_priority,
-    block=plugin_config.bingchat_block,
+
+
+def _is_user_data_evictable(user_info: UserInfo, user_data: UserData) -> bool:
+    return not request_queue.get_user_num_pending(user_info)
+
+
+def _on_user_data_evicted(user_info: UserInfo, user_data: UserData) -> None:
+    task = asyncio.create_task(chatbot_pool.discard(user_info))
+    _background_task_set.add(task)
+    task.add_done_callback(_background_task_set.discard)
+
+
+# 保留关闭Chatbot的任务的引用，避免任务在完成前被回收
+_background_task_set: set[asyncio.Task[None]] = set()
+
+
+plugin_data = PluginData(
+    user_data_dict=ExpiringLRUDict(
+        max_size=plugin_config.bingchat_max_user_data,
+        ttl=plugin_config.bingchat_user_data_ttl,
+        get_last_time=lambda user_data: user_data.last_time,
+        is_evictable=_is_user_data_evictable,
+        on_evict=_on_user_data_evicted,
+    ),
+    reply_message_id_dict=ExpiringLRUDict(
+        max_size=plugin_config.bingchat_max_reply_message_id,
+        ttl=plugin_config.bingchat_reply_message_id_ttl,
+    ),
 )
 
-matcher_reply_to_me = on_message(
-    rule=to_me(),
-    priority=plugin_config.bingchat_priority,
-    block=plugin_config.bingchat_block,
+command_router = CommandRouter(
+    command_start=plugin_config.command_start,
+    command_dict={
+        'chat': plugin_config.bingchat_command_chat,
+        'new_chat': plugin_config.bingchat_command_new_chat,
+        'history': plugin_config.bingchat_command_history_chat,
+        'filter': plugin_config.bingchat_command_filter,
+    },
 )
 
 COMMON_HELP_MESSAGE = (
@@ -66,19 +127,19 @@ def init() -> None:
         raise RuntimeError(
             'BingChat插件未配置cookie，请在./data/BingChat/cookies/cookies.json中填入你的cookie'
         )
-    for cookies_file_path in plugin_cookies_file_path_list:
-        if cookies_file_path.stat().st_size == 0:
-            raise RuntimeError(f'BingChat插件未配置cookie，请在{cookies_file_path}中填入你的cookie')
+    # 文件内容在驱动器启动后和账号状态一起在后台检查，见cookies.check_cookies_status
+    plugin_data.cookies_file_path_list = plugin_cookies_file_path_list
+
+    # 读取每个账号的使用记录
+    cookies_usage_file_path = plugin_directory / 'cookies_usage.json'
+    if cookies_usage_file_path.exists():
         try:
-            with open(cookies_file_path, 'r', encoding='utf-8') as f:
-                json.load(f)
+            plugin_data.cookies_usage_dict = parse_file_as(
+                dict[str, CookiesUsage], cookies_usage_file_path
+            )
         except Exception as exc:
-            raise RuntimeError(
-                f'BingChat插件配置的cookie不是一个合法的json，请检查{cookies_file_path}'
-            ) from exc
-
-    plugin_data.cookies_file_path_list = plugin_cookies_file_path_list
-    plugin_data.current_cookies_file_path = plugin_data.cookies_file_path_list[0]
+            logger.error(f'读取账号使用记录{cookies_usage_file_path}时出错，将重新记录')
+            logger.error(exc)
 
     # 创建log文件夹
     plugin_log_directory = plugin_directory / 'log'
@@ -87,26 +148,277 @@ def init() -> None:
     # 检查依赖
     require('nonebot_plugin_apscheduler')
     if any(i == 'image' for i, _ in plugin_config.bingchat_display_content_types):
-        try:
-            require('nonebot_plugin_htmlrender')
-        except Exception as exc:
+        # 只检查是否安装，第一次渲染时才加载，不在启动时打开浏览器
+        if importlib.util.find_spec('nonebot_plugin_htmlrender') is None:
             raise RuntimeError(
                 '请使用 pip install nonebot-plugin-bing-chat[image] markdown渲染插件'
-            ) from exc
+            )
 
 
 init()
 
-"""
 from nonebot_plugin_apscheduler import scheduler
 
+storage: BaseStorage
+match plugin_config.bingchat_storage:
+    case 'sqlite':
+        storage = SQLiteStorage(plugin_config.bingchat_plugin_directory / 'bingchat.db')
+    case 'redis':
+        storage = RedisStorage(
+            url=plugin_config.bingchat_redis_url,
+            prefix=plugin_config.bingchat_redis_prefix,
+            user_data_ttl=plugin_config.bingchat_user_data_ttl,
+            reply_message_id_ttl=plugin_config.bingchat_reply_message_id_ttl,
+            lock_timeout=plugin_config.bingchat_redis_lock_timeout,
+        )
+    case _:
+        storage = MemoryStorage()
+
+
+@scheduler.scheduled_job(
+    'interval', seconds=plugin_config.bingchat_storage_flush_interval
+)  # type: ignore
+async def _flush_storage() -> None:
+    await storage.flush()
+
+
+@scheduler.scheduled_job('interval', hours=1)  # type: ignore
+async def _purge_storage() -> None:
+    await storage.purge(
+        user_data_ttl=plugin_config.bingchat_user_data_ttl,
+        reply_message_id_ttl=plugin_config.bingchat_reply_message_id_ttl,
+    )
+
+
+@get_driver().on_shutdown
+async def _flush_storage_on_shutdown() -> None:
+    await storage.flush()
+    await storage.close()
+
+
+answer_cache = AnswerCache(
+    max_size=plugin_config.bingchat_answer_cache_size,
+    ttl=plugin_config.bingchat_answer_cache_ttl,
+    allow_pattern_list=plugin_config.bingchat_answer_cache_allow_patterns,
+    deny_pattern_list=plugin_config.bingchat_answer_cache_deny_patterns,
+)
+
+# 等待者最多等待一次完整的询问，领头的请求卡住时自行询问
+single_flight = SingleFlight(timeout=upstream_timer.total_timeout)
+
+permission_filter = PermissionFilter(
+    file_path=plugin_config.bingchat_plugin_directory / 'filter.json',
+    default=FilterData(
+        group_whitelist=plugin_config.bingchat_group_filter_whitelist,
+        group_blacklist=plugin_config.bingchat_group_filter_blacklist,
+        guild_whitelist=plugin_config.bingchat_guild_filter_whitelist,
+        guild_blacklist=plugin_config.bingchat_guild_filter_blacklist,
+        user_blacklist=plugin_config.bingchat_user_filter_blacklist,
+    ),
+)
+
+user_rate_limiter = RateLimiter('每个用户', *plugin_config.bingchat_user_rate_limit)
+group_rate_limiter = RateLimiter('每个群组', *plugin_config.bingchat_group_rate_limit)
+global_rate_limiter = RateLimiter('所有用户', *plugin_config.bingchat_global_rate_limit)
+
+if plugin_config.bingchat_filter_reload_interval > 0:
+
+    @scheduler.scheduled_job(
+        'interval', seconds=plugin_config.bingchat_filter_reload_interval
+    )  # type: ignore
+    async def _reload_permission_filter() -> None:
+        if permission_filter.reload_if_modified():
+            logger.info(f'重新加载了名单：{permission_filter.stats}')
+
+
+display_plan = compile_display_plan(plugin_config.bingchat_display_content_types)
+stream_display_plan = compile_display_plan(
+    plugin_config.bingchat_display_content_types, exclude_answer=True
+)
+
+render_cache = RenderCache(
+    cache_directory=plugin_config.bingchat_plugin_directory / 'render_cache',
+    max_memory_size=plugin_config.bingchat_render_cache_memory_size,
+    max_disk_size=plugin_config.bingchat_render_cache_disk_size,
+    max_concurrency=plugin_config.bingchat_render_max_concurrency,
+    width=plugin_config.bingchat_render_width,
+)
+
+response_log_writer = ResponseLogWriter(
+    log_directory=plugin_config.bingchat_plugin_directory / 'log',
+    max_queue_size=plugin_config.bingchat_log_queue_size,
+    segment_max_size=plugin_config.bingchat_log_segment_max_size,
+    segment_max_age=plugin_config.bingchat_log_segment_max_age,
+)
+
+
+@get_driver().on_startup
+async def _start_response_log_writer() -> None:
+    response_log_writer.start()
+
+
+@get_driver().on_shutdown
+async def _stop_response_log_writer() -> None:
+    await response_log_writer.stop()
+
 
 @scheduler.scheduled_job('cron', hour=2)  # type: ignore
-async def _del_log_file() -> None:
-    print('del_log_file')
-    current_time = datetime.now()
-    plugin_log_directory = plugin_config.bingchat_plugin_directory / 'log'
-    for child_dir in plugin_log_directory.iterdir():
-        if current_time - datetime.fromisoformat(child_dir.name) > timedelta(days=7):
-            shutil.rmtree(child_dir)
-"""
+async def _delete_expired_log() -> None:
+    if num_deleted := await asyncio.to_thread(
+        response_log_writer.delete_expired, plugin_config.bingchat_log_retention_days
+    ):
+        logger.info(f'删除了{num_deleted}天的过期日志')
+
+
+@scheduler.scheduled_job('interval', minutes=1)  # type: ignore
+async def _reap_idle_chatbot() -> None:
+    if num_closed := await chatbot_pool.reap_idle():
+        logger.info(f'关闭了{num_closed}个空闲的Chatbot，连接池状态：{chatbot_pool.stats}')
+
+
+@scheduler.scheduled_job('interval', minutes=10)  # type: ignore
+async def _sweep_expired_data() -> None:
+    if num_answers := answer_cache.sweep():
+        logger.info(f'清理了{num_answers}个过期的回答缓存，回答缓存状态：{answer_cache.stats}')
+    if single_flight.num_coalesced:
+        logger.info(f'合并相同问题的状态：{single_flight.stats}')
+    logger.debug(f'向Bing询问的用时：{upstream_timer.stats}')
+    for rate_limiter in (user_rate_limiter, group_rate_limiter, global_rate_limiter):
+        rate_limiter.sweep()
+    request_queue.sweep()
+    evicted_user_data_list = plugin_data.user_data_dict.sweep()
+    evicted_reply_message_id_list = plugin_data.reply_message_id_dict.sweep()
+    if not evicted_user_data_list and not evicted_reply_message_id_list:
+        return
+    num_bytes = get_deep_size(evicted_user_data_list) + get_deep_size(
+        evicted_reply_message_id_list
+    )
+    logger.info(
+        f'清理了{len(evicted_user_data_list)}个过期的用户数据，'
+        f'{len(evicted_reply_message_id_list)}个过期的消息id，'
+        f'约释放{num_bytes / 1024:.1f}KB内存'
+    )
+
+
+CallbackMetric(
+    'bingchat_active_users', '正在排队或者正在对话的用户数', lambda: request_queue.num_active_users
+)
+CallbackMetric(
+    'bingchat_pending_requests', '正在排队和正在进行的请求数', lambda: request_queue.num_pending
+)
+CallbackMetric(
+    'bingchat_tenant_waiting_requests',
+    '各个群组、频道和所有私聊合计正在等待并发名额的请求数',
+    lambda: {(k,): v for k, v in request_queue.tenant_num_waiting_dict.items()},
+    label_names=('tenant',),
+)
+CallbackMetric(
+    'bingchat_user_data', '内存中的用户数据数', lambda: len(plugin_data.user_data_dict)
+)
+CallbackMetric(
+    'bingchat_reply_message_ids',
+    '内存中记录的消息id数',
+    lambda: len(plugin_data.reply_message_id_dict),
+)
+CallbackMetric(
+    'bingchat_rate_limit_buckets',
+    '内存中没有装满的令牌桶数',
+    lambda: {
+        ('user',): len(user_rate_limiter),
+        ('group',): len(group_rate_limiter),
+        ('global',): len(global_rate_limiter),
+    },
+    label_names=('scope',),
+)
+CallbackMetric(
+    'bingchat_chatbot_pool',
+    'Chatbot连接池的状态',
+    lambda: {
+        (k,): v
+        for k, v in chatbot_pool.stats.items()
+        if k in ('size', 'in_use', 'spares')
+    },
+    label_names=('state',),
+)
+CallbackMetric(
+    'bingchat_chatbot_pool_requests_total',
+    'Chatbot连接池的命中和未命中次数',
+    lambda: {('hit',): chatbot_pool.hits, ('miss',): chatbot_pool.misses},
+    label_names=('result',),
+    type='counter',
+)
+CallbackMetric(
+    'bingchat_spare_conversation_requests_total',
+    '到达对话上限时备用会话可用和不可用的次数',
+    lambda: {('hit',): chatbot_pool.spare_hits, ('miss',): chatbot_pool.spare_misses},
+    label_names=('result',),
+    type='counter',
+)
+CallbackMetric(
+    'bingchat_upstream_latency_seconds',
+    '最近的询问中各段用时的分位数，connect只统计需要创建会话的询问',
+    lambda: {
+        (phase, f'{quantile:g}'): value
+        for phase in PHASE_LIST
+        for quantile in QUANTILE_LIST
+        if (value := upstream_timer.get_quantile(phase, quantile)) is not None
+    },
+    label_names=('phase', 'quantile'),
+)
+CallbackMetric(
+    'bingchat_upstream_timeouts_total',
+    '询问的各段超过期限的次数',
+    lambda: {(k,): v for k, v in upstream_timer.num_timeouts_dict.items()},
+    label_names=('phase',),
+    type='counter',
+)
+CallbackMetric(
+    'bingchat_hedged_asks_total',
+    '首帧太慢时发起的对冲请求中胜出和没有胜出的次数，以及没有其他账号可用而没有发起的次数',
+    lambda: {
+        ('win',): upstream_timer.num_hedge_wins,
+        ('lose',): upstream_timer.num_hedges - upstream_timer.num_hedge_wins,
+        ('skipped',): upstream_timer.num_hedges_skipped,
+    },
+    label_names=('result',),
+    type='counter',
+)
+CallbackMetric(
+    'bingchat_render_cache_requests_total',
+    '渲染缓存的命中、未命中和等待相同渲染的次数',
+    lambda: {
+        ('memory_hit',): render_cache.memory_hits,
+        ('disk_hit',): render_cache.disk_hits,
+        ('miss',): render_cache.misses,
+        ('coalesced',): render_cache.num_coalesced,
+    },
+    label_names=('result',),
+    type='counter',
+)
+CallbackMetric(
+    'bingchat_answer_cache_requests_total',
+    '回答缓存的命中和未命中次数',
+    lambda: {('hit',): answer_cache.hits, ('miss',): answer_cache.misses},
+    label_names=('result',),
+    type='counter',
+)
+
+if plugin_config.bingchat_metrics:
+    metrics_registry.enabled = True
+    register_metrics_route(
+        plugin_config.bingchat_metrics_path, plugin_config.bingchat_metrics_token
+    )
+
+    # 命令对应的路由和开始时间
+    _handler_start_time_dict: dict[Matcher, tuple[str, float]] = {}
+
+    @run_preprocessor
+    async def _record_handler_start_time(matcher: Matcher, state: T_State) -> None:
+        if (route := state.get(ROUTE_KEY)) is not None:
+            _handler_start_time_dict[matcher] = (route, time.perf_counter())
+
+    @run_postprocessor
+    async def _record_handler_time(matcher: Matcher) -> None:
+        if item := _handler_start_time_dict.pop(matcher, None):
+            route, start_time = item
+            handler_seconds.observe(time.perf_counter() - start_time, route)
@@ -0,0 +1,87 @@
+import re
+import time
+from typing import Optional
+
+from .data_model import BingChatResponse
+from .expiring_dict import ExpiringLRUDict
+
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def get_prompt_key(prompt: str, conversation_style: str) -> str:
+    """忽略空白和大小写的差异，相同风格下相同的问题得到相同的键"""
+    normalized_prompt = _WHITESPACE_PATTERN.sub(' ', prompt).strip().casefold()
+    return f'{conversation_style}\n{normalized_prompt}'
+
+
+class CachedAnswer:
+    __slots__ = ('response', 'created_at')
+
+    def __init__(self, response: BingChatResponse) -> None:
+        self.response = response
+        self.created_at = time.time()
+
+
+class AnswerCache:
+    """缓存新对话第一轮的回答，相同的问题在ttl内直接返回，不再消耗账号的次数
+
+    allow_pattern_list不为空时，只有匹配其中之一的问题才会缓存；匹配deny_pattern_list的问题不会缓存
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float,
+        allow_pattern_list: list[str],
+        deny_pattern_list: list[str],
+    ) -> None:
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._allow_pattern_list = [re.compile(i) for i in allow_pattern_list]
+        self._deny_pattern_list = [re.compile(i) for i in deny_pattern_list]
+        self._data: ExpiringLRUDict[str, CachedAnswer] = ExpiringLRUDict(
+            max_size=max_size, ttl=ttl, get_last_time=lambda i: i.created_at
+        )
+
+    @property
+    def stats(self) -> dict[str, float]:
+        num_requests = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / num_requests if num_requests else 0,
+            # 每次命中都省下了一次新建对话和一次询问
+            'saved_messages': self.hits,
+        }
+
+    def is_cacheable(self, prompt: str) -> bool:
+        if self._allow_pattern_list and not any(
+            i.search(prompt) for i in self._allow_pattern_list
+        ):
+            return False
+        return not any(i.search(prompt) for i in self._deny_pattern_list)
+
+    def get(self, prompt: str, conversation_style: str) -> Optional[BingChatResponse]:
+        if not self.is_cacheable(prompt):
+            return None
+        key = get_prompt_key(prompt, conversation_style)
+        cached_answer = self._data.get(key)
+        if cached_answer is None or time.time() - cached_answer.created_at > self.ttl:
+            self._data.pop(key, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cached_answer.response
+
+    def put(
+        self, prompt: str, conversation_style: str, response: BingChatResponse
+    ) -> None:
+        if not self.is_cacheable(prompt):
+            return
+        key = get_prompt_key(prompt, conversation_style)
+        self._data[key] = CachedAnswer(response)
+
+    def sweep(self) -> int:
+        return len(self._data.sweep())
@@ -0,0 +1,320 @@
+import json
+import time
+import asyncio
+from typing import TYPE_CHECKING, Any, Optional
+from pathlib import Path
+from collections import OrderedDict
+
+from pydantic import BaseModel
+from nonebot.log import logger
+
+from .data_model import UserInfo, BingSession
+from .exceptions import BingchatNetworkException
+
+# EdgeGPT连同它的依赖导入要花约0.5秒，推迟到第一次创建会话时再导入
+if TYPE_CHECKING:
+    from EdgeGPT import Chatbot
+else:
+    Chatbot = Any
+
+
+class PooledChatbot(BaseModel, arbitrary_types_allowed=True):
+    chatbot: Chatbot
+    cookies_file_path: Path
+    last_time: float
+    created_time: float
+    in_use: bool = False
+    # cookies文件已被删除，对话继续使用内存中的会话直到结束，不再准备备用会话
+    retired: bool = False
+    # 对话快要到达上限时在后台创建的备用会话
+    spare: Optional[asyncio.Task[Optional[Chatbot]]] = None
+
+
+class ChatbotPool:
+    """在多轮对话之间保留Chatbot，并限制同时存在的连接数
+
+    EdgeGPT每次询问都会重新建立websocket，所以这里保留的是Chatbot（也就是Bing的会话），
+    每次询问结束后只关闭websocket，下一轮对话不需要再重新创建会话
+
+    对话还剩spare_margin轮到达上限，或者会话快要超过max_age时，在后台为用户准备一个备用会话，
+    到达上限后用rotate直接换上，不需要先收到Bing的拒绝再重新创建
+
+    Chatbot被关闭后，可以用保存在用户数据中的会话信息（get_session）恢复，继续Bing上的同一个对话
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        idle_timeout: float,
+        proxy: Optional[str] = None,
+        spare_margin: int = 1,
+        max_age: float = 0,
+    ) -> None:
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.proxy = proxy
+        self.spare_margin = spare_margin
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.spare_hits = 0
+        self.spare_misses = 0
+        self.resumes = 0
+        self._entries: OrderedDict[UserInfo, PooledChatbot] = OrderedDict()
+        self._lock = asyncio.Lock()
+        self._num_creating = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_info: UserInfo) -> bool:
+        return user_info in self._entries
+
+    @property
+    def num_spares(self) -> int:
+        return sum(i.spare is not None for i in self._entries.values())
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            'size': len(self._entries),
+            'in_use': sum(i.in_use for i in self._entries.values()),
+            'spares': self.num_spares,
+            'hits': self.hits,
+            'misses': self.misses,
+            'spare_hits': self.spare_hits,
+            'spare_misses': self.spare_misses,
+            'resumes': self.resumes,
+        }
+
+    def get_cookies_file_path(self, user_info: UserInfo) -> Optional[Path]:
+        """返回用户的Chatbot所使用的cookies文件，没有Chatbot则返回None"""
+        if entry := self._entries.get(user_info):
+            return entry.cookies_file_path
+        return None
+
+    def get_session(self, user_info: UserInfo) -> Optional[BingSession]:
+        """返回用户的Chatbot的会话信息，没有Chatbot则返回None"""
+        if not (entry := self._entries.get(user_info)):
+            return None
+        request = entry.chatbot.chat_hub.request
+        return BingSession(
+            cookies_file_name=entry.cookies_file_path.name,
+            conversation_id=request.conversation_id,
+            client_id=request.client_id,
+            conversation_signature=request.conversation_signature,
+            invocation_id=request.invocation_id,
+            created_time=entry.created_time,
+        )
+
+    async def acquire(
+        self,
+        user_info: UserInfo,
+        cookies_file_path: Path,
+        session: Optional[BingSession] = None,
+    ) -> Chatbot:
+        """获取用户的Chatbot，如果没有则用session恢复，没有session时使用cookies_file_path创建一个"""
+        if (entry := self._entries.get(user_info)) and (
+            session is not None and self._is_stale(entry, session)
+        ):
+            # 其他进程已经在这个对话上继续询问过，或者换到了别的对话
+            await self.discard(user_info)
+            entry = None
+        if entry:
+            self.hits += 1
+            entry.in_use = True
+            entry.last_time = time.time()
+            self._entries.move_to_end(user_info)
+            return entry.chatbot
+
+        self.misses += 1
+        async with self._lock:
+            await self._make_room()
+            self._num_creating += 1
+        try:
+            if session is not None:
+                chatbot = await self._resume_chatbot(cookies_file_path, session)
+                created_time = session.created_time
+                self.resumes += 1
+            else:
+                chatbot = await self._create_chatbot(cookies_file_path)
+                created_time = time.time()
+        finally:
+            self._num_creating -= 1
+
+        self._entries[user_info] = PooledChatbot(
+            chatbot=chatbot,
+            cookies_file_path=cookies_file_path,
+            last_time=time.time(),
+            created_time=created_time,
+            in_use=True,
+        )
+        return chatbot
+
+    def _is_stale(self, entry: PooledChatbot, session: BingSession) -> bool:
+        request = entry.chatbot.chat_hub.request
+        return (
+            request.conversation_id != session.conversation_id
+            or request.invocation_id < session.invocation_id
+        )
+
+    async def _create_chatbot(self, cookies_file_path: Path) -> Chatbot:
+        from EdgeGPT import Chatbot
+
+        # Chatbot的构造函数会同步地创建会话，而且不会关闭创建会话用的httpx.Client
+        return await Chatbot.create(
+            cookie_path=str(cookies_file_path), proxy=self.proxy
+        )
+
+    async def _resume_chatbot(
+        self, cookies_file_path: Path, session: BingSession
+    ) -> Chatbot:
+        from EdgeGPT import Chatbot, _ChatHub, _Conversation
+
+        # EdgeGPT没有恢复会话的接口，按照Chatbot.create的步骤构造，只是用保存的会话信息代替创建会话的请求
+        chatbot = Chatbot.__new__(Chatbot)
+        chatbot.cookies = json.loads(
+            await asyncio.to_thread(cookies_file_path.read_text, encoding='utf-8')
+        )
+        chatbot.proxy = self.proxy
+        conversation = _Conversation(async_mode=True)
+        conversation.struct = {
+            'conversationId': session.conversation_id,
+            'clientId': session.client_id,
+            'conversationSignature': session.conversation_signature,
+            'result': {'value': 'Success', 'message': None},
+        }
+        chatbot.chat_hub = _ChatHub(conversation)
+        chatbot.chat_hub.request.invocation_id = session.invocation_id
+        return chatbot
+
+    async def create_detached(self, cookies_file_path: Path) -> Chatbot:
+        """创建一个不放入连接池的会话，用于对冲请求，胜出后用replace放入连接池"""
+        return await self._create_chatbot(cookies_file_path)
+
+    async def replace(
+        self, user_info: UserInfo, chatbot: Chatbot, cookies_file_path: Path
+    ) -> bool:
+        """把用户正在使用的会话换成另一个账号上的会话，用户不在连接池中时返回False"""
+        if not (entry := self._entries.get(user_info)):
+            return False
+        old_chatbot = entry.chatbot
+        if entry.spare is not None:
+            entry.spare.cancel()
+            entry.spare = None
+        entry.chatbot = chatbot
+        entry.cookies_file_path = cookies_file_path
+        entry.created_time = entry.last_time = time.time()
+        entry.retired = False
+        await old_chatbot.close()
+        return True
+
+    async def _create_spare(self, cookies_file_path: Path) -> Optional[Chatbot]:
+        try:
+            return await self._create_chatbot(cookies_file_path)
+        except Exception as exc:
+            logger.warning(f'创建备用会话时出错：{exc}')
+            return None
+
+    def _is_aging(self, entry: PooledChatbot, lead_time: float = 0) -> bool:
+        return bool(self.max_age) and (
+            time.time() - entry.created_time >= self.max_age - lead_time
+        )
+
+    def should_rotate(
+        self, user_info: UserInfo, num_conversation: int, max_conversation: int
+    ) -> bool:
+        """对话已经到达上限或者会话已经超过max_age，下一次询问需要换成新的会话"""
+        if not (entry := self._entries.get(user_info)):
+            return False
+        return num_conversation >= max_conversation or self._is_aging(entry)
+
+    def prepare_spare(
+        self, user_info: UserInfo, num_conversation: int, max_conversation: int
+    ) -> bool:
+        """快要需要换会话时在后台创建备用会话，返回是否开始创建"""
+        if not (entry := self._entries.get(user_info)) or entry.spare is not None:
+            return False
+        if entry.retired:
+            return False
+        if not (
+            num_conversation >= max_conversation - self.spare_margin
+            # 留出创建会话的时间，和idle_timeout相比很短
+            or self._is_aging(entry, lead_time=min(self.max_age / 10, 300))
+        ):
+            return False
+        if len(self._entries) + self._num_creating + self.num_spares >= self.max_size:
+            return False
+        entry.spare = asyncio.create_task(self._create_spare(entry.cookies_file_path))
+        return True
+
+    async def rotate(self, user_info: UserInfo) -> bool:
+        """把用户的会话换成备用会话，没有可用的备用会话时移除Chatbot，返回是否用上了备用会话"""
+        if not (entry := self._entries.get(user_info)):
+            return False
+        spare, entry.spare = entry.spare, None
+        # 备用会话一般早已创建好，还在创建时等待也比重新创建快
+        if spare is None or (chatbot := await spare) is None:
+            self.spare_misses += 1
+            await self.discard(user_info)
+            return False
+
+        self.spare_hits += 1
+        await entry.chatbot.close()
+        entry.chatbot = chatbot
+        entry.created_time = entry.last_time = time.time()
+        return True
+
+    def retire(self, cookies_file_path: Path) -> int:
+        """cookies文件被删除后调用，已有的对话用完当前会话后换到其他账号，返回受影响的对话数"""
+        num_retired = 0
+        for entry in self._entries.values():
+            if entry.cookies_file_path != cookies_file_path:
+                continue
+            entry.retired = True
+            if entry.spare is not None:
+                entry.spare.cancel()
+                entry.spare = None
+            num_retired += 1
+        return num_retired
+
+    async def release(self, user_info: UserInfo) -> None:
+        """询问结束后调用，关闭websocket但保留会话"""
+        if not (entry := self._entries.get(user_info)):
+            return
+        entry.in_use = False
+        entry.last_time = time.time()
+        await entry.chatbot.close()
+
+    async def discard(self, user_info: UserInfo) -> None:
+        """关闭并移除用户的Chatbot和备用会话"""
+        if entry := self._entries.pop(user_info, None):
+            await entry.chatbot.close()
+            if entry.spare is not None:
+                entry.spare.cancel()
+
+    async def close_all(self) -> None:
+        for user_info in list(self._entries):
+            await self.discard(user_info)
+
+    async def reap_idle(self) -> int:
+        """关闭空闲时间超过idle_timeout的Chatbot，返回关闭的数量"""
+        deadline = time.time() - self.idle_timeout
+        idle_user_info_list = [
+            user_info
+            for user_info, entry in self._entries.items()
+            if not entry.in_use and entry.last_time < deadline
+        ]
+        for user_info in idle_user_info_list:
+            await self.discard(user_info)
+        return len(idle_user_info_list)
+
+    async def _make_room(self) -> None:
+        if len(self._entries) + self._num_creating + self.num_spares < self.max_size:
+            return
+        for user_info, entry in self._entries.items():
+            if not entry.in_use:
+                logger.debug(f'Chatbot连接池已满，关闭最久未使用的Chatbot：{user_info}')
+                await self.discard(user_info)
+                return
+        raise BingchatNetworkException('<Chatbot连接数已达上限，请稍后再试>')
@@ -0,0 +1,392 @@
+import json
+import asyncio
+import hashlib
+from typing import Optional
+from pathlib import Path
+from datetime import date, datetime, timedelta
+
+from nonebot import get_driver
+from nonebot.log import logger
+from nonebot_plugin_apscheduler import scheduler
+
+from . import storage, plugin_data, chatbot_pool, plugin_config
+from .metrics import CallbackMetric
+from .data_model import BingSession, CookiesUsage, CookiesStatus
+
+_cookies_usage_file_path = (
+    plugin_config.bingchat_plugin_directory / 'cookies_usage.json'
+)
+_is_cookies_usage_changed = False
+_cookies_directory_path = plugin_config.bingchat_plugin_directory / 'cookies'
+# dict[cookies文件, 上次检查时的修改时间]，启动后第一次检查时才填入
+_cookies_mtime_dict: dict[Path, float] = {}
+
+
+def get_cookies_usage(cookies_file_path: Path) -> CookiesUsage:
+    """获取账号当天的使用记录，跨天后自动重置"""
+    today = date.today().isoformat()
+    usage = plugin_data.cookies_usage_dict.get(cookies_file_path.name)
+    if usage is None or usage.date != today:
+        usage = CookiesUsage(date=today)
+        plugin_data.cookies_usage_dict[cookies_file_path.name] = usage
+    return usage
+
+
+def get_cookies_status(cookies_file_path: Path) -> CookiesStatus:
+    """获取账号缓存的健康状态"""
+    return plugin_data.cookies_status_dict.setdefault(
+        cookies_file_path.name, CookiesStatus()
+    )
+
+
+def is_cookies_throttled(cookies_file_path: Path) -> bool:
+    """账号是否还在今日上限的限制期内"""
+    throttled_until = get_cookies_usage(cookies_file_path).throttled_until
+    return throttled_until is not None and throttled_until > datetime.now()
+
+
+def is_cookies_usable(cookies_file_path: Path) -> bool:
+    """根据缓存的健康状态判断账号能否使用，不会发出任何请求"""
+    match get_cookies_status(cookies_file_path).state:
+        case 'invalid':
+            return False
+        case _:
+            return not is_cookies_throttled(cookies_file_path)
+
+
+def is_cookies_retired(cookies_file_path: Path) -> bool:
+    """在达到每日上限之前提前退役"""
+    return get_cookies_usage(cookies_file_path).num_message >= (
+        plugin_config.bingchat_cookies_daily_limit
+        - plugin_config.bingchat_cookies_daily_reserve
+    )
+
+
+def choose_cookies(exclude: Optional[Path] = None) -> Optional[Path]:
+    """为新的对话选择使用次数最少的可用账号，没有可用账号则返回None"""
+    usable_cookies_file_path_list = [
+        cookies_file_path
+        for cookies_file_path in plugin_data.cookies_file_path_list
+        if cookies_file_path != exclude and is_cookies_usable(cookies_file_path)
+    ]
+    # 所有账号都已提前退役时，继续使用还没有真正用尽的账号
+    usable_cookies_file_path_list = [
+        cookies_file_path
+        for cookies_file_path in usable_cookies_file_path_list
+        if not is_cookies_retired(cookies_file_path)
+    ] or usable_cookies_file_path_list
+    if not usable_cookies_file_path_list:
+        return None
+
+    cookies_file_path = min(
+        usable_cookies_file_path_list,
+        key=lambda i: (
+            get_cookies_usage(i).num_message,
+            get_cookies_usage(i).num_conversation,
+        ),
+    )
+    # 在回答返回之前就计入新的对话，避免同时开始的对话都挤到同一个账号上，
+    # 没能创建会话时用cancel_cookies_conversation撤销
+    _record_change(cookies_file_path, num_conversation=1)
+    return cookies_file_path
+
+
+def find_session_cookies(session: Optional[BingSession]) -> Optional[Path]:
+    """返回恢复会话时使用的账号，会话所在的账号已经被删除或者不能使用时返回None"""
+    if session is None:
+        return None
+    for cookies_file_path in plugin_data.cookies_file_path_list:
+        if cookies_file_path.name == session.cookies_file_name:
+            return cookies_file_path if is_cookies_usable(cookies_file_path) else None
+    return None
+
+
+def record_cookies_conversation(cookies_file_path: Path) -> None:
+    """不经过choose_cookies开始新的对话时调用，例如换上备用会话"""
+    _record_change(cookies_file_path, num_conversation=1)
+
+
+def cancel_cookies_conversation(cookies_file_path: Path) -> None:
+    """choose_cookies选出的账号没能创建会话时调用，撤销计入的对话"""
+    _record_change(cookies_file_path, num_conversation=-1)
+
+
+def record_cookies_usage(cookies_file_path: Path) -> None:
+    """每收到一次成功的回答，记录账号发送了一条消息"""
+    _record_change(cookies_file_path, num_message=1)
+
+
+def mark_cookies_throttled(cookies_file_path: Path) -> None:
+    """账号到达今日上限，在第二天之前不再使用"""
+    global _is_cookies_usage_changed
+    logger.warning(f'账号{cookies_file_path.name}到达今日请求上限')
+    get_cookies_status(cookies_file_path).state = 'throttled'
+    _is_cookies_usage_changed = True
+    usage = get_cookies_usage(cookies_file_path)
+    usage.throttled_until = datetime.combine(
+        date.today() + timedelta(days=1), datetime.min.time()
+    )
+    storage.set_cookies_throttled(
+        cookies_file_path.name, usage.date, usage.throttled_until
+    )
+
+
+def _record_change(
+    cookies_file_path: Path, num_message: int = 0, num_conversation: int = 0
+) -> None:
+    global _is_cookies_usage_changed
+    _is_cookies_usage_changed = True
+    usage = get_cookies_usage(cookies_file_path)
+    usage.num_message += num_message
+    usage.num_conversation += num_conversation
+    storage.add_cookies_usage(
+        cookies_file_path.name, usage.date, num_message, num_conversation
+    )
+
+
+def _write_cookies_usage(data: str) -> None:
+    _cookies_usage_file_path.write_text(data, encoding='utf-8')
+
+
+@scheduler.scheduled_job('interval', minutes=1)  # type: ignore
+async def save_cookies_usage() -> None:
+    """把账号使用记录写入文件"""
+    global _is_cookies_usage_changed
+    if not _is_cookies_usage_changed:
+        return
+    _is_cookies_usage_changed = False
+    data = json.dumps(
+        {k: v.dict() for k, v in plugin_data.cookies_usage_dict.items()},
+        ensure_ascii=False,
+        indent=2,
+        default=str,
+    )
+    await asyncio.to_thread(_write_cookies_usage, data)
+
+
+@get_driver().on_shutdown
+async def _save_cookies_usage_on_shutdown() -> None:
+    # 每分钟保存一次，退出前保存最后一分钟内的记录
+    await save_cookies_usage()
+
+
+if storage.shared:
+
+    @scheduler.scheduled_job(
+        'interval', seconds=plugin_config.bingchat_storage_flush_interval
+    )  # type: ignore
+    async def sync_cookies_usage() -> None:
+        """多个进程共用存储时，用所有进程汇总的使用次数代替本进程的记录
+
+        其他进程发现的到达上限的账号，本进程也不再使用
+        """
+        today = date.today().isoformat()
+        for cookies_name, usage in (await storage.load_cookies_usage(today)).items():
+            # 本进程刚记录的限制期可能还没有写入存储
+            old_usage = plugin_data.cookies_usage_dict.get(cookies_name)
+            if (
+                old_usage is not None
+                and old_usage.date == today
+                and old_usage.throttled_until is not None
+            ):
+                usage.throttled_until = max(
+                    usage.throttled_until or old_usage.throttled_until,
+                    old_usage.throttled_until,
+                )
+            plugin_data.cookies_usage_dict[cookies_name] = usage
+            status = plugin_data.cookies_status_dict.get(cookies_name)
+            if (
+                status is not None
+                and status.state != 'invalid'
+                and usage.throttled_until is not None
+                and usage.throttled_until > datetime.now()
+            ):
+                status.state = 'throttled'
+
+
+def _validate_cookies_file(cookies_file_path: Path) -> Optional[str]:
+    """检查cookies文件是否为空、是否为合法的json，返回错误信息"""
+    try:
+        text = cookies_file_path.read_text(encoding='utf-8')
+    except OSError as exc:
+        return f'读取cookies：{cookies_file_path} 时出错：{exc}'
+    if not text.strip():
+        return f'BingChat插件未配置cookie，请在{cookies_file_path}中填入你的cookie'
+    try:
+        json.loads(text)
+    except ValueError:
+        return f'BingChat插件配置的cookie不是一个合法的json，请检查{cookies_file_path}'
+    return None
+
+
+async def check_cookies_status(cookies_file_path: Path) -> None:
+    """只创建一个会话来检查cookies是否有效，不会消耗账号的消息数"""
+    import httpx
+    from EdgeGPT import Chatbot
+
+    status = get_cookies_status(cookies_file_path)
+    if error := await asyncio.to_thread(_validate_cookies_file, cookies_file_path):
+        logger.error(error)
+        status.state = 'invalid'
+        status.checked_at = datetime.now()
+        return
+    chatbot = None
+    try:
+        chatbot = await Chatbot.create(
+            cookie_path=str(cookies_file_path), proxy=plugin_config.bingchat_proxy
+        )
+    except httpx.HTTPError as exc:
+        # 网络错误不能说明cookies无效，保持原来的状态
+        logger.warning(f'检查cookies：{cookies_file_path} 时网络错误：{exc}')
+        return
+    except Exception as exc:
+        logger.error(f'cookies：{cookies_file_path} 无效')
+        logger.error(exc)
+        status.state = 'invalid'
+    else:
+        # 创建会话无法看出账号是否到达上限，所以还在限制期内的账号保持throttled
+        status.state = (
+            'throttled' if is_cookies_throttled(cookies_file_path) else 'healthy'
+        )
+    finally:
+        if chatbot is not None:
+            await chatbot.close()
+    status.checked_at = datetime.now()
+
+
+@scheduler.scheduled_job(
+    'interval', minutes=plugin_config.bingchat_cookies_check_interval
+)  # type: ignore
+async def check_all_cookies_status() -> None:
+    """定时检查所有账号，切换账号时只需要查询缓存的状态"""
+    await asyncio.gather(
+        *(check_cookies_status(i) for i in plugin_data.cookies_file_path_list)
+    )
+    logger.debug(
+        '账号状态：'
+        + ', '.join(
+            f'{k}: {v.state}' for k, v in plugin_data.cookies_status_dict.items()
+        )
+    )
+
+
+def _scan_cookies_directory() -> dict[Path, float]:
+    mtime_dict: dict[Path, float] = {}
+    for cookies_file_path in _cookies_directory_path.glob('*.json'):
+        try:
+            mtime_dict[cookies_file_path] = cookies_file_path.stat().st_mtime
+        except FileNotFoundError:
+            continue
+    return mtime_dict
+
+
+async def reload_cookies_directory() -> None:
+    """把cookies文件夹中新增、修改和删除的文件同步到账号列表，只检查有变化的文件
+
+    新增的文件检查完才加入账号列表；删除的文件立即不再分配给新的对话，
+    正在使用它的对话继续用内存中的会话，直到对话结束或被刷新
+    """
+    global _cookies_mtime_dict
+    mtime_dict = await asyncio.to_thread(_scan_cookies_directory)
+    old_mtime_dict, _cookies_mtime_dict = _cookies_mtime_dict, mtime_dict
+    if not old_mtime_dict:
+        # 第一次检查，账号列表在init中已经读取过了
+        old_mtime_dict = {
+            i: mtime_dict.get(i, 0.0) for i in plugin_data.cookies_file_path_list
+        }
+
+    removed_path_list = [i for i in old_mtime_dict if i not in mtime_dict]
+    added_path_list = [i for i in mtime_dict if i not in old_mtime_dict]
+    modified_path_list = [
+        i
+        for i in old_mtime_dict
+        if i in mtime_dict and mtime_dict[i] != old_mtime_dict[i]
+    ]
+    if not (removed_path_list or added_path_list or modified_path_list):
+        return
+
+    if removed_path_list:
+        plugin_data.cookies_file_path_list = [
+            i for i in plugin_data.cookies_file_path_list if i not in removed_path_list
+        ]
+    for cookies_file_path in removed_path_list:
+        plugin_data.cookies_status_dict.pop(cookies_file_path.name, None)
+        num_retired = chatbot_pool.retire(cookies_file_path)
+        logger.info(f'cookies：{cookies_file_path} 已被删除，{num_retired}个对话结束后不再使用')
+
+    for cookies_file_path in added_path_list + modified_path_list:
+        plugin_data.cookies_status_dict.pop(cookies_file_path.name, None)
+    await asyncio.gather(
+        *(check_cookies_status(i) for i in added_path_list + modified_path_list)
+    )
+    if added_path_list:
+        plugin_data.cookies_file_path_list = [
+            *plugin_data.cookies_file_path_list,
+            *added_path_list,
+        ]
+    logger.info(
+        f'重新加载了cookies文件夹：新增{len(added_path_list)}个，修改{len(modified_path_list)}个，'
+        f'删除{len(removed_path_list)}个，账号状态：'
+        + ', '.join(
+            f'{i.name}: {get_cookies_status(i).state}'
+            for i in added_path_list + modified_path_list
+        )
+    )
+    if not plugin_data.cookies_file_path_list:
+        logger.warning(f'cookies文件夹{_cookies_directory_path}中没有cookies文件')
+
+
+if plugin_config.bingchat_cookies_reload_interval > 0:
+
+    @scheduler.scheduled_job(
+        'interval', seconds=plugin_config.bingchat_cookies_reload_interval
+    )  # type: ignore
+    async def _reload_cookies_directory() -> None:
+        await reload_cookies_directory()
+
+
+@get_driver().on_startup
+async def _check_all_cookies_status_on_startup() -> None:
+    task = asyncio.create_task(check_all_cookies_status())
+    _background_task_set.add(task)
+    task.add_done_callback(_background_task_set.discard)
+
+
+# 保留启动时检查账号的任务的引用，避免任务在完成前被回收
+_background_task_set: set[asyncio.Task[None]] = set()
+
+
+def get_cookies_label(cookies_file_path: Path) -> str:
+    """指标中用文件名的哈希代替文件名，文件名可能是账号的邮箱"""
+    return hashlib.sha256(cookies_file_path.name.encode('utf-8')).hexdigest()[:8]
+
+
+CallbackMetric(
+    'bingchat_cookies_messages',
+    '各个账号当天已经发送的消息数',
+    lambda: {
+        (get_cookies_label(i),): get_cookies_usage(i).num_message
+        for i in plugin_data.cookies_file_path_list
+    },
+    label_names=('cookies',),
+)
+CallbackMetric(
+    'bingchat_cookies_remaining_messages',
+    '各个账号当天距离保留额度还能发送的消息数',
+    lambda: {
+        (get_cookies_label(i),): plugin_config.bingchat_cookies_daily_limit
+        - plugin_config.bingchat_cookies_daily_reserve
+        - get_cookies_usage(i).num_message
+        for i in plugin_data.cookies_file_path_list
+    },
+    label_names=('cookies',),
+)
+CallbackMetric(
+    'bingchat_cookies_state',
+    '各个账号的健康状态，当前状态的值为1',
+    lambda: {
+        (get_cookies_label(i), get_cookies_status(i).state): 1
+        for i in plugin_data.cookies_file_path_list
+    },
+    label_names=('cookies', 'state'),
+)
@@ -1,19 +1,10 @@
 import re
 import time
-from typing import (
-    Any,
-    Literal,
-    TypeVar,
-    Callable,
-    Optional,
-    ParamSpec,
-    TypeAlias,
-    Concatenate,
-)
+from typing import Any, Literal, Optional, TypeAlias
 from pathlib import Path
+from datetime import datetime
 
-from EdgeGPT import Chatbot
-from pydantic import Extra, BaseModel, validator
+from pydantic import Extra, Field, BaseModel, validator
 from nonebot.log import logger
 
 from .exceptions import (
@@ -22,6 +13,7 @@ from .exceptions import (
     BingChatAccountReachLimitException,
     BingChatConversationReachLimitException,
 )
+from .expiring_dict import ExpiringLRUDict
 
 FilterMode: TypeAlias = Literal['whitelist', 'blacklist']
 ConversationStyle: TypeAlias = Literal['creative', 'balanced', 'precise']
@@ -30,30 +22,21 @@ ResponseContentType: TypeAlias = Literal[
     'answer', 'reference', 'suggested-question', 'num-max-conversation'
 ]
 DisplayContentType: TypeAlias = tuple[DisplayType, list[ResponseContentType]]
-
-TParam = ParamSpec("TParam")
-TReturn = TypeVar("TReturn")
-TOriginalFunc = Callable[TParam, TReturn]
-TDecoratedFunc = Callable[Concatenate[TParam], TReturn]
+StorageType: TypeAlias = Literal['memory', 'sqlite', 'redis']
+CookiesState: TypeAlias = Literal['unknown', 'healthy', 'throttled', 'invalid']
+FilterListName: TypeAlias = Literal[
+    'group_whitelist',
+    'group_blacklist',
+    'guild_whitelist',
+    'guild_blacklist',
+    'user_blacklist',
+]
 
 
 def remove_quote_str(string: str) -> str:
     return re.sub(r'\[\^\d+?\^]', '', string)
 
 
-def get_response_content_handler() -> TDecoratedFunc:
-    def decorator(func: TOriginalFunc) -> TDecoratedFunc:
-        def wrapper(*args, **kwargs) -> TReturn:  # type: ignore
-            try:
-                return func(*args, **kwargs)
-            except (IndexError, KeyError) as exc:
-                raise BingChatResponseException('<无效的响应值>') from exc
-
-        return wrapper
-
-    return decorator
-
-
 class PluginConfig(BaseModel, extra=Extra.ignore):
     superusers: set[int]
     command_start: set[str]
@@ -73,12 +56,63 @@ class PluginConfig(BaseModel, extra=Extra.ignore):
         ('text', ['num-max-conversation', 'answer', 'suggested-question'])
     ]
 
+    bingchat_render_width: int = 500
+    bingchat_render_max_concurrency: int = 2
+    bingchat_render_cache_memory_size: int = 32 * 1024 * 1024
+    bingchat_render_cache_disk_size: int = 256 * 1024 * 1024
+
+    bingchat_stream_mode: bool = False
+    bingchat_stream_flush_interval: float = 1.5
+    bingchat_stream_min_chunk_size: int = 40
+
     bingchat_log: bool = True
+    bingchat_keep_raw_response: bool = False
+    bingchat_log_queue_size: int = 1000
+    bingchat_log_segment_max_size: int = 10 * 1024 * 1024
+    bingchat_log_segment_max_age: float = 3600
+    bingchat_log_retention_days: int = 7
+    bingchat_slow_request_threshold: float = 30
+    bingchat_metrics: bool = False
+    bingchat_metrics_path: str = '/bingchat/metrics'
+    bingchat_metrics_token: Optional[str] = None
     bingchat_proxy: Optional[str] = None
     bingchat_plugin_directory: Path = Path('./data/BingChat')
     bingchat_conversation_style: ConversationStyle = 'balanced'
+
+    bingchat_answer_cache: bool = False
+    bingchat_answer_cache_ttl: int = 3600
+    bingchat_answer_cache_size: int = 1000
+    bingchat_answer_cache_allow_patterns: list[str] = []
+    bingchat_answer_cache_deny_patterns: list[str] = []
+    bingchat_coalesce_asks: bool = False
     bingchat_auto_switch_cookies: bool = False
+    bingchat_cookies_daily_limit: int = 200
+    bingchat_cookies_daily_reserve: int = 10
+    bingchat_cookies_check_interval: int = 30
+    bingchat_cookies_reload_interval: float = 30
     bingchat_auto_refresh_conversation: bool = True
+    bingchat_spare_conversation_margin: int = 1
+    bingchat_conversation_max_age: float = 0
+    bingchat_connect_timeout: float = 30
+    bingchat_first_frame_timeout: float = 60
+    bingchat_complete_timeout: float = 300
+    bingchat_hedge_quantile: float = 0
+    bingchat_chatbot_pool_size: int = 100
+    bingchat_chatbot_idle_timeout: float = 1800
+    bingchat_max_concurrency: int = 8
+    bingchat_user_queue_size: int = 3
+    bingchat_queue_size: int = 100
+    bingchat_priority_groups: set[int] = set()
+    bingchat_group_queue_weights: dict[int, float] = {}
+    bingchat_max_user_data: int = 10000
+    bingchat_user_data_ttl: float = 259200
+    bingchat_max_reply_message_id: int = 100000
+    bingchat_reply_message_id_ttl: float = 259200
+    bingchat_storage: StorageType = 'sqlite'
+    bingchat_storage_flush_interval: float = 5
+    bingchat_redis_url: str = 'redis://localhost:6379/0'
+    bingchat_redis_prefix: str = 'bingchat'
+    bingchat_redis_lock_timeout: float = 300
 
     bingchat_group_filter_mode: FilterMode = 'blacklist'
     bingchat_group_filter_whitelist: set[int] = set()
@@ -87,6 +121,15 @@ class PluginConfig(BaseModel, extra=Extra.ignore):
     bingchat_guild_filter_whitelist: list[dict] = []
     bingchat_guild_filter_blacklist: list[dict] = []
 
+    bingchat_user_filter_blacklist: set[int] = set()
+    bingchat_command_filter: set[str] = {'chat-filter'}
+    bingchat_filter_reload_interval: float = 30
+
+    # (次数, 秒)，次数为0时不限制
+    bingchat_user_rate_limit: tuple[int, float] = (0, 60)
+    bingchat_group_rate_limit: tuple[int, float] = (0, 60)
+    bingchat_global_rate_limit: tuple[int, float] = (0, 60)
+
     def __init__(self, **data: Any) -> None:
         if 'bingchat_show_detail' in data:
             logger.error(
@@ -116,6 +159,12 @@ class PluginConfig(BaseModel, extra=Extra.ignore):
             raise ValueError('bingchat_command_history_chat不能为空')
         return set(v) if not isinstance(v, str) else {v}
 
+    @validator('bingchat_command_filter', pre=True)
+    def bingchat_command_filter_validator(cls, v: Any) -> set[str]:
+        if not v:
+            raise ValueError('bingchat_command_filter不能为空')
+        return set(v) if not isinstance(v, str) else {v}
+
     @validator('bingchat_display_content_types', pre=True)
     def bingchat_display_content_types_validator(
         cls, v: Any
@@ -138,16 +187,86 @@ class PluginConfig(BaseModel, extra=Extra.ignore):
             types.append((display_type, content_type_list))
         return types
 
+    @validator('bingchat_group_queue_weights')
+    def bingchat_group_queue_weights_validator(
+        cls, v: dict[int, float]
+    ) -> dict[int, float]:
+        for group_id, weight in v.items():
+            if weight <= 0:
+                raise ValueError(f'群{group_id}的权重必须大于0')
+        return v
+
+    @validator('bingchat_hedge_quantile')
+    def bingchat_hedge_quantile_validator(cls, v: float) -> float:
+        if not 0 <= v < 1:
+            raise ValueError('bingchat_hedge_quantile必须在0和1之间')
+        return v
+
     @validator('bingchat_plugin_directory', pre=True)
     def bingchat_plugin_directory_validator(cls, v: Any) -> Path:
         return Path(v)
 
 
-class BingChatResponse(BaseModel):
-    raw: dict[Any, Any]
-
-    @validator('raw')
-    def raw_validator(cls, v: dict[Any, Any]) -> dict[Any, Any]:
+class BingChatResponse:
+    """Bing的响应值，只在创建时检查并提取需要的内容，默认不保留原始的响应值"""
+
+    __slots__ = (
+        'answer',
+        'source_attributions_url_list',
+        'suggested_question_list',
+        'num_conversation',
+        'max_conversation',
+        'raw',
+    )
+
+    answer: str
+    source_attributions_url_list: tuple[str, ...]
+    suggested_question_list: tuple[str, ...]
+    num_conversation: int
+    max_conversation: int
+    raw: Optional[dict[Any, Any]]
+
+    def __init__(self, raw: dict[Any, Any], keep_raw: bool = False) -> None:
+        self.check_raw(raw)
+        try:
+            message = raw['item']['messages'][1]
+            throttling = raw['item']['throttling']
+            self.answer = remove_quote_str(message['text'])
+            self.source_attributions_url_list = tuple(
+                i['seeMoreUrl'] for i in message.get('sourceAttributions', [])
+            )
+            self.suggested_question_list = tuple(
+                i['text'] for i in message.get('suggestedResponses', [])
+            )
+            self.num_conversation = int(throttling['numUserMessagesInConversation'])
+            self.max_conversation = int(throttling['maxNumUserMessagesInConversation'])
+        except (IndexError, KeyError, TypeError, ValueError) as exc:
+            raise BingChatResponseException('<无效的响应值>') from exc
+        self.raw = raw if keep_raw else None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'answer': self.answer,
+            'source_attributions_url_list': list(self.source_attributions_url_list),
+            'suggested_question_list': list(self.suggested_question_list),
+            'num_conversation': self.num_conversation,
+            'max_conversation': self.max_conversation,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> 'BingChatResponse':
+        """从to_dict的结果恢复，不会再次检查"""
+        self = cls.__new__(cls)
+        self.answer = data['answer']
+        self.source_attributions_url_list = tuple(data['source_attributions_url_list'])
+        self.suggested_question_list = tuple(data['suggested_question_list'])
+        self.num_conversation = data['num_conversation']
+        self.max_conversation = data['max_conversation']
+        self.raw = None
+        return self
+
+    @staticmethod
+    def check_raw(v: dict[Any, Any]) -> None:
         match v:
             case {'item': {'result': {'value': 'Throttled'}}}:
                 logger.error('<Bing账号到达今日请求上限>')
@@ -203,57 +322,24 @@ class BingChatResponse(BaseModel):
                     ],
                 }
             }:
-                return v
+                return
 
             case _:
                 logger.error('<未知的错误>')
                 raise BingChatResponseException('<未知的错误, 请管理员查看控制台>')
 
     @property
-    @get_response_content_handler()
-    def num_conversation(self) -> int:
-        return int(self.raw['item']['throttling']['numUserMessagesInConversation'])
-
-    @property
-    @get_response_content_handler()
-    def max_conversation(self) -> int:
-        return int(self.raw['item']['throttling']['maxNumUserMessagesInConversation'])
-
-    @property
-    @get_response_content_handler()
     def content_answer(self) -> str:
-        return remove_quote_str(self.raw['item']['messages'][1]['text'])
+        return self.answer
 
     @property
-    @get_response_content_handler()
     def content_reference(self) -> str:
         return '\n'.join(f'- {i}' for i in self.source_attributions_url_list)
 
     @property
     def content_suggested_question(self) -> str:
-        print(self.suggested_question_list)
         return '\n'.join(f'- {i}' for i in self.suggested_question_list)
 
-    @property
-    @get_response_content_handler()
-    def adaptive_cards(self) -> list[str]:
-        return list(self.raw['item']['messages'][1]['adaptiveCards'][0]['body'])
-
-    @property
-    @get_response_content_handler()
-    def source_attributions_url_list(self) -> list[str]:
-        return [
-            i['seeMoreUrl']
-            for i in self.raw['item']['messages'][1]['sourceAttributions']
-        ]
-
-    @property
-    @get_response_content_handler()
-    def suggested_question_list(self) -> list[str]:
-        return [
-            i['text'] for i in self.raw['item']['messages'][1]['suggestedResponses']
-        ]
-
     def get_content(self, type: ResponseContentType = 'answer') -> str:
         match type:
             case 'answer':
@@ -278,21 +364,38 @@ class Sender(BaseModel, extra=Extra.ignore):
     user_name: str
 
 
-class Conversation(BaseModel):
+class Conversation(BaseModel, arbitrary_types_allowed=True):
     ask: str
     response: BingChatResponse
 
+    @validator('response', pre=True)
+    def response_validator(cls, v: Any) -> BingChatResponse:
+        if isinstance(v, dict):
+            return BingChatResponse.from_dict(v)
+        return v
+
+
+class BingSession(BaseModel):
+    """Bing的会话信息，重启后或者在其他进程中可以用它恢复Chatbot，继续同一个对话"""
+
+    cookies_file_name: str
+    conversation_id: str
+    client_id: str
+    conversation_signature: str
+    # 已经发送的消息数，Bing用它区分新对话的第一条消息
+    invocation_id: int
+    created_time: float
+
 
-class UserData(BaseModel, arbitrary_types_allowed=True):
+class UserData(BaseModel, json_encoders={BingChatResponse: BingChatResponse.to_dict}):
     sender: Sender
 
     first_ask_message_id: Optional[int] = None
     last_reply_message_id: int = 0
 
-    chatbot: Optional[Chatbot] = None
-    last_time: float = time.time()
-    is_waiting: bool = False
+    last_time: float = Field(default_factory=time.time)
     history: list[Conversation] = []
+    session: Optional[BingSession] = None
 
     @property
     def latest_conversation(self) -> Conversation:
@@ -306,24 +409,48 @@ class UserData(BaseModel, arbitrary_types_allowed=True):
     def latest_response(self) -> BingChatResponse:
         return self.history[-1].response
 
-    async def clear(self, sender: Sender) -> None:
-        if self.chatbot is not None:
-            await self.chatbot.close()
-
+    def clear(self, sender: Sender) -> None:
         self.sender = sender
         self.first_ask_message_id = None
         self.last_reply_message_id = 0
-        self.chatbot = None
         self.history = []
+        self.session = None
+
+
+class CookiesUsage(BaseModel):
+    date: str
+    num_message: int = 0
+    num_conversation: int = 0
+    # 到达今日上限后在这个时间之前不再使用，和使用次数一起保存，重启后仍然有效
+    throttled_until: Optional[datetime] = None
+
+
+class CookiesStatus(BaseModel):
+    state: CookiesState = 'unknown'
+    checked_at: Optional[datetime] = None
+
+
+class FilterData(BaseModel):
+    """保存在filter.json中的名单，频道用{"guild_id": ..., "channel_id": ...}表示"""
+
+    group_whitelist: set[int] = set()
+    group_blacklist: set[int] = set()
+    guild_whitelist: list[dict] = []
+    guild_blacklist: list[dict] = []
+    user_blacklist: set[int] = set()
 
 
 class PluginData(BaseModel):
     cookies_file_path_list: list[Path] = []
-    current_cookies_file_path: Path = Path()
-    is_switching_cookies: bool = False
+
+    # dict[cookies文件名, CookiesUsage] 每个账号当天的使用情况
+    cookies_usage_dict: dict[str, CookiesUsage] = {}
+
+    # dict[cookies文件名, CookiesStatus] 定时检查得到的账号状态
+    cookies_status_dict: dict[str, CookiesStatus] = {}
 
     # dict[user_id, UserData] user_id: UserData
-    user_data_dict: dict[UserInfo, UserData] = {}
+    user_data_dict: ExpiringLRUDict = Field(default_factory=ExpiringLRUDict)
 
     # dict[message_id, user_id] bot回答的问题的message_id: 对应的用户的user_id
-    reply_message_id_dict: dict[int, UserInfo] = {}
+    reply_message_id_dict: ExpiringLRUDict = Field(default_factory=ExpiringLRUDict)
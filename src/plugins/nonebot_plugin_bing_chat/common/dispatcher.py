@@ -0,0 +1,64 @@
+"""预先把命令符号和命令拼接好，用一次查表代替多个matcher和正则匹配
+
+所有消息只经过一个matcher，和命令无关的消息只需要检查第一个字符就能返回
+"""
+from typing import Literal, Iterable, Optional
+
+from nonebot.log import logger
+from nonebot.adapters import Message
+
+RouteName = Literal['chat', 'new_chat', 'history', 'filter', 'continue']
+
+# 规则匹配后写入state的键
+ROUTE_KEY = '_bingchat_route'
+ARG_KEY = '_bingchat_arg'
+
+
+class CommandRouter:
+    def __init__(
+        self,
+        command_start: Iterable[str],
+        command_dict: dict[RouteName, Iterable[str]],
+    ) -> None:
+        # 完整的命令前缀 -> 对应的路由
+        self._prefix_dict: dict[str, RouteName] = {}
+        for route, command_list in command_dict.items():
+            for command in command_list:
+                for start in command_start:
+                    prefix = start + command
+                    if prefix in self._prefix_dict:
+                        logger.warning(f'命令"{prefix}"重复，只会匹配第一个')
+                        continue
+                    self._prefix_dict[prefix] = route
+
+        # 从长到短尝试，保证"chat-new"不会被"chat"抢先匹配
+        self._length_list = sorted({len(i) for i in self._prefix_dict}, reverse=True)
+        # 有空的前缀时任何消息都可能匹配，不能用首字符过滤
+        self._first_char_set: Optional[frozenset[str]] = (
+            None
+            if '' in self._prefix_dict
+            else frozenset(i[0] for i in self._prefix_dict)
+        )
+
+    def match(self, text: str) -> Optional[tuple[RouteName, int]]:
+        """按最长前缀匹配text的开头，返回路由和命令前缀的长度"""
+        if self._first_char_set is not None and (
+            not text or text[0] not in self._first_char_set
+        ):
+            return None
+        for length in self._length_list:
+            if length > len(text):
+                continue
+            if (route := self._prefix_dict.get(text[:length])) is not None:
+                return route, length
+        return None
+
+
+def get_command_arg(message: Message, text: str, prefix_length: int) -> Message:
+    """和nonebot的CommandArg相同：去掉命令前缀和之后的空白，保留其余的消息段"""
+    arg = message.copy()
+    arg.pop(0)
+    if arg_text := text[prefix_length:].lstrip():
+        for segment in reversed(message.__class__(arg_text)):
+            arg.insert(0, segment)
+    return arg
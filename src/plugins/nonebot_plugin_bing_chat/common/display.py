@@ -0,0 +1,52 @@
+from .data_model import DisplayType, DisplayContentType, ResponseContentType
+
+# 每种输出方式下各个内容前面的标题
+_HEADER_DICT: dict[DisplayType, dict[ResponseContentType, str]] = {
+    'text': {
+        'answer': '',
+        'reference': '参考链接：\n',
+        'suggested-question': '猜你想问：\n',
+        'num-max-conversation': '回复数：',
+    },
+    'image': {
+        'answer': '',
+        'reference': '参考链接：\n\n',
+        'suggested-question': '猜你想问：\n\n',
+        'num-max-conversation': '回复数：',
+    },
+}
+
+# 同一条消息中各个内容之间的分隔符
+_SEPARATOR_DICT: dict[DisplayType, str] = {
+    'text': '\n\n',
+    'image': '\n\n---\n\n',
+}
+
+
+class DisplayPart:
+    """输出配置中的一项，预先确定好标题和分隔符，name用作渲染用时指标的标签"""
+
+    __slots__ = ('name', 'display_type', 'header_list', 'separator')
+
+    def __init__(
+        self, display_type: DisplayType, content_type_list: list[ResponseContentType]
+    ) -> None:
+        self.name = f'{display_type}.{"&".join(content_type_list)}'
+        self.display_type = display_type
+        self.header_list: tuple[tuple[ResponseContentType, str], ...] = tuple(
+            (i, _HEADER_DICT[display_type][i]) for i in content_type_list
+        )
+        self.separator = _SEPARATOR_DICT[display_type]
+
+
+def compile_display_plan(
+    display_content_types: list[DisplayContentType], exclude_answer: bool = False
+) -> tuple[DisplayPart, ...]:
+    """把输出配置编译为输出计划，exclude_answer用于流式模式（回答已经分段发送）"""
+    display_part_list: list[DisplayPart] = []
+    for display_type, content_type_list in display_content_types:
+        if exclude_answer:
+            content_type_list = [i for i in content_type_list if i != 'answer']
+        if content_type_list:
+            display_part_list.append(DisplayPart(display_type, content_type_list))
+    return tuple(display_part_list)
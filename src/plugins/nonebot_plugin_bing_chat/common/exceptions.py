@@ -7,16 +7,20 @@ BaseBingChatException
         - BingChatGroupNotInListException
         - BingchatIsWaitingForResponseException
     · BingchatNetworkException
+        - BingchatTimeoutException
         - BingChatResponseException
             + BingChatInvalidSessionException
             + BingChatAccountReachLimitException
             + BingChatConversationReachLimitException
 
 """
+from .metrics import exceptions_total
 
 
 class BaseBingChatException(Exception):
-    pass
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+        exceptions_total.inc(type(self).__name__)
 
 
 class BingChatPermissionDeniedException(BaseBingChatException):
@@ -39,6 +43,10 @@ class BingchatNetworkException(BaseBingChatException):
     pass
 
 
+class BingchatTimeoutException(BingchatNetworkException):
+    pass
+
+
 class BingChatResponseException(BingchatNetworkException):
     pass
 
@@ -0,0 +1,147 @@
+import sys
+import time
+from typing import (
+    Any,
+    TypeVar,
+    Callable,
+    Iterator,
+    Optional,
+    ItemsView,
+    ValuesView,
+    MutableMapping,
+)
+from collections import OrderedDict
+
+TKey = TypeVar('TKey')
+TValue = TypeVar('TValue')
+
+
+class ExpiringLRUDict(MutableMapping[TKey, TValue]):
+    """有容量上限的字典，超出容量时淘汰最久未使用的条目，空闲超过ttl的条目由sweep淘汰
+
+    get_last_time: 从值中读取最后活跃的时间，不提供时使用最后一次读写的时间
+    is_evictable: 返回False的条目不会被淘汰，比如正在进行对话的用户
+    on_evict: 条目被淘汰时调用
+    """
+
+    def __init__(
+        self,
+        max_size: Optional[int] = None,
+        ttl: Optional[float] = None,
+        get_last_time: Optional[Callable[[TValue], float]] = None,
+        is_evictable: Optional[Callable[[TKey, TValue], bool]] = None,
+        on_evict: Optional[Callable[[TKey, TValue], None]] = None,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.get_last_time = get_last_time
+        self.is_evictable = is_evictable
+        self.on_evict = on_evict
+        self.num_evicted = 0
+        self._data: OrderedDict[TKey, TValue] = OrderedDict()
+        self._last_time_dict: dict[TKey, float] = {}
+
+    @classmethod
+    def __get_validators__(cls) -> Iterator[Callable[[Any], 'ExpiringLRUDict']]:
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, v: Any) -> 'ExpiringLRUDict':
+        # 保持原对象，避免pydantic把它当成普通的dict复制
+        if not isinstance(v, cls):
+            raise TypeError('ExpiringLRUDict required')
+        return v
+
+    def __getitem__(self, key: TKey) -> TValue:
+        value = self._data[key]
+        self._touch(key)
+        return value
+
+    def __setitem__(self, key: TKey, value: TValue) -> None:
+        self._data[key] = value
+        self._touch(key)
+        if self.max_size is not None and len(self._data) > self.max_size:
+            self._evict_least_recently_used()
+
+    def __delitem__(self, key: TKey) -> None:
+        del self._data[key]
+        self._last_time_dict.pop(key, None)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._data
+
+    def __iter__(self) -> Iterator[TKey]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    # 遍历时不改变使用顺序
+    def values(self) -> ValuesView[TValue]:
+        return self._data.values()
+
+    def items(self) -> ItemsView[TKey, TValue]:
+        return self._data.items()
+
+    def sweep(self) -> list[tuple[TKey, TValue]]:
+        """淘汰空闲超过ttl的条目，返回被淘汰的条目"""
+        if self.ttl is None:
+            return []
+        deadline = time.time() - self.ttl
+        expired_key_list = [
+            key
+            for key, value in self._data.items()
+            if self._get_last_time(key, value) < deadline
+            and (self.is_evictable is None or self.is_evictable(key, value))
+        ]
+        return [self._evict(key) for key in expired_key_list]
+
+    def _touch(self, key: TKey) -> None:
+        self._data.move_to_end(key)
+        if self.get_last_time is None:
+            self._last_time_dict[key] = time.time()
+
+    def _get_last_time(self, key: TKey, value: TValue) -> float:
+        if self.get_last_time is not None:
+            return self.get_last_time(value)
+        return self._last_time_dict.get(key, 0)
+
+    def _evict_least_recently_used(self) -> None:
+        for key, value in self._data.items():
+            if self.is_evictable is None or self.is_evictable(key, value):
+                self._evict(key)
+                return
+
+    def _evict(self, key: TKey) -> tuple[TKey, TValue]:
+        value = self._data.pop(key)
+        self._last_time_dict.pop(key, None)
+        self.num_evicted += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+        return key, value
+
+
+def get_deep_size(obj: object, seen: Optional[set[int]] = None) -> int:
+    """粗略计算对象及其引用的对象占用的内存字节数"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            get_deep_size(k, seen) + get_deep_size(v, seen) for k, v in obj.items()
+        )
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(get_deep_size(i, seen) for i in obj)
+    else:
+        if hasattr(obj, '__dict__'):
+            size += get_deep_size(vars(obj), seen)
+        # 使用__slots__的对象没有__dict__，属性要沿着MRO逐个读取
+        for cls in type(obj).__mro__:
+            slot_names = cls.__dict__.get('__slots__', ())
+            for name in (slot_names,) if isinstance(slot_names, str) else slot_names:
+                if name not in ('__dict__', '__weakref__') and hasattr(obj, name):
+                    size += get_deep_size(getattr(obj, name), seen)
+    return size
@@ -0,0 +1,130 @@
+import gzip
+import json
+import time
+import shutil
+import asyncio
+from typing import Any, Optional
+from pathlib import Path
+from datetime import date, datetime, timedelta
+
+from nonebot.log import logger
+
+
+class ResponseLogWriter:
+    """在后台把响应值批量写入压缩的JSONL日志，put不会阻塞事件循环
+
+    日志按天分文件夹，每个文件超过大小或时间后切换到新的文件
+    """
+
+    def __init__(
+        self,
+        log_directory: Path,
+        max_queue_size: int,
+        segment_max_size: int,
+        segment_max_age: float,
+    ) -> None:
+        self.log_directory = log_directory
+        self.segment_max_size = segment_max_size
+        self.segment_max_age = segment_max_age
+        self.num_dropped = 0
+        # None通知后台任务写完之前的日志后退出
+        self._queue: asyncio.Queue[Optional[dict[str, Any]]] = asyncio.Queue(
+            max_queue_size
+        )
+        self._task: Optional[asyncio.Task] = None
+        self._segment_file_path: Optional[Path] = None
+        self._segment_start_time = 0.0
+
+    def put(self, data: dict[str, Any]) -> None:
+        """把一条日志放入队列，队列满时丢弃"""
+        try:
+            self._queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.num_dropped += 1
+            if self.num_dropped % 100 == 1:
+                logger.warning(f'日志队列已满，已丢弃{self.num_dropped}条日志')
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """停止后台任务，并写入队列中剩余的日志
+
+        不能直接取消后台任务，取消后线程中的写入还在继续，会和最后一次写入交错在同一个文件中
+        """
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        if batch := self._get_batch():
+            await asyncio.to_thread(self._write_batch, batch)
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            batch.extend(self._get_batch())
+            is_stopping = None in batch
+            if batch := [i for i in batch if i is not None]:
+                try:
+                    await asyncio.to_thread(self._write_batch, batch)
+                except Exception as exc:
+                    logger.error(f'写入{len(batch)}条日志时出错')
+                    logger.error(exc)
+            if is_stopping:
+                return
+
+    def _get_batch(self) -> list[Optional[dict[str, Any]]]:
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    def _write_batch(self, batch: list[Optional[dict[str, Any]]]) -> None:
+        data = ''.join(
+            json.dumps(i, ensure_ascii=False, default=str) + '\n' for i in batch
+        )
+        segment_file_path = self._get_segment_file_path()
+        # 追加写入会生成多段gzip，gzip可以直接读取
+        with gzip.open(segment_file_path, 'at', encoding='utf-8') as f:
+            f.write(data)
+
+    def _get_segment_file_path(self) -> Path:
+        now = datetime.now()
+        if (
+            self._segment_file_path is None
+            or self._segment_file_path.parent.name != now.strftime('%Y-%m-%d')
+            or time.time() - self._segment_start_time > self.segment_max_age
+            or (
+                self._segment_file_path.exists()
+                and self._segment_file_path.stat().st_size > self.segment_max_size
+            )
+        ):
+            current_log_directory = self.log_directory / now.strftime('%Y-%m-%d')
+            current_log_directory.mkdir(parents=True, exist_ok=True)
+            segment_file_path = (
+                current_log_directory / f'{now.strftime("%H-%M-%S")}.jsonl.gz'
+            )
+            index = 1
+            while segment_file_path.exists():
+                segment_file_path = (
+                    current_log_directory
+                    / f'{now.strftime("%H-%M-%S")}-{index}.jsonl.gz'
+                )
+                index += 1
+            self._segment_file_path = segment_file_path
+            self._segment_start_time = time.time()
+        return self._segment_file_path
+
+    def delete_expired(self, retention_days: int) -> int:
+        """删除超过保留天数的日志文件夹，返回删除的数量"""
+        num_deleted = 0
+        for child_dir in self.log_directory.iterdir():
+            try:
+                log_date = date.fromisoformat(child_dir.name)
+            except ValueError:
+                continue
+            if date.today() - log_date >= timedelta(days=retention_days):
+                shutil.rmtree(child_dir)
+                num_deleted += 1
+        return num_deleted
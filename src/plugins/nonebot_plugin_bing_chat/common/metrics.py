@@ -0,0 +1,234 @@
+"""简单的指标统计，以Prometheus的文本格式输出
+
+未启用时所有记录操作都直接返回，gauge只在被抓取时才会计算
+"""
+import math
+import time
+import secrets
+from typing import Any, Callable, Iterator, Optional
+from contextlib import nullcontext, contextmanager
+
+from nonebot import get_driver
+from nonebot.log import logger
+
+LabelValues = tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, math.inf)
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: LabelValues) -> str:
+    if not label_names:
+        return ''
+    pair_list = [
+        '{}="{}"'.format(
+            name,
+            value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'),
+        )
+        for name, value in zip(label_names, label_values)
+    ]
+    return '{' + ','.join(pair_list) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.enabled = False
+        self._metric_list: list['BaseMetric'] = []
+
+    def register(self, metric: 'BaseMetric') -> None:
+        self._metric_list.append(metric)
+
+    def render(self) -> str:
+        line_list: list[str] = []
+        for metric in self._metric_list:
+            line_list.append(f'# HELP {metric.name} {metric.documentation}')
+            line_list.append(f'# TYPE {metric.name} {metric.type}')
+            line_list.extend(metric.collect())
+        return '\n'.join(line_list) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class BaseMetric:
+    type = 'untyped'
+
+    def __init__(
+        self, name: str, documentation: str, label_names: tuple[str, ...] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        registry.register(self)
+
+    def collect(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class Counter(BaseMetric):
+    type = 'counter'
+
+    def __init__(
+        self, name: str, documentation: str, label_names: tuple[str, ...] = ()
+    ) -> None:
+        super().__init__(name, documentation, label_names)
+        self._value_dict: dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, value: float = 1) -> None:
+        if not registry.enabled:
+            return
+        self._value_dict[label_values] = self._value_dict.get(label_values, 0) + value
+
+    def collect(self) -> Iterator[str]:
+        for label_values, value in self._value_dict.items():
+            labels = _format_labels(self.label_names, label_values)
+            yield f'{self.name}{labels} {_format_value(value)}'
+
+
+class Histogram(BaseMetric):
+    type = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = buckets
+        # 每组标签对应各个桶的计数，以及总和
+        self._bucket_count_dict: dict[LabelValues, list[int]] = {}
+        self._sum_dict: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        if not registry.enabled:
+            return
+        if (bucket_count_list := self._bucket_count_dict.get(label_values)) is None:
+            bucket_count_list = self._bucket_count_dict[label_values] = [0] * len(
+                self.buckets
+            )
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                bucket_count_list[i] += 1
+                break
+        self._sum_dict[label_values] = self._sum_dict.get(label_values, 0) + value
+
+    def time(self, *label_values: str) -> Any:
+        """记录with语句块的用时，未启用时返回一个什么都不做的上下文管理器"""
+        if not registry.enabled:
+            return nullcontext()
+        return self._time(label_values)
+
+    @contextmanager
+    def _time(self, label_values: LabelValues) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, *label_values)
+
+    def collect(self) -> Iterator[str]:
+        for label_values, bucket_count_list in self._bucket_count_dict.items():
+            cumulative_count = 0
+            for upper_bound, count in zip(self.buckets, bucket_count_list):
+                cumulative_count += count
+                labels = _format_labels(
+                    self.label_names + ('le',),
+                    label_values + (_format_value(upper_bound),),
+                )
+                yield f'{self.name}_bucket{labels} {cumulative_count}'
+            labels = _format_labels(self.label_names, label_values)
+            yield f'{self.name}_sum{labels} {_format_value(self._sum_dict[label_values])}'
+            yield f'{self.name}_count{labels} {cumulative_count}'
+
+
+class CallbackMetric(BaseMetric):
+    """在被抓取时调用func获取当前值，func返回数值，或者标签到数值的字典"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        func: Callable[[], float | dict[LabelValues, float]],
+        label_names: tuple[str, ...] = (),
+        type: str = 'gauge',
+    ) -> None:
+        super().__init__(name, documentation, label_names)
+        self.type = type
+        self.func = func
+
+    def collect(self) -> Iterator[str]:
+        try:
+            value = self.func()
+        except Exception as exc:
+            logger.warning(f'获取指标{self.name}时出错：{exc}')
+            return
+        value_dict = value if isinstance(value, dict) else {(): value}
+        for label_values, i in value_dict.items():
+            labels = _format_labels(self.label_names, label_values)
+            yield f'{self.name}{labels} {_format_value(i)}'
+
+
+upstream_ask_seconds = Histogram('bingchat_upstream_ask_seconds', '向Bing询问的用时')
+render_seconds = Histogram('bingchat_render_seconds', '把markdown渲染为图片的用时')
+send_seconds = Histogram('bingchat_send_seconds', '发送回答的用时')
+display_part_seconds = Histogram(
+    'bingchat_display_part_seconds', '生成输出配置中每一项的用时', label_names=('part',)
+)
+handler_seconds = Histogram(
+    'bingchat_handler_seconds', '事件处理函数的总用时', label_names=('handler',)
+)
+queue_wait_seconds = Histogram(
+    'bingchat_queue_wait_seconds', '等待并发名额的用时', label_names=('lane',)
+)
+tenant_queued_requests_total = Counter(
+    'bingchat_tenant_queued_requests_total',
+    '各个群组、频道和所有私聊合计等待过并发名额的请求数',
+    label_names=('tenant',),
+)
+tenant_queue_wait_seconds_total = Counter(
+    'bingchat_tenant_queue_wait_seconds_total',
+    '各个群组、频道和所有私聊合计等待并发名额的总用时',
+    label_names=('tenant',),
+)
+exceptions_total = Counter(
+    'bingchat_exceptions_total', '插件内各种异常发生的次数', label_names=('exception',)
+)
+
+
+def register_metrics_route(path: str, token: Optional[str] = None) -> None:
+    """在FastAPI驱动器上注册输出指标的路由，token不为None时请求需要带上Bearer令牌"""
+    driver = get_driver()
+    try:
+        from fastapi import FastAPI, Request
+        from fastapi.responses import PlainTextResponse
+    except ImportError:
+        logger.warning('没有安装FastAPI，无法输出指标')
+        return
+    server_app: Optional[Any] = getattr(driver, 'server_app', None)
+    if not isinstance(server_app, FastAPI):
+        logger.warning('当前驱动器不是FastAPI，无法输出指标')
+        return
+    if token is None and not driver.config.host.is_loopback:
+        logger.warning(
+            f'NoneBot监听在{driver.config.host}，没有设置bingchat_metrics_token时所有人都可以读取指标'
+        )
+
+    @server_app.get(path, include_in_schema=False)
+    async def _(request: Request) -> PlainTextResponse:
+        if token is not None and not secrets.compare_digest(
+            request.headers.get('Authorization', '').encode(),
+            f'Bearer {token}'.encode(),
+        ):
+            return PlainTextResponse('Unauthorized', status_code=401)
+        return PlainTextResponse(
+            registry.render(), media_type='text/plain; version=0.0.4; charset=utf-8'
+        )
+
+    logger.info(f'BingChat的指标在{path}')
@@ -0,0 +1,122 @@
+"""群组、频道和用户的名单，加载时转换为集合，检查时只需要一次哈希查找
+
+插件文件夹中的filter.json存在时会代替配置中的名单，文件被修改后会定时重新加载，
+超级用户用命令修改名单后也会写回这个文件
+"""
+from typing import Any, Optional
+from pathlib import Path
+
+from pydantic import parse_file_as
+from nonebot.log import logger
+
+from .data_model import FilterData, FilterListName
+
+# (guild_id, channel_id)
+GuildKey = tuple[str, str]
+FilterKey = int | GuildKey
+
+
+def _to_guild_key(item: dict[str, Any]) -> GuildKey:
+    return str(item['guild_id']), str(item['channel_id'])
+
+
+def parse_filter_key(name: FilterListName, text: str) -> FilterKey:
+    """把命令中的id转换为名单中的键，频道写作guild_id/channel_id"""
+    if name.startswith('guild'):
+        guild_id, sep, channel_id = text.partition('/')
+        if not sep or not guild_id or not channel_id:
+            raise ValueError('频道的格式是guild_id/channel_id')
+        return guild_id, channel_id
+    return int(text)
+
+
+class PermissionFilter:
+    def __init__(self, file_path: Path, default: FilterData) -> None:
+        self.file_path = file_path
+        self._default = default
+        self._mtime: Optional[float] = None
+
+        self.group_whitelist: set[int] = set()
+        self.group_blacklist: set[int] = set()
+        self.guild_whitelist: set[GuildKey] = set()
+        self.guild_blacklist: set[GuildKey] = set()
+        self.user_blacklist: set[int] = set()
+        self.load()
+
+    def _compile(self, data: FilterData) -> None:
+        # 只替换集合的引用，检查时不会看到更新了一半的名单
+        self.group_whitelist = set(data.group_whitelist)
+        self.group_blacklist = set(data.group_blacklist)
+        self.guild_whitelist = {_to_guild_key(i) for i in data.guild_whitelist}
+        self.guild_blacklist = {_to_guild_key(i) for i in data.guild_blacklist}
+        self.user_blacklist = set(data.user_blacklist)
+
+    def _get_mtime(self) -> Optional[float]:
+        try:
+            return self.file_path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def load(self) -> None:
+        """从文件加载名单，文件不存在时使用配置中的名单，文件有误时保留当前的名单"""
+        self._mtime = self._get_mtime()
+        if self._mtime is None:
+            self._compile(self._default)
+            return
+        try:
+            self._compile(parse_file_as(FilterData, self.file_path))
+        except Exception as exc:
+            logger.error(f'读取名单{self.file_path}时出错，继续使用之前的名单')
+            logger.error(exc)
+
+    def reload_if_modified(self) -> bool:
+        if self._get_mtime() == self._mtime:
+            return False
+        self.load()
+        return True
+
+    def add(self, name: FilterListName, key: FilterKey) -> bool:
+        filter_set: set[Any] = getattr(self, name)
+        if key in filter_set:
+            return False
+        filter_set.add(key)
+        return True
+
+    def remove(self, name: FilterListName, key: FilterKey) -> bool:
+        filter_set: set[Any] = getattr(self, name)
+        if key not in filter_set:
+            return False
+        filter_set.discard(key)
+        return True
+
+    def to_data(self) -> FilterData:
+        return FilterData(
+            group_whitelist=self.group_whitelist,
+            group_blacklist=self.group_blacklist,
+            guild_whitelist=[
+                {'guild_id': i, 'channel_id': j} for i, j in self.guild_whitelist
+            ],
+            guild_blacklist=[
+                {'guild_id': i, 'channel_id': j} for i, j in self.guild_blacklist
+            ],
+            user_blacklist=self.user_blacklist,
+        )
+
+    def dumps(self) -> str:
+        return self.to_data().json(ensure_ascii=False, indent=2)
+
+    def write(self, data: str) -> None:
+        """写入dumps得到的内容，可以在线程中调用"""
+        self.file_path.write_text(data, encoding='utf-8')
+        # 自己写入的修改不需要重新加载
+        self._mtime = self._get_mtime()
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            'group_whitelist': len(self.group_whitelist),
+            'group_blacklist': len(self.group_blacklist),
+            'guild_whitelist': len(self.guild_whitelist),
+            'guild_blacklist': len(self.guild_blacklist),
+            'user_blacklist': len(self.user_blacklist),
+        }
@@ -0,0 +1,66 @@
+"""令牌桶限流，分别限制每个用户、每个群组（频道）和全局的请求频率
+
+用GCRA实现，和令牌桶等价，但每个键只需要保存一个浮点数：令牌桶重新装满的时间，
+已经装满的键和不存在的键没有区别，由sweep删除
+"""
+import math
+import time
+from typing import Hashable, Iterable, Optional
+
+
+class RateLimiter:
+    """每个键最多连续请求limit次，之后每period/limit秒恢复一次，limit为0时不限制"""
+
+    def __init__(self, scope: str, limit: int, period: float) -> None:
+        self.scope = scope
+        self.limit = limit
+        self.period = period
+        self._interval = period / limit if limit > 0 else 0.0
+        # dict[键, 令牌桶重新装满的时间]
+        self._full_time_dict: dict[Hashable, float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit > 0
+
+    def get_wait_time(self, key: Hashable, now: float) -> float:
+        """还需要等待多少秒才有一个令牌"""
+        full_time = self._full_time_dict.get(key, now)
+        return max(0.0, full_time - now - (self.period - self._interval))
+
+    def consume(self, key: Hashable, now: float) -> None:
+        full_time = self._full_time_dict.get(key, now)
+        self._full_time_dict[key] = max(full_time, now) + self._interval
+
+    def sweep(self) -> int:
+        """删除已经装满的令牌桶，返回删除的数量"""
+        now = time.monotonic()
+        full_key_list = [k for k, v in self._full_time_dict.items() if v <= now]
+        for key in full_key_list:
+            del self._full_time_dict[key]
+        return len(full_key_list)
+
+    def __len__(self) -> int:
+        return len(self._full_time_dict)
+
+    @property
+    def description(self) -> str:
+        return f'{self.scope}每{self.period:g}秒最多{self.limit}次'
+
+
+def acquire(
+    item_list: Iterable[tuple[RateLimiter, Hashable]]
+) -> Optional[tuple[RateLimiter, int]]:
+    """所有限制都允许时才一起扣除令牌，否则返回需要等待最久的限制和等待的秒数"""
+    now = time.monotonic()
+    item_list = [(limiter, key) for limiter, key in item_list if limiter.enabled]
+    wait_time, limiter = max(
+        ((limiter.get_wait_time(key, now), limiter) for limiter, key in item_list),
+        key=lambda i: i[0],
+        default=(0.0, None),
+    )
+    if limiter is not None and wait_time > 0:
+        return limiter, math.ceil(wait_time)
+    for limiter, key in item_list:
+        limiter.consume(key, now)
+    return None
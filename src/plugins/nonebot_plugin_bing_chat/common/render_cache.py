@@ -0,0 +1,141 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from typing import Optional
+from pathlib import Path
+from collections import OrderedDict
+
+from nonebot import require
+from nonebot.log import logger
+
+from .metrics import render_seconds
+
+
+class RenderCache:
+    """markdown转图片的缓存，以markdown和渲染参数的哈希为键
+
+    内存中和磁盘上各有一层，都按照总大小淘汰最久未使用的图片，同时限制同时渲染的数量，
+    相同的markdown正在读取或渲染时，后来的请求等待同一个结果
+    """
+
+    def __init__(
+        self,
+        cache_directory: Path,
+        max_memory_size: int,
+        max_disk_size: int,
+        max_concurrency: int,
+        width: int,
+    ) -> None:
+        self.cache_directory = cache_directory
+        self.max_memory_size = max_memory_size
+        self.max_disk_size = max_disk_size
+        self.width = width
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.num_coalesced = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._memory_cache: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_size = 0
+        self._disk_size: Optional[int] = None
+        # 写入磁盘在多个线程中同时进行，磁盘的总大小和淘汰要一个一个来
+        self._disk_lock = threading.Lock()
+        # dict[键, 正在读取或渲染的任务]
+        self._task_dict: dict[str, asyncio.Task[bytes]] = {}
+
+    def get_key(self, md: str) -> str:
+        return hashlib.sha256(f'{self.width}\n{md}'.encode('utf-8')).hexdigest()
+
+    async def render(self, md: str) -> bytes:
+        key = self.get_key(md)
+
+        if (data := self._memory_cache.get(key)) is not None:
+            self.memory_hits += 1
+            self._memory_cache.move_to_end(key)
+            return data
+
+        if (task := self._task_dict.get(key)) is not None:
+            self.num_coalesced += 1
+        else:
+            task = self._task_dict[key] = asyncio.create_task(self._load(key, md))
+            task.add_done_callback(lambda _: self._task_dict.pop(key, None))
+        # shield防止一个请求被取消时连带取消其他请求正在等待的渲染
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str, md: str) -> bytes:
+        if (data := await asyncio.to_thread(self._read_disk, key)) is not None:
+            self.disk_hits += 1
+            self._put_memory(key, data)
+            return data
+
+        self.misses += 1
+        async with self._semaphore:
+            # 第一次渲染时才加载htmlrender，浏览器也在这时才启动
+            md_to_pic = require('nonebot_plugin_htmlrender').md_to_pic
+
+            start_time = time.perf_counter()
+            data = await md_to_pic(md, width=self.width)
+            elapsed = time.perf_counter() - start_time
+            render_seconds.observe(elapsed)
+            logger.debug(f'渲染markdown用时{elapsed:.2f}s')
+
+        self._put_memory(key, data)
+        await asyncio.to_thread(self._write_disk, key, data)
+        return data
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_memory_size:
+            return
+        if (old_data := self._memory_cache.pop(key, None)) is not None:
+            self._memory_size -= len(old_data)
+        self._memory_cache[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.max_memory_size:
+            _, evicted_data = self._memory_cache.popitem(last=False)
+            self._memory_size -= len(evicted_data)
+
+    def _get_file_path(self, key: str) -> Path:
+        return self.cache_directory / f'{key}.png'
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        file_path = self._get_file_path(key)
+        try:
+            data = file_path.read_bytes()
+            # 用修改时间记录最后使用的时间
+            os.utime(file_path)
+        except FileNotFoundError:
+            # 刚刚被其他线程淘汰
+            return None
+        return data
+
+    def _write_disk(self, key: str, data: bytes) -> None:
+        with self._disk_lock:
+            self.cache_directory.mkdir(parents=True, exist_ok=True)
+            if self._disk_size is None:
+                self._disk_size = sum(
+                    i.stat().st_size for i in self.cache_directory.glob('*.png')
+                )
+            file_path = self._get_file_path(key)
+            # 覆盖已有的文件时先减去旧文件的大小
+            try:
+                self._disk_size -= file_path.stat().st_size
+            except FileNotFoundError:
+                pass
+            file_path.write_bytes(data)
+            self._disk_size += len(data)
+            if self._disk_size > self.max_disk_size:
+                self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """调用前需要拿到_disk_lock"""
+        file_path_list = sorted(
+            self.cache_directory.glob('*.png'), key=lambda i: i.stat().st_mtime
+        )
+        self._disk_size = sum(i.stat().st_size for i in file_path_list)
+        for file_path in file_path_list:
+            if self._disk_size <= self.max_disk_size * 0.9:
+                break
+            self._disk_size -= file_path.stat().st_size
+            file_path.unlink(missing_ok=True)
@@ -0,0 +1,201 @@
+import time
+import heapq
+import asyncio
+import itertools
+
+from .metrics import (
+    queue_wait_seconds,
+    tenant_queued_requests_total,
+    tenant_queue_wait_seconds_total,
+)
+from .data_model import UserInfo
+from .exceptions import BingchatIsWaitingForResponseException
+
+PRIORITY_LANE = 0
+NORMAL_LANE = 1
+_LANE_NAME_LIST = ['priority', 'normal']
+PRIVATE_TENANT_PREFIX = 'private:'
+
+
+def get_tenant_label(tenant: str) -> str:
+    """指标中的租户标签，每个私聊各自是一个租户，但在指标中合并，避免标签数随用户数增长"""
+    return 'private' if tenant.startswith(PRIVATE_TENANT_PREFIX) else tenant
+
+
+class RequestQueue:
+    """每个用户一个有界的先进先出队列，所有用户共享一个全局并发上限
+
+    并发名额按开始时间公平排队分配给各个租户（群组、频道或私聊）：每个请求的虚拟开始时间
+    是当前虚拟时间和该租户上一个请求的虚拟完成时间中较大的一个，完成时间再往后1/weight，
+    有空闲名额时先放行虚拟开始时间最小的请求，所以一个群组刷屏只会让它自己排得更久；
+    优先通道中的请求总是先于普通通道放行
+
+    队列满时抛出BingchatIsWaitingForResponseException，而不是无限制地排队
+    """
+
+    def __init__(
+        self, max_concurrency: int, max_user_queue_size: int, max_queue_size: int
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_user_queue_size = max_user_queue_size
+        self.max_queue_size = max_queue_size
+        # 正在等待和正在进行的请求数
+        self._num_pending = 0
+        self._num_running = 0
+        self._user_num_pending_dict: dict[UserInfo, int] = {}
+        self._user_lock_dict: dict[UserInfo, asyncio.Lock] = {}
+        # 占着并发名额的用户，每个用户同时只有一个请求在进行
+        self._running_user_set: set[UserInfo] = set()
+        # (通道, 虚拟开始时间, 序号, future)
+        self._waiter_heap: list[tuple[int, float, int, asyncio.Future[None]]] = []
+        self._counter = itertools.count()
+        # 每个通道的虚拟时间，等于最近放行的请求的虚拟开始时间
+        self._virtual_time_list = [0.0, 0.0]
+        # dict[(通道, 租户), 该租户最后一个请求的虚拟完成时间]
+        self._finish_time_dict: dict[tuple[int, str], float] = {}
+        self._tenant_num_waiting_dict: dict[str, int] = {}
+
+    @property
+    def num_pending(self) -> int:
+        return self._num_pending
+
+    @property
+    def num_active_users(self) -> int:
+        return len(self._user_num_pending_dict)
+
+    @property
+    def tenant_num_waiting_dict(self) -> dict[str, int]:
+        """每个租户标签正在等待并发名额的请求数，所有私聊合并为一个标签"""
+        return self._tenant_num_waiting_dict
+
+    def get_user_num_pending(self, user_info: UserInfo) -> int:
+        return self._user_num_pending_dict.get(user_info, 0)
+
+    async def acquire(
+        self,
+        user_info: UserInfo,
+        tenant: str = '',
+        weight: float = 1,
+        priority: bool = False,
+    ) -> None:
+        """排队直到轮到该用户，且按加权公平排队轮到该租户"""
+        await self.acquire_user(user_info)
+        try:
+            await self.acquire_slot(user_info, tenant, weight, priority)
+        except BaseException:
+            self.release(user_info)
+            raise
+
+    async def acquire_user(self, user_info: UserInfo) -> None:
+        """排队直到轮到该用户，之后还需要acquire_slot拿到并发名额，中间可以等待其他进程的用户锁"""
+        if self.get_user_num_pending(user_info) > self.max_user_queue_size:
+            raise BingchatIsWaitingForResponseException('您排队中的对话太多了，请先等待之前的回应')
+        if self._num_pending >= self.max_concurrency + self.max_queue_size:
+            raise BingchatIsWaitingForResponseException('当前请求的人太多了，队列已满，请稍后再试')
+
+        self._num_pending += 1
+        self._user_num_pending_dict[user_info] = (
+            self.get_user_num_pending(user_info) + 1
+        )
+        user_lock = self._user_lock_dict.setdefault(user_info, asyncio.Lock())
+        try:
+            await user_lock.acquire()
+        except BaseException:
+            self._leave(user_info)
+            raise
+
+    async def acquire_slot(
+        self,
+        user_info: UserInfo,
+        tenant: str = '',
+        weight: float = 1,
+        priority: bool = False,
+    ) -> None:
+        """按加权公平排队轮到该租户，之后无论成功与否都要调用release"""
+        await self._acquire_slot(
+            tenant, weight, PRIORITY_LANE if priority else NORMAL_LANE
+        )
+        self._running_user_set.add(user_info)
+
+    def release_slot(self, user_info: UserInfo) -> None:
+        """询问结束后调用，提前把并发名额让给其他用户，该用户的队列要等release才放行"""
+        if user_info not in self._running_user_set:
+            return
+        self._running_user_set.remove(user_info)
+        self._num_running -= 1
+        self._dispatch()
+
+    def release(self, user_info: UserInfo) -> None:
+        self.release_slot(user_info)
+        self._user_lock_dict[user_info].release()
+        self._leave(user_info)
+
+    def sweep(self) -> int:
+        """删除已经追上虚拟时间的租户，它们和没有出现过的租户没有区别，返回删除的数量"""
+        if not self._waiter_heap:
+            # 没有请求在等待时所有租户都是平等的
+            num_idle = len(self._finish_time_dict)
+            self._finish_time_dict.clear()
+            return num_idle
+        idle_key_list = [
+            key
+            for key, finish_time in self._finish_time_dict.items()
+            if finish_time <= self._virtual_time_list[key[0]]
+        ]
+        for key in idle_key_list:
+            del self._finish_time_dict[key]
+        return len(idle_key_list)
+
+    async def _acquire_slot(self, tenant: str, weight: float, lane: int) -> None:
+        key = (lane, tenant)
+        start_time = max(
+            self._virtual_time_list[lane], self._finish_time_dict.get(key, 0.0)
+        )
+        self._finish_time_dict[key] = start_time + 1 / weight
+
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._waiter_heap, (lane, start_time, next(self._counter), future)
+        )
+        tenant_label = get_tenant_label(tenant)
+        self._tenant_num_waiting_dict[tenant_label] = (
+            self._tenant_num_waiting_dict.get(tenant_label, 0) + 1
+        )
+        enqueue_time = time.monotonic()
+        try:
+            self._dispatch()
+            await future
+        except BaseException:
+            # 已经分到名额但同时被取消，把名额让给下一个请求
+            if future.done() and not future.cancelled():
+                self._num_running -= 1
+                self._dispatch()
+            raise
+        finally:
+            self._tenant_num_waiting_dict[tenant_label] -= 1
+            if not self._tenant_num_waiting_dict[tenant_label]:
+                del self._tenant_num_waiting_dict[tenant_label]
+
+        wait_time = time.monotonic() - enqueue_time
+        queue_wait_seconds.observe(wait_time, _LANE_NAME_LIST[lane])
+        tenant_queued_requests_total.inc(tenant_label)
+        tenant_queue_wait_seconds_total.inc(tenant_label, value=wait_time)
+
+    def _dispatch(self) -> None:
+        while self._num_running < self.max_concurrency and self._waiter_heap:
+            lane, start_time, _, future = heapq.heappop(self._waiter_heap)
+            # 等待时被取消的请求
+            if future.done():
+                continue
+            self._virtual_time_list[lane] = max(
+                self._virtual_time_list[lane], start_time
+            )
+            self._num_running += 1
+            future.set_result(None)
+
+    def _leave(self, user_info: UserInfo) -> None:
+        self._num_pending -= 1
+        self._user_num_pending_dict[user_info] -= 1
+        if not self._user_num_pending_dict[user_info]:
+            del self._user_num_pending_dict[user_info]
+            del self._user_lock_dict[user_info]
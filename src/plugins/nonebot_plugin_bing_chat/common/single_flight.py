@@ -0,0 +1,50 @@
+import asyncio
+from typing import Optional
+
+from .data_model import BingChatResponse
+
+
+class SingleFlight:
+    """相同的问题同时只向Bing请求一次，其余的请求等待并共用同一个回答"""
+
+    def __init__(self, timeout: Optional[float] = None) -> None:
+        self.timeout = timeout
+        self.num_leaders = 0
+        self.num_coalesced = 0
+        self._future_dict: dict[str, asyncio.Future[Optional[BingChatResponse]]] = {}
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            'in_flight': len(self._future_dict),
+            'leaders': self.num_leaders,
+            'coalesced': self.num_coalesced,
+        }
+
+    def start(self, key: str) -> bool:
+        """开始请求，如果相同的问题已经在请求中则返回False"""
+        if key in self._future_dict:
+            return False
+        self._future_dict[key] = asyncio.get_running_loop().create_future()
+        self.num_leaders += 1
+        return True
+
+    async def wait(self, key: str) -> Optional[BingChatResponse]:
+        """等待正在进行的相同请求的回答，没有相同的请求、请求失败或者等待超时时返回None"""
+        if (future := self._future_dict.get(key)) is None:
+            return None
+        self.num_coalesced += 1
+        # shield防止等待者被取消或者超时时连带取消其他等待者
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def resolve(self, key: Optional[str], response: BingChatResponse) -> None:
+        if key is not None and (future := self._future_dict.pop(key, None)):
+            future.set_result(response)
+
+    def discard(self, key: Optional[str]) -> None:
+        """请求失败或者结束时调用，还在等待的请求会得到None，然后自行询问"""
+        if key is not None and (future := self._future_dict.pop(key, None)):
+            future.set_result(None)
@@ -0,0 +1,505 @@
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+from pathlib import Path
+from datetime import datetime
+from collections import defaultdict
+
+from nonebot.log import logger
+
+from .data_model import UserData, UserInfo, CookiesUsage
+from .exceptions import BingchatIsWaitingForResponseException
+
+
+class BaseStorage(ABC):
+    """用户数据和消息id的持久化存储
+
+    save_*只会把数据放进待写入的队列，由flush在后台批量写入，不会让消息处理等待磁盘
+
+    用户数据中带有Bing的会话信息，重启后或者在其他进程中连接池没有该用户的Chatbot时，
+    用它恢复Chatbot继续同一个对话
+
+    shared为True时多个进程共用同一个存储，需要通过存储汇总账号的使用次数，
+    并用acquire_user_lock让同一个用户的对话在所有进程之间排队
+    """
+
+    shared = False
+
+    @abstractmethod
+    async def load_user_data(self, user_info: UserInfo) -> Optional[UserData]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def load_reply_user_info(self, message_id: int) -> Optional[UserInfo]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_user_data(self, user_info: UserInfo, user_data: UserData) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_reply_message_id(self, message_id: int, user_info: UserInfo) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def flush(self) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def purge(self, user_data_ttl: float, reply_message_id_ttl: float) -> None:
+        """删除过期的数据"""
+        raise NotImplementedError
+
+    def add_cookies_usage(
+        self, cookies_name: str, date: str, num_message: int, num_conversation: int
+    ) -> None:
+        """记录账号使用次数的增量，不共用时本进程的记录就是全部"""
+
+    def set_cookies_throttled(
+        self, cookies_name: str, date: str, throttled_until: datetime
+    ) -> None:
+        """记录账号到达今日上限，不共用时cookies_usage.json中的记录就是全部"""
+
+    async def load_cookies_usage(self, date: str) -> dict[str, CookiesUsage]:
+        """读取所有进程汇总的账号使用次数和限制期"""
+        return {}
+
+    async def acquire_user_lock(self, user_info: UserInfo) -> Optional[str]:
+        """返回释放锁时需要的令牌，不共用时进程内的RequestQueue已经让同一个用户的对话排队"""
+        return None
+
+    async def release_user_lock(
+        self, user_info: UserInfo, token: Optional[str]
+    ) -> None:
+        """令牌不匹配时什么都不做，可以重复调用"""
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryStorage(BaseStorage):
+    """不持久化，所有数据只保存在PluginData中"""
+
+    async def load_user_data(self, user_info: UserInfo) -> Optional[UserData]:
+        return None
+
+    async def load_reply_user_info(self, message_id: int) -> Optional[UserInfo]:
+        return None
+
+    def save_user_data(self, user_info: UserInfo, user_data: UserData) -> None:
+        pass
+
+    def save_reply_message_id(self, message_id: int, user_info: UserInfo) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+    async def purge(self, user_data_ttl: float, reply_message_id_ttl: float) -> None:
+        pass
+
+
+class SQLiteStorage(BaseStorage):
+    """保存在本地SQLite数据库中，所有数据库操作都在线程中进行"""
+
+    def __init__(self, database_file_path: Path) -> None:
+        self._connection = sqlite3.connect(database_file_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS user_data ('
+            'platform TEXT NOT NULL, user_id INTEGER NOT NULL, '
+            'last_time REAL NOT NULL, data TEXT NOT NULL, '
+            'PRIMARY KEY (platform, user_id))'
+        )
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS reply_message_id ('
+            'message_id INTEGER PRIMARY KEY, platform TEXT NOT NULL, '
+            'user_id INTEGER NOT NULL, created_time REAL NOT NULL)'
+        )
+        self._connection.commit()
+        # sqlite3的连接不能同时在多个线程中使用
+        self._connection_lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+
+        self._dirty_user_data_dict: dict[UserInfo, UserData] = {}
+        self._flushing_user_data_dict: dict[UserInfo, UserData] = {}
+        self._dirty_reply_message_id_list: list[tuple[int, str, int, float]] = []
+
+    async def load_user_data(self, user_info: UserInfo) -> Optional[UserData]:
+        if user_data := self._dirty_user_data_dict.get(
+            user_info
+        ) or self._flushing_user_data_dict.get(user_info):
+            return user_data
+        row = await asyncio.to_thread(
+            self._fetch_one,
+            'SELECT data FROM user_data WHERE platform = ? AND user_id = ?',
+            (user_info.platform, user_info.user_id),
+        )
+        if row is None:
+            return None
+        try:
+            return UserData.parse_raw(row[0])
+        except Exception as exc:
+            logger.error(f'读取用户{user_info}的数据时出错')
+            logger.error(exc)
+            return None
+
+    async def load_reply_user_info(self, message_id: int) -> Optional[UserInfo]:
+        row = await asyncio.to_thread(
+            self._fetch_one,
+            'SELECT platform, user_id FROM reply_message_id WHERE message_id = ?',
+            (message_id,),
+        )
+        if row is None:
+            return None
+        return UserInfo(platform=row[0], user_id=row[1])
+
+    def save_user_data(self, user_info: UserInfo, user_data: UserData) -> None:
+        self._dirty_user_data_dict[user_info] = user_data
+
+    def save_reply_message_id(self, message_id: int, user_info: UserInfo) -> None:
+        self._dirty_reply_message_id_list.append(
+            (message_id, user_info.platform, user_info.user_id, time.time())
+        )
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._dirty_user_data_dict and not self._dirty_reply_message_id_list:
+                return
+            dirty_user_data_dict = self._dirty_user_data_dict
+            dirty_reply_message_id_list = self._dirty_reply_message_id_list
+            self._flushing_user_data_dict = dirty_user_data_dict
+            self._dirty_user_data_dict = {}
+            self._dirty_reply_message_id_list = []
+
+            user_data_row_list = [
+                (
+                    user_info.platform,
+                    user_info.user_id,
+                    user_data.last_time,
+                    user_data.json(),
+                )
+                for user_info, user_data in dirty_user_data_dict.items()
+            ]
+            try:
+                await asyncio.to_thread(
+                    self._write, user_data_row_list, dirty_reply_message_id_list
+                )
+            except Exception:
+                # 写入失败时放回队列，下次再试
+                for user_info, user_data in dirty_user_data_dict.items():
+                    self._dirty_user_data_dict.setdefault(user_info, user_data)
+                self._dirty_reply_message_id_list[:0] = dirty_reply_message_id_list
+                raise
+            finally:
+                self._flushing_user_data_dict = {}
+
+    async def purge(self, user_data_ttl: float, reply_message_id_ttl: float) -> None:
+        await asyncio.to_thread(
+            self._execute_many,
+            [
+                (
+                    'DELETE FROM user_data WHERE last_time < ?',
+                    (time.time() - user_data_ttl,),
+                ),
+                (
+                    'DELETE FROM reply_message_id WHERE created_time < ?',
+                    (time.time() - reply_message_id_ttl,),
+                ),
+            ],
+        )
+
+    def _fetch_one(self, sql: str, parameters: tuple) -> Optional[tuple]:
+        with self._connection_lock:
+            return self._connection.execute(sql, parameters).fetchone()
+
+    def _execute_many(self, statement_list: list[tuple[str, tuple]]) -> None:
+        with self._connection_lock, self._connection:
+            for sql, parameters in statement_list:
+                self._connection.execute(sql, parameters)
+
+    def _write(
+        self,
+        user_data_row_list: list[tuple[str, int, float, str]],
+        reply_message_id_row_list: list[tuple[int, str, int, float]],
+    ) -> None:
+        with self._connection_lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO user_data VALUES (?, ?, ?, ?)',
+                user_data_row_list,
+            )
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO reply_message_id VALUES (?, ?, ?, ?)',
+                reply_message_id_row_list,
+            )
+
+
+class RedisStorage(BaseStorage):
+    """保存在Redis中，多个进程可以共用同一份对话数据、消息id、账号使用次数和用户锁
+
+    数据的过期交给Redis的过期时间，写入会在下一次事件循环中合并成一个pipeline立即发送
+    """
+
+    shared = True
+
+    def __init__(
+        self,
+        url: str,
+        prefix: str,
+        user_data_ttl: float,
+        reply_message_id_ttl: float,
+        lock_timeout: float,
+        client: Optional[Any] = None,
+    ) -> None:
+        if client is None:
+            try:
+                from redis.asyncio import Redis
+            except ImportError as exc:
+                raise RuntimeError(
+                    '请使用 pip install nonebot-plugin-bing-chat[redis] 安装Redis的依赖'
+                ) from exc
+            client = Redis.from_url(url)
+        self._client = client
+        self.prefix = prefix
+        self.user_data_ttl = user_data_ttl
+        self.reply_message_id_ttl = reply_message_id_ttl
+        self.lock_timeout = lock_timeout
+
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task[None]] = None
+        # dict[锁的token, 续期任务]
+        self._lock_refresh_task_dict: dict[str, asyncio.Task[None]] = {}
+        self._dirty_user_data_dict: dict[UserInfo, UserData] = {}
+        self._flushing_user_data_dict: dict[UserInfo, UserData] = {}
+        self._dirty_reply_message_id_list: list[tuple[int, UserInfo]] = []
+        # dict[(日期, 账号), [消息数, 对话数]]
+        self._dirty_cookies_usage_dict: defaultdict[
+            tuple[str, str], list[int]
+        ] = defaultdict(lambda: [0, 0])
+        # dict[(日期, 账号), 限制期的结束时间]
+        self._dirty_cookies_throttled_dict: dict[tuple[str, str], datetime] = {}
+
+    def _user_data_key(self, user_info: UserInfo) -> str:
+        return f'{self.prefix}:user_data:{user_info.platform}:{user_info.user_id}'
+
+    def _reply_message_id_key(self, message_id: int) -> str:
+        return f'{self.prefix}:reply_message_id:{message_id}'
+
+    def _cookies_usage_key(self, date: str) -> str:
+        return f'{self.prefix}:cookies_usage:{date}'
+
+    def _user_lock_key(self, user_info: UserInfo) -> str:
+        return f'{self.prefix}:user_lock:{user_info.platform}:{user_info.user_id}'
+
+    async def load_user_data(self, user_info: UserInfo) -> Optional[UserData]:
+        if user_data := self._dirty_user_data_dict.get(
+            user_info
+        ) or self._flushing_user_data_dict.get(user_info):
+            return user_data
+        if (data := await self._client.get(self._user_data_key(user_info))) is None:
+            return None
+        try:
+            return UserData.parse_raw(data)
+        except Exception as exc:
+            logger.error(f'读取用户{user_info}的数据时出错')
+            logger.error(exc)
+            return None
+
+    async def load_reply_user_info(self, message_id: int) -> Optional[UserInfo]:
+        data = await self._client.get(self._reply_message_id_key(message_id))
+        if data is None:
+            return None
+        platform, _, user_id = data.decode().rpartition(':')
+        return UserInfo(platform=platform, user_id=int(user_id))
+
+    def save_user_data(self, user_info: UserInfo, user_data: UserData) -> None:
+        self._dirty_user_data_dict[user_info] = user_data
+        self._schedule_flush()
+
+    def save_reply_message_id(self, message_id: int, user_info: UserInfo) -> None:
+        self._dirty_reply_message_id_list.append((message_id, user_info))
+        self._schedule_flush()
+
+    def add_cookies_usage(
+        self, cookies_name: str, date: str, num_message: int, num_conversation: int
+    ) -> None:
+        usage = self._dirty_cookies_usage_dict[(date, cookies_name)]
+        usage[0] += num_message
+        usage[1] += num_conversation
+        self._schedule_flush()
+
+    def set_cookies_throttled(
+        self, cookies_name: str, date: str, throttled_until: datetime
+    ) -> None:
+        self._dirty_cookies_throttled_dict[(date, cookies_name)] = throttled_until
+        self._schedule_flush()
+
+    async def load_cookies_usage(self, date: str) -> dict[str, CookiesUsage]:
+        data = await self._client.hgetall(self._cookies_usage_key(date))
+        usage_dict: dict[str, CookiesUsage] = {}
+        for field, value in data.items():
+            cookies_name, _, name = field.decode().rpartition(':')
+            usage = usage_dict.setdefault(cookies_name, CookiesUsage(date=date))
+            match name:
+                case 'throttled_until':
+                    usage.throttled_until = datetime.fromtimestamp(float(value))
+                case _:
+                    setattr(usage, name, int(value))
+        return usage_dict
+
+    async def acquire_user_lock(self, user_info: UserInfo) -> Optional[str]:
+        token = uuid.uuid4().hex
+        key = self._user_lock_key(user_info)
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.05
+        # 锁的过期时间和等待上限相同，持有锁的进程意外退出后其他进程最多等待一轮
+        while not await self._client.set(
+            key, token, nx=True, px=int(self.lock_timeout * 1000)
+        ):
+            if time.monotonic() >= deadline:
+                raise BingchatIsWaitingForResponseException('您之前的对话还在处理中，请稍后再试')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1)
+        # 连接和回答加起来可能超过过期时间，持有锁期间定期续期
+        self._lock_refresh_task_dict[token] = asyncio.create_task(
+            self._refresh_user_lock(key, token)
+        )
+        return token
+
+    async def _refresh_user_lock(self, key: str, token: str) -> None:
+        from redis.exceptions import WatchError
+
+        while True:
+            await asyncio.sleep(self.lock_timeout / 3)
+            try:
+                async with self._client.pipeline(transaction=True) as pipe:
+                    await pipe.watch(key)
+                    if await pipe.get(key) != token.encode():
+                        logger.warning(f'用户锁 {key} 已经过期并被其他进程拿走')
+                        return
+                    pipe.multi()
+                    pipe.pexpire(key, int(self.lock_timeout * 1000))
+                    await pipe.execute()
+            except WatchError:
+                return
+            except Exception as exc:
+                # 网络波动时等下一轮再续期
+                logger.warning(f'续期用户锁 {key} 失败：{exc!r}')
+
+    async def release_user_lock(
+        self, user_info: UserInfo, token: Optional[str]
+    ) -> None:
+        if token is None:
+            return
+        if (refresh_task := self._lock_refresh_task_dict.pop(token, None)) is not None:
+            refresh_task.cancel()
+        # 先写入这一轮的数据，下一个拿到锁的进程才能读到
+        await self.flush()
+        from redis.exceptions import WatchError
+
+        key = self._user_lock_key(user_info)
+        async with self._client.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if await pipe.get(key) != token.encode():
+                    return
+                pipe.multi()
+                pipe.delete(key)
+                await pipe.execute()
+            except WatchError:
+                # 锁已经过期并被其他进程拿走
+                pass
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self) -> None:
+        try:
+            await self.flush()
+        except Exception as exc:
+            # 写入失败的数据已经放回队列，由定时的flush重试
+            logger.error(f'写入Redis时出错：{exc}')
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not (
+                self._dirty_user_data_dict
+                or self._dirty_reply_message_id_list
+                or self._dirty_cookies_usage_dict
+                or self._dirty_cookies_throttled_dict
+            ):
+                return
+            dirty_user_data_dict = self._dirty_user_data_dict
+            dirty_reply_message_id_list = self._dirty_reply_message_id_list
+            dirty_cookies_usage_dict = self._dirty_cookies_usage_dict
+            dirty_cookies_throttled_dict = self._dirty_cookies_throttled_dict
+            self._flushing_user_data_dict = dirty_user_data_dict
+            self._dirty_user_data_dict = {}
+            self._dirty_reply_message_id_list = []
+            self._dirty_cookies_usage_dict = defaultdict(lambda: [0, 0])
+            self._dirty_cookies_throttled_dict = {}
+
+            pipe = self._client.pipeline(transaction=False)
+            for user_info, user_data in dirty_user_data_dict.items():
+                pipe.set(
+                    self._user_data_key(user_info),
+                    user_data.json(),
+                    ex=int(self.user_data_ttl),
+                )
+            for message_id, user_info in dirty_reply_message_id_list:
+                pipe.set(
+                    self._reply_message_id_key(message_id),
+                    f'{user_info.platform}:{user_info.user_id}',
+                    ex=int(self.reply_message_id_ttl),
+                )
+            for (date, cookies_name), (
+                num_message,
+                num_conversation,
+            ) in dirty_cookies_usage_dict.items():
+                key = self._cookies_usage_key(date)
+                pipe.hincrby(key, f'{cookies_name}:num_message', num_message)
+                pipe.hincrby(key, f'{cookies_name}:num_conversation', num_conversation)
+                pipe.expire(key, 2 * 24 * 3600)
+            for (
+                date,
+                cookies_name,
+            ), throttled_until in dirty_cookies_throttled_dict.items():
+                key = self._cookies_usage_key(date)
+                pipe.hset(
+                    key, f'{cookies_name}:throttled_until', throttled_until.timestamp()
+                )
+                pipe.expire(key, 2 * 24 * 3600)
+            try:
+                await pipe.execute()
+            except Exception:
+                # 写入失败时放回队列，下次再试
+                for user_info, user_data in dirty_user_data_dict.items():
+                    self._dirty_user_data_dict.setdefault(user_info, user_data)
+                self._dirty_reply_message_id_list[:0] = dirty_reply_message_id_list
+                for key, (
+                    num_message,
+                    num_conversation,
+                ) in dirty_cookies_usage_dict.items():
+                    self._dirty_cookies_usage_dict[key][0] += num_message
+                    self._dirty_cookies_usage_dict[key][1] += num_conversation
+                for key, throttled_until in dirty_cookies_throttled_dict.items():
+                    self._dirty_cookies_throttled_dict.setdefault(key, throttled_until)
+                raise
+            finally:
+                self._flushing_user_data_dict = {}
+
+    async def purge(self, user_data_ttl: float, reply_message_id_ttl: float) -> None:
+        """Redis会自动删除过期的键"""
+
+    async def close(self) -> None:
+        for refresh_task in self._lock_refresh_task_dict.values():
+            refresh_task.cancel()
+        self._lock_refresh_task_dict.clear()
+        await self.flush()
+        await self._client.aclose()
@@ -0,0 +1,54 @@
+import re
+import time
+
+from .data_model import remove_quote_str
+
+# 段落或句子的结尾，流式输出只会在这些位置切分
+_CHUNK_BOUNDARY_PATTERN = re.compile(r'\n\n|[。！？；!?;]|\.(?=\s)')
+
+
+class StreamChunker:
+    """把流式返回的累积文本切分为句子或段落大小的片段"""
+
+    def __init__(self, min_chunk_size: int, flush_interval: float) -> None:
+        self.min_chunk_size = min_chunk_size
+        self.flush_interval = flush_interval
+        self.sent_length = 0
+        self.num_chunks = 0
+        self.last_flush_time = time.monotonic()
+
+    def feed(self, text: str) -> str:
+        """传入当前累积的全部文本，返回可以发送的片段，没有则返回空字符串"""
+        pending = text[self.sent_length :]
+        if len(pending) < self.min_chunk_size:
+            return ''
+        if time.monotonic() - self.last_flush_time < self.flush_interval:
+            return ''
+
+        boundary_list = list(_CHUNK_BOUNDARY_PATTERN.finditer(pending))
+        if not boundary_list:
+            return ''
+
+        cut = boundary_list[-1].end()
+        self.sent_length += cut
+        self.last_flush_time = time.monotonic()
+        return self._make_chunk(pending[:cut])
+
+    def flush(self, text: str, answer: str) -> str:
+        """按检查后的回答返回剩余所有未发送的部分，text为流式返回的累积文本
+
+        累积文本的开头可能有正在搜索之类不属于回答的行，去掉这些行后已发送的部分应当是回答的开头
+        """
+        sent_length, self.sent_length = self.sent_length, len(text)
+        if not (sent := remove_quote_str(text[:sent_length])):
+            return self._make_chunk(answer)
+        for start in (0, *(i.end() for i in re.finditer('\n', sent))):
+            if start < len(sent) and answer.startswith(sent[start:]):
+                return self._make_chunk(answer[len(sent) - start :])
+        # 对不上时只能按累积文本发送
+        return self._make_chunk(text[sent_length:])
+
+    def _make_chunk(self, text: str) -> str:
+        if chunk := remove_quote_str(text).strip():
+            self.num_chunks += 1
+        return chunk
@@ -0,0 +1,153 @@
+"""记录一次对话在各个阶段的用时，超过阈值时写入慢请求记录
+
+处理函数开始时创建RequestTrace并放入contextvar，之后在每个阶段开始时调用enter_stage，
+自动刷新对话等递归调用会沿用同一个RequestTrace和请求id
+"""
+import json
+import time
+import uuid
+import asyncio
+import functools
+from typing import Any, TypeVar, Callable, Optional, Awaitable
+from datetime import datetime
+from contextvars import ContextVar
+
+from nonebot.log import logger
+
+from . import plugin_config
+
+TReturn = TypeVar('TReturn')
+
+
+class RequestTrace:
+    __slots__ = (
+        'request_id',
+        'user_id',
+        'handler',
+        'start_time',
+        'depth',
+        'stage_list',
+        '_stage_name',
+        '_stage_depth',
+        '_stage_start_time',
+    )
+
+    def __init__(self, user_id: int, handler: str) -> None:
+        self.request_id = uuid.uuid4().hex[:12]
+        self.user_id = user_id
+        self.handler = handler
+        self.start_time = time.perf_counter()
+        self.depth = 0
+        # (阶段名称, 递归深度, 用时)
+        self.stage_list: list[tuple[str, int, float]] = []
+        self._stage_name: Optional[str] = None
+        self._stage_depth = 0
+        self._stage_start_time = self.start_time
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def enter_stage(self, name: str) -> None:
+        """结束当前阶段并开始新的阶段"""
+        self.end_stage()
+        self._stage_name = name
+        self._stage_depth = self.depth
+        self._stage_start_time = time.perf_counter()
+
+    def end_stage(self) -> None:
+        if self._stage_name is None:
+            return
+        self.stage_list.append(
+            (
+                self._stage_name,
+                self._stage_depth,
+                time.perf_counter() - self._stage_start_time,
+            )
+        )
+        self._stage_name = None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'time': datetime.now(),
+            'request_id': self.request_id,
+            'user_id': self.user_id,
+            'handler': self.handler,
+            'elapsed': round(self.elapsed, 3),
+            'stages': [
+                {'name': name, 'depth': depth, 'elapsed': round(elapsed, 3)}
+                for name, depth, elapsed in self.stage_list
+            ],
+        }
+
+
+current_trace: ContextVar[Optional[RequestTrace]] = ContextVar(
+    'current_trace', default=None
+)
+
+
+def get_request_id() -> Optional[str]:
+    trace = current_trace.get()
+    return trace.request_id if trace is not None else None
+
+
+def enter_stage(name: str) -> None:
+    if (trace := current_trace.get()) is not None:
+        trace.enter_stage(name)
+
+
+def traced(
+    func: Callable[..., Awaitable[TReturn]]
+) -> Callable[..., Awaitable[TReturn]]:
+    """为处理函数记录各个阶段的用时，已经在记录中的递归调用只会增加深度"""
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> TReturn:
+        if (trace := current_trace.get()) is not None:
+            trace.depth += 1
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                trace.depth -= 1
+
+        event = kwargs.get('event')
+        trace = RequestTrace(
+            user_id=getattr(event, 'user_id', 0), handler=func.__name__
+        )
+        token = current_trace.set(trace)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            trace.end_stage()
+            current_trace.reset(token)
+            if trace.elapsed >= plugin_config.bingchat_slow_request_threshold > 0:
+                record_slow_request(trace)
+
+    return wrapper
+
+
+def record_slow_request(trace: RequestTrace) -> None:
+    data = trace.to_dict()
+    logger.warning(
+        f'慢请求{trace.request_id}用时{data["elapsed"]}s：'
+        + '，'.join(f'{i["name"]} {i["elapsed"]}s' for i in data['stages'])
+    )
+    task = asyncio.create_task(asyncio.to_thread(_write_slow_request, data))
+    _background_task_set.add(task)
+    task.add_done_callback(_background_task_set.discard)
+
+
+# 保留写入任务的引用，避免任务在完成前被回收
+_background_task_set: set[asyncio.Task[None]] = set()
+
+
+def _write_slow_request(data: dict[str, Any]) -> None:
+    # 和对话日志放在同一个按日期划分的文件夹中，过期时一起删除
+    log_directory = (
+        plugin_config.bingchat_plugin_directory
+        / 'log'
+        / data['time'].strftime('%Y-%m-%d')
+    )
+    log_directory.mkdir(parents=True, exist_ok=True)
+    with open(log_directory / 'slow-requests.jsonl', 'a', encoding='utf-8') as f:
+        f.write(json.dumps(data, ensure_ascii=False, default=str) + '\n')
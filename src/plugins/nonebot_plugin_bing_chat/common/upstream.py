@@ -0,0 +1,255 @@
+"""向Bing询问时的期限和对冲请求
+
+一次询问分为三段，各有各的期限，为0时不限制：
+- connect：从连接池获取会话，没有会话时需要创建
+- first_frame：从发出询问到收到第一帧，建立websocket和握手都在这一段
+- complete：从发出询问到收到完整的回答
+
+开启对冲后，首帧用时超过最近首帧用时的某个分位数时，在另一个账号上同时发起一次询问，
+先收到首帧的一方胜出，另一方被取消
+"""
+import time
+import asyncio
+from typing import Any, Literal, TypeVar, Callable, Optional, Awaitable
+from pathlib import Path
+from collections import deque
+
+from nonebot.log import logger
+
+from .exceptions import (
+    BingchatNetworkException,
+    BingchatTimeoutException,
+    BingChatResponseException,
+)
+
+T = TypeVar('T')
+Phase = Literal['connect', 'first_frame', 'complete']
+PHASE_LIST: list[Phase] = ['connect', 'first_frame', 'complete']
+QUANTILE_LIST = [0.5, 0.9, 0.99]
+
+
+class UpstreamAsk:
+    """对一个会话的一次询问，按期限读取ask_stream的每一帧"""
+
+    def __init__(
+        self,
+        timer: 'UpstreamTimer',
+        chatbot: Any,
+        cookies_file_path: Path,
+        prompt: str,
+        conversation_style: str,
+    ) -> None:
+        self.chatbot = chatbot
+        self.cookies_file_path = cookies_file_path
+        self.num_frames = 0
+        # 开始读取第一帧时ask_stream才会把问题发给Bing
+        self.is_sent = False
+        self._timer = timer
+        self._stream = chatbot.ask_stream(
+            prompt=prompt, conversation_style=conversation_style
+        )
+        self._start_time = time.monotonic()
+
+    async def next_frame(self) -> tuple[bool, Any]:
+        """返回(是否为最终的响应值, 累积的回答或者响应值)"""
+        phase: Phase = 'complete' if self.num_frames else 'first_frame'
+        timeout = self._timer.get_remaining_time(self._start_time, phase)
+        self.is_sent = True
+        try:
+            final, response = await asyncio.wait_for(self._stream.__anext__(), timeout)
+        except asyncio.TimeoutError:
+            self._timer.num_timeouts_dict[phase] += 1
+            raise BingchatTimeoutException(
+                f'<等待Bing{"回应" if phase == "first_frame" else "完成回答"}超时>'
+            ) from None
+        except StopAsyncIteration:
+            raise BingChatResponseException('<请求意外中断>') from None
+
+        elapsed = time.monotonic() - self._start_time
+        if not self.num_frames:
+            self._timer.observe('first_frame', elapsed)
+        if final:
+            self._timer.observe('complete', elapsed)
+        self.num_frames += 1
+        return final, response
+
+    async def close(self) -> None:
+        try:
+            await self._stream.aclose()
+        except Exception as exc:
+            logger.debug(f'关闭询问时出错：{exc}')
+
+
+class UpstreamTimer:
+    """给询问的每一段加上期限，记录最近window次的用时，并在首帧太慢时发起对冲请求"""
+
+    def __init__(
+        self,
+        connect_timeout: float,
+        first_frame_timeout: float,
+        complete_timeout: float,
+        hedge_quantile: float = 0,
+        window: int = 200,
+        min_samples: int = 20,
+    ) -> None:
+        self.timeout_dict: dict[Phase, float] = {
+            'connect': connect_timeout,
+            'first_frame': first_frame_timeout,
+            'complete': complete_timeout,
+        }
+        self.hedge_quantile = hedge_quantile
+        self.min_samples = min_samples
+        self.num_timeouts_dict: dict[Phase, int] = dict.fromkeys(PHASE_LIST, 0)
+        self.num_hedges = 0
+        self.num_hedge_wins = 0
+        self.num_hedges_skipped = 0
+        self._latency_deque_dict: dict[Phase, deque[float]] = {
+            phase: deque(maxlen=window) for phase in PHASE_LIST
+        }
+
+    def observe(self, phase: Phase, seconds: float) -> None:
+        self._latency_deque_dict[phase].append(seconds)
+
+    def get_quantile(self, phase: Phase, quantile: float) -> Optional[float]:
+        """最近的用时的分位数，样本太少时返回None"""
+        latency_list = sorted(self._latency_deque_dict[phase])
+        if len(latency_list) < self.min_samples:
+            return None
+        return latency_list[
+            min(int(len(latency_list) * quantile), len(latency_list) - 1)
+        ]
+
+    @property
+    def total_timeout(self) -> Optional[float]:
+        """连接加上询问最长需要的秒数，有一个阶段没有期限时返回None"""
+        if not all(self.timeout_dict.values()):
+            return None
+        return sum(self.timeout_dict.values())
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        return {
+            'latency': {
+                phase: {
+                    f'p{quantile * 100:g}': round(value, 3)
+                    for quantile in QUANTILE_LIST
+                    if (value := self.get_quantile(phase, quantile)) is not None
+                }
+                for phase in PHASE_LIST
+            },
+            'timeouts': self.num_timeouts_dict,
+            'hedges': self.num_hedges,
+            'hedge_wins': self.num_hedge_wins,
+            'hedges_skipped': self.num_hedges_skipped,
+        }
+
+    def get_remaining_time(self, start_time: float, phase: Phase) -> Optional[float]:
+        """到phase的期限还剩多少秒，没有期限时返回None"""
+        deadline_list = [
+            start_time + timeout
+            for i in (phase, 'complete')
+            if (timeout := self.timeout_dict[i]) > 0  # type: ignore
+        ]
+        if not deadline_list:
+            return None
+        return max(0.0, min(deadline_list) - time.monotonic())
+
+    async def connect(self, awaitable: Awaitable[T], is_creating: bool = True) -> T:
+        """在connect的期限内等待获取会话，is_creating为False时不记录用时"""
+        start_time = time.monotonic()
+        try:
+            result = await asyncio.wait_for(
+                awaitable, self.get_remaining_time(start_time, 'connect')
+            )
+        except asyncio.TimeoutError:
+            self.num_timeouts_dict['connect'] += 1
+            raise BingchatTimeoutException('<创建会话超时>') from None
+        if is_creating:
+            self.observe('connect', time.monotonic() - start_time)
+        return result
+
+    def ask(
+        self,
+        chatbot: Any,
+        cookies_file_path: Path,
+        prompt: str,
+        conversation_style: str,
+    ) -> UpstreamAsk:
+        return UpstreamAsk(self, chatbot, cookies_file_path, prompt, conversation_style)
+
+    async def start(
+        self,
+        primary: UpstreamAsk,
+        create_hedge: Optional[Callable[[], Awaitable[Optional[UpstreamAsk]]]] = None,
+    ) -> tuple[UpstreamAsk, tuple[bool, Any]]:
+        """等待第一帧，返回(胜出的询问, 第一帧)
+
+        create_hedge为None、没有开启对冲或者样本太少时只等待primary
+        """
+        hedge_delay = (
+            self.get_quantile('first_frame', self.hedge_quantile)
+            if create_hedge is not None and self.hedge_quantile > 0
+            else None
+        )
+        if hedge_delay is None:
+            return primary, await primary.next_frame()
+
+        primary_task = asyncio.create_task(primary.next_frame())
+        try:
+            done_set, _ = await asyncio.wait({primary_task}, timeout=hedge_delay)
+        except BaseException:
+            primary_task.cancel()
+            raise
+        if done_set:
+            return primary, primary_task.result()
+
+        assert create_hedge is not None
+        hedge: Optional[UpstreamAsk] = None
+
+        async def hedge_first_frame() -> tuple[bool, Any]:
+            nonlocal hedge
+            # 没有其他账号时没有发起对冲，不算作没有胜出
+            if (hedge := await create_hedge()) is None:
+                self.num_hedges_skipped += 1
+                raise BingchatNetworkException('<没有其他可用的账号>')
+            self.num_hedges += 1
+            return await hedge.next_frame()
+
+        hedge_task = asyncio.create_task(hedge_first_frame())
+        pending_set = {primary_task, hedge_task}
+        winner_task: Optional[asyncio.Task[tuple[bool, Any]]] = None
+        error: Optional[BaseException] = None
+        try:
+            while pending_set and winner_task is None:
+                done_set, pending_set = await asyncio.wait(
+                    pending_set, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in sorted(done_set, key=lambda i: i is not primary_task):
+                    if (exc := task.exception()) is None:
+                        winner_task = task
+                        break
+                    # 一方失败时继续等待另一方，都失败时报告primary的错误
+                    if error is None or task is primary_task:
+                        error = exc
+        finally:
+            # 先等输掉的一方停下，才能关闭它的ask_stream
+            for task in pending_set:
+                task.cancel()
+            await asyncio.gather(*pending_set, return_exceptions=True)
+
+        if winner_task is None:
+            if hedge is not None:
+                await hedge.close()
+                await hedge.chatbot.close()
+            assert error is not None
+            raise error
+        if winner_task is hedge_task:
+            assert hedge is not None
+            self.num_hedge_wins += 1
+            logger.info(f'对冲请求胜出，换用账号{hedge.cookies_file_path.name}')
+            await primary.close()
+            return hedge, winner_task.result()
+        if hedge is not None:
+            await hedge.close()
+            await hedge.chatbot.close()
+        return primary, winner_task.result()
@@ -1,12 +1,20 @@
+from typing import Hashable
+
 from nonebot_plugin_guild_patch import GuildMessageEvent
 from nonebot.adapters.onebot.v11 import MessageEvent, GroupMessageEvent
 
-from .utils import UserData
-from ..common import plugin_config
+from ..common import (
+    plugin_config,
+    permission_filter,
+    user_rate_limiter,
+    group_rate_limiter,
+    global_rate_limiter,
+)
 from ..common.exceptions import (
+    BingchatReachLimitException,
     BingChatPermissionDeniedException,
-    BingchatIsWaitingForResponseException,
 )
+from ..common.rate_limit import RateLimiter, acquire
 
 
 def check_if_in_list(event: MessageEvent) -> str:
@@ -17,38 +25,47 @@ def check_if_in_list(event: MessageEvent) -> str:
     if event.user_id in plugin_config.superusers:
         return '跳过权限检查，发送用户为超级用户'
 
+    if event.user_id in permission_filter.user_blacklist:
+        raise BingChatPermissionDeniedException('您没有权限，您在黑名单')
+
     if isinstance(event, GroupMessageEvent):
         match plugin_config.bingchat_group_filter_mode:
             case 'blacklist':
-                if event.group_id in plugin_config.bingchat_group_filter_blacklist:
+                if event.group_id in permission_filter.group_blacklist:
                     raise BingChatPermissionDeniedException('您没有权限，此群组在黑名单')
 
             case 'whitelist':
-                if event.group_id not in plugin_config.bingchat_group_filter_whitelist:
+                if event.group_id not in permission_filter.group_whitelist:
                     raise BingChatPermissionDeniedException('您没有权限，此群组不在白名单')
     elif isinstance(event, GuildMessageEvent):
+        guild_key = (str(event.guild_id), str(event.channel_id))
         match plugin_config.bingchat_group_filter_mode:
             case 'blacklist':
-                if {
-                    "guild_id": event.guild_id,
-                    "channel_id": event.channel_id,
-                } in plugin_config.bingchat_guild_filter_blacklist:
+                if guild_key in permission_filter.guild_blacklist:
                     raise BingChatPermissionDeniedException('您没有权限，此群组在黑名单')
 
             case 'whitelist':
-                if {
-                    "guild_id": event.guild_id,
-                    "channel_id": event.channel_id,
-                } not in plugin_config.bingchat_guild_filter_whitelist:
+                if guild_key not in permission_filter.guild_whitelist:
                     raise BingChatPermissionDeniedException('您没有权限，此群组不在白名单')
     return '在名单中'
 
 
-def check_if_user_is_waiting_for_response(
-    event: MessageEvent, user_data: UserData
-) -> str:
-    """检查用户是否有对话在进行中，如果有则抛出异常"""
-    if user_data.is_waiting:
-        raise BingchatIsWaitingForResponseException('您有一个对话正在进行中，请先等待回应')
+def check_rate_limit(event: MessageEvent) -> None:
+    """检查用户、群组和全局的请求频率，超过限制时抛出异常，超级用户不受限制"""
+    if event.user_id in plugin_config.superusers:
+        return
+
+    item_list: list[tuple[RateLimiter, Hashable]] = [
+        (user_rate_limiter, event.user_id),
+        (global_rate_limiter, None),
+    ]
+    if isinstance(event, GroupMessageEvent):
+        item_list.append((group_rate_limiter, event.group_id))
+    elif isinstance(event, GuildMessageEvent):
+        item_list.append((group_rate_limiter, (event.guild_id, event.channel_id)))
 
-    return '用户没有对话在进行中'
+    if (result := acquire(item_list)) is not None:
+        rate_limiter, wait_time = result
+        raise BingchatReachLimitException(
+            f'请求太频繁，{rate_limiter.description}，请在{wait_time}秒后再试'
+        )
@@ -1,9 +1,10 @@
-import json
+import time
+import asyncio
 from typing import Optional
+from datetime import datetime
 
-from EdgeGPT import Chatbot
 from nonebot.log import logger
-from nonebot.params import CommandArg, EventMessage
+from nonebot.typing import T_State
 from nonebot.matcher import Matcher
 from nonebot.adapters import Bot
 from nonebot_plugin_guild_patch import GuildMessageEvent
@@ -14,24 +15,48 @@ from nonebot.adapters.onebot.v11 import (
     PrivateMessageEvent,
 )
 
-from .check import check_if_in_list, check_if_user_is_waiting_for_response
+from .check import check_if_in_list, check_rate_limit
 from .utils import (
     reply_out,
     history_out,
+    ask_upstream,
+    bingchat_matcher,
+    get_queue_tenant,
+    send_stream_chunk,
+    send_display_message,
     default_get_user_data,
     get_display_message_list,
-    get_display_message_forward,
-    matcher_reply_to_continue_chat,
 )
 from ..common import (
     HELP_MESSAGE,
-    plugin_data,
-    command_chat,
+    storage,
+    answer_cache,
+    chatbot_pool,
     plugin_config,
-    command_new_chat,
-    command_history_chat,
+    request_queue,
+    single_flight,
+    upstream_timer,
+    permission_filter,
+    stream_display_plan,
 )
-from ..common.utils import create_log, switch_to_usable_cookies
+from ..common.utils import (
+    create_log,
+    load_user_data,
+    save_user_data,
+    get_reply_user_info,
+    record_reply_message_id,
+)
+from ..common.cookies import (
+    choose_cookies,
+    is_cookies_usable,
+    is_cookies_retired,
+    find_session_cookies,
+    mark_cookies_throttled,
+    cancel_cookies_conversation,
+    record_cookies_conversation,
+)
+from ..common.metrics import send_seconds, upstream_ask_seconds
+from ..common.tracing import traced, enter_stage, get_request_id
 from ..common.data_model import (
     Sender,
     UserData,
@@ -39,6 +64,7 @@ from ..common.data_model import (
     Conversation,
     BingChatResponse,
 )
+from ..common.dispatcher import ARG_KEY, ROUTE_KEY
 from ..common.exceptions import (
     BaseBingChatException,
     BingChatResponseException,
@@ -46,14 +72,16 @@ from ..common.exceptions import (
     BingChatAccountReachLimitException,
     BingChatConversationReachLimitException,
 )
+from ..common.permission import parse_filter_key
+from ..common.answer_cache import get_prompt_key
 
 
-@command_chat.handle()
+@traced
 async def bingchat_command_chat(
     bot: Bot,
     event: MessageEvent,
     matcher: Matcher,
-    arg: Message = CommandArg(),
+    arg: Message,
     user_data: Optional[UserData] = None,
     depth: int = 1,
 ) -> None:
@@ -68,134 +96,317 @@ async def bingchat_command_chat(
         await matcher.finish(HELP_MESSAGE)
 
     # 检查用户和群组是否在名单中，如果没有则终止
+    enter_stage('check')
     try:
         check_if_in_list(event=event)
+        # 自动刷新对话时的递归调用不重复计数
+        if depth == 2:
+            check_rate_limit(event=event)
     except BaseBingChatException as exc:
         await matcher.finish(reply_out(event, str(exc)))
 
-    if plugin_data.is_switching_cookies:
-        await matcher.finish(reply_out(event, '正在切换cookies，请稍后再试'))
+    enter_stage('load_user_data')
+    current_user_data = user_data or await default_get_user_data(event=event)
 
-    current_user_data = user_data or default_get_user_data(
-        event=event, user_data_dict=plugin_data.user_data_dict
-    )
+    current_user_data.last_time = time.time()
+
+    user_info = UserInfo(platform='qq', user_id=current_user_data.sender.user_id)
+    user_input_text = arg.extract_plain_text()
+
+    # 新对话的第一轮先查找回答缓存，再看是否有相同的问题正在询问，都没有才需要询问Bing
+    flight_key = None
+    if not current_user_data.history and not request_queue.get_user_num_pending(
+        user_info
+    ):
+        enter_stage('shared_response')
+        shared_response = None
+        if plugin_config.bingchat_answer_cache:
+            shared_response = answer_cache.get(
+                user_input_text, plugin_config.bingchat_conversation_style
+            )
+        if shared_response is None and plugin_config.bingchat_coalesce_asks:
+            prompt_key = get_prompt_key(
+                user_input_text, plugin_config.bingchat_conversation_style
+            )
+            shared_response = await single_flight.wait(prompt_key)
+            if shared_response is None and single_flight.start(prompt_key):
+                flight_key = prompt_key
+
+        # 共享的回答背后没有Bing的会话，不写入历史记录，回复它会开始新的对话
+        if shared_response is not None:
+            shared_user_data = UserData(
+                sender=current_user_data.sender,
+                history=[Conversation(ask=user_input_text, response=shared_response)],
+            )
+            try:
+                await send_display_message(
+                    bot, event, matcher, user_info, shared_user_data
+                )
+            except BingChatResponseException as exc:
+                await matcher.finish(
+                    reply_out(event, f'<调用content_simple时出错>\n{str(exc)}')
+                )
+            await matcher.finish(reply_out(event, '这是相同问题的共享回答，回复将开始新的对话'))
 
     if not current_user_data.first_ask_message_id:
         current_user_data.first_ask_message_id = event.message_id
 
-    # 检查用户是否有对话在进行中，如果有则终止
-    try:
-        check_if_user_is_waiting_for_response(event=event, user_data=current_user_data)
-    except BaseBingChatException as exc:
-        await matcher.finish(reply_out(event, str(exc)))
-
-    # 获取Chatbot，如果没有则创建一个
+    # 这一轮的回答保存并发送完之前一直占着该用户的队列和Chatbot，并发名额在询问结束后就让出
+    refresh_notice = None
+    user_lock_token = None
+    is_queued = False
     try:
-        if not current_user_data.chatbot:
-            current_user_data.chatbot = Chatbot(
-                cookie_path=plugin_data.current_cookies_file_path,  # type: ignore 应该支持Path的
-                proxy=plugin_config.bingchat_proxy,
+        # 进入该用户的请求队列，按顺序等待之前的对话和全局的并发名额
+        enter_stage('queue')
+        if request_queue.get_user_num_pending(user_info):
+            await matcher.send(reply_out(event, '已加入队列，将在之前的对话完成后回答'))
+        try:
+            await request_queue.acquire_user(user_info)
+        except BaseBingChatException as exc:
+            await matcher.finish(reply_out(event, str(exc)))
+        is_queued = True
+
+        # 多个进程共用存储时，同一个用户的对话在进程之间也要排队，拿到锁后读取其他进程写入的数据
+        # 等待其他进程时还没有占用并发名额，不会挡住其他用户
+        try:
+            user_lock_token = await storage.acquire_user_lock(user_info)
+        except BaseBingChatException as exc:
+            await matcher.finish(reply_out(event, str(exc)))
+        if user_lock_token is not None:
+            current_user_data = (
+                await load_user_data(user_info, refresh=True) or current_user_data
             )
-    except Exception as exc:
-        await matcher.send(reply_out(event, f'<无法创建Chatbot>\n{exc}'))
-        raise exc
-    else:
-        chatbot = current_user_data.chatbot
-
-    message_is_asking_data = None
-    # 向Bing发送请求, 并获取响应值
-    try:
-        if plugin_config.bingchat_display_is_waiting:
-            message_is_asking_data = await matcher.send(reply_out(event, '正在请求'))
-        current_user_data.is_waiting = True
-        user_input_text = arg.extract_plain_text()
-        response = await chatbot.ask(
-            prompt=user_input_text,
-            conversation_style=plugin_config.bingchat_conversation_style,
+        tenant, weight, is_priority = get_queue_tenant(event)
+        await request_queue.acquire_slot(
+            user_info, tenant=tenant, weight=weight, priority=is_priority
         )
-        """ from ..example_data import get_example_response
-        user_input_text = 'python中asyncio有什么用，并举例代码'
-        response = get_example_response() """
-    except Exception as exc:
-        await matcher.send(reply_out(event, f'<无法询问，如果出现多次请试刷新>\n{exc}'))
-        raise exc
-    finally:
-        current_user_data.is_waiting = False
-        if message_is_asking_data and not isinstance(event, GuildMessageEvent):
-            await bot.delete_msg(message_id=message_is_asking_data['message_id'])
 
-    # 检查后保存响应值
-    try:
-        if plugin_config.bingchat_log:
-            create_log(json.dumps(response))
-        current_user_data.history.append(
-            Conversation(ask=user_input_text, response=BingChatResponse(raw=response))
-        )
-    except BingChatAccountReachLimitException as exc:
-        if plugin_config.bingchat_auto_switch_cookies:
-            await matcher.send(reply_out(event, '检测到达到账户上限，将自动刷新账户，所有对话将被清空'))
-            if not await switch_to_usable_cookies():
-                await matcher.finish('无可用cookies')
-            for user_data in plugin_data.user_data_dict.values():
-                await user_data.clear(
-                    sender=Sender(
-                        user_id=event.user_id,
-                        user_name=(event.sender.nickname or '<未知的的用户名>'),
-                    )
+        # 从连接池获取Chatbot，如果没有则为新的对话选择一个账号并创建
+        enter_stage('chatbot')
+        # 对话已经到达上限时直接换上备用会话，不需要等Bing拒绝之后再刷新对话
+        restart_notice = None
+        if (
+            plugin_config.bingchat_auto_refresh_conversation
+            and current_user_data.history
+            and chatbot_pool.should_rotate(
+                user_info,
+                current_user_data.latest_response.num_conversation,
+                current_user_data.latest_response.max_conversation,
+            )
+        ):
+            if await chatbot_pool.rotate(user_info):
+                record_cookies_conversation(
+                    chatbot_pool.get_cookies_file_path(user_info)  # type: ignore
                 )
-            await matcher.finish('已切换cookies')
-        await matcher.finish(reply_out(event, f'<请尝联系管理员>\n{exc}'))
-    except (
-        BingChatConversationReachLimitException,
-        BingChatInvalidSessionException,
-    ) as exc:
-        if plugin_config.bingchat_auto_refresh_conversation:
-            if isinstance(exc, BingChatConversationReachLimitException):
-                await matcher.send(reply_out(event, '检测到达到对话上限，将自动刷新对话'))
-            if isinstance(exc, BingChatConversationReachLimitException):
-                await matcher.send(reply_out(event, '检测到达到对话过期，将自动刷新对话'))
-            await bingchat_command_new_chat(
-                bot=bot, event=event, matcher=matcher, arg=arg, depth=depth
+            current_user_data.clear(sender=current_user_data.sender)
+            current_user_data.first_ask_message_id = event.message_id
+            restart_notice = '对话已达到上限或者过期，已自动刷新对话'
+        # 会话因为空闲太久、连接池已满或者重启被关闭时用保存的会话信息恢复，
+        # 没有会话信息、账号已经不能使用或者对话已经到达上限时历史记录已经无法在Bing上继续
+        elif (
+            current_user_data.history
+            and user_info not in chatbot_pool
+            and (
+                find_session_cookies(current_user_data.session) is None
+                or current_user_data.latest_response.num_conversation
+                >= current_user_data.latest_response.max_conversation
             )
-            await matcher.finish()
-        await matcher.finish(reply_out(event, f'<请尝试刷新>\n{exc}'))
-    except BaseBingChatException as exc:
-        await matcher.finish(reply_out(event, f'<处理响应值值时出错>\n{exc}'))
+        ):
+            current_user_data.clear(sender=current_user_data.sender)
+            current_user_data.first_ask_message_id = event.message_id
+            restart_notice = '之前的对话已经关闭，已自动开始新的对话'
+        # 有会话信息时在它所在的账号上恢复，连接池中的会话已经过时的话也会换成恢复的会话
+        session = current_user_data.session
+        if (session_cookies_file_path := find_session_cookies(session)) is None:
+            session = None
+        is_creating = session is None and user_info not in chatbot_pool
+        cookies_file_path = (
+            session_cookies_file_path
+            or chatbot_pool.get_cookies_file_path(user_info)
+            or choose_cookies()
+        )
+        if cookies_file_path is None:
+            await matcher.finish(reply_out(event, '<无可用cookies，请联系管理员>'))
 
-    # 发送响应值
-    try:
-        # 合并转发
-        if plugin_config.bingchat_display_in_forward:
-            msg = await get_display_message_forward(current_user_data=current_user_data)
-            if isinstance(event, GroupMessageEvent):
-                await bot.send_group_forward_msg(group_id=event.group_id, messages=msg)
-            elif isinstance(event, PrivateMessageEvent):
-                await bot.send_private_forward_msg(user_id=event.user_id, messages=msg)
-
-        # 直接发送
-        else:
-            msg_list = await get_display_message_list(
-                current_user_data=current_user_data
+        try:
+            chatbot = await upstream_timer.connect(
+                chatbot_pool.acquire(user_info, cookies_file_path, session),
+                is_creating=is_creating,
+            )
+        except Exception as exc:
+            if is_creating:
+                cancel_cookies_conversation(cookies_file_path)
+            await matcher.send(reply_out(event, f'<无法创建Chatbot>\n{exc}'))
+            raise exc
+
+        message_is_asking_data = None
+        stream_chunker = None
+        stream_text = ''
+        # 向Bing发送请求, 并获取响应值
+        try:
+            if restart_notice is not None:
+                await matcher.send(reply_out(event, restart_notice))
+            if plugin_config.bingchat_display_is_waiting:
+                enter_stage('waiting_notice')
+                message_is_asking_data = await matcher.send(reply_out(event, '正在请求'))
+            enter_stage('ask')
+            with upstream_ask_seconds.time():
+                # 只有新对话的第一轮可以换到其他账号上询问
+                (
+                    response,
+                    stream_chunker,
+                    stream_text,
+                    cookies_file_path,
+                ) = await ask_upstream(
+                    event=event,
+                    matcher=matcher,
+                    user_info=user_info,
+                    chatbot=chatbot,
+                    cookies_file_path=cookies_file_path,
+                    prompt=user_input_text,
+                    can_hedge=not current_user_data.history,
+                )
+            """ from ..example_data import get_example_response
+            user_input_text = 'python中asyncio有什么用，并举例代码'
+            response = get_example_response() """
+        except Exception as exc:
+            await matcher.send(reply_out(event, f'<无法询问，如果出现多次请试刷新>\n{exc}'))
+            raise exc
+        finally:
+            request_queue.release_slot(user_info)
+            if message_is_asking_data and not isinstance(event, GuildMessageEvent):
+                await bot.delete_msg(message_id=message_is_asking_data['message_id'])
+
+        # 检查后保存响应值
+        try:
+            if plugin_config.bingchat_log:
+                enter_stage('log')
+                create_log(
+                    {
+                        'time': datetime.now(),
+                        'request_id': get_request_id(),
+                        'user_id': current_user_data.sender.user_id,
+                        'ask': user_input_text,
+                        'response': response,
+                    }
+                )
+            enter_stage('validate')
+            current_user_data.history.append(
+                Conversation(
+                    ask=user_input_text,
+                    response=BingChatResponse(
+                        raw=response, keep_raw=plugin_config.bingchat_keep_raw_response
+                    ),
+                )
             )
-            for i, msg in enumerate(msg_list):
-                data = await matcher.send(
-                    msg if i else reply_out(event=event, content=msg)
+            current_user_data.session = chatbot_pool.get_session(user_info)
+            save_user_data(user_info, current_user_data)
+            # 账号已经到达上限或者提前退役时不准备备用会话，到时候换到其他账号上
+            if (
+                plugin_config.bingchat_auto_refresh_conversation
+                and is_cookies_usable(cookies_file_path)
+                and not is_cookies_retired(cookies_file_path)
+            ):
+                chatbot_pool.prepare_spare(
+                    user_info,
+                    current_user_data.latest_response.num_conversation,
+                    current_user_data.latest_response.max_conversation,
+                )
+            single_flight.resolve(flight_key, current_user_data.latest_response)
+            if (
+                plugin_config.bingchat_answer_cache
+                and len(current_user_data.history) == 1
+            ):
+                answer_cache.put(
+                    user_input_text,
+                    plugin_config.bingchat_conversation_style,
+                    current_user_data.latest_response,
                 )
-                plugin_data.reply_message_id_dict[data['message_id']] = UserInfo(
-                    platform='qq', user_id=event.user_id
+        except BingChatAccountReachLimitException as exc:
+            mark_cookies_throttled(cookies_file_path)
+            await chatbot_pool.discard(user_info)
+            if not plugin_config.bingchat_auto_switch_cookies:
+                await matcher.finish(reply_out(event, f'<请尝联系管理员>\n{exc}'))
+            refresh_notice = '检测到达到账户上限，将自动切换账户并刷新对话'
+        except (
+            BingChatConversationReachLimitException,
+            BingChatInvalidSessionException,
+        ) as exc:
+            if not plugin_config.bingchat_auto_refresh_conversation:
+                await matcher.finish(reply_out(event, f'<请尝试刷新>\n{exc}'))
+            if isinstance(exc, BingChatConversationReachLimitException):
+                refresh_notice = '检测到达到对话上限，将自动刷新对话'
+            if isinstance(exc, BingChatInvalidSessionException):
+                refresh_notice = '检测到达到对话过期，将自动刷新对话'
+        except BaseBingChatException as exc:
+            await matcher.finish(reply_out(event, f'<处理响应值值时出错>\n{exc}'))
+        finally:
+            # 这一轮的数据保存之后才让其他进程继续这个用户的对话
+            await storage.release_user_lock(user_info, user_lock_token)
+            user_lock_token = None
+
+        # 发送响应值
+        if refresh_notice is None:
+            try:
+                # 流式输出，发送剩余的回答与其他内容
+                if stream_chunker is not None:
+                    enter_stage('send')
+                    # 累积文本中可能有不属于回答的内容，剩余部分以检查后的回答为准
+                    rest_text = stream_chunker.flush(
+                        stream_text, current_user_data.latest_response.content_answer
+                    )
+                    if rest_text:
+                        await send_stream_chunk(
+                            event,
+                            matcher,
+                            user_info,
+                            rest_text,
+                            stream_chunker.num_chunks <= 1,
+                        )
+                    if stream_display_plan:
+                        enter_stage('render')
+                        msg_list = await get_display_message_list(
+                            current_user_data=current_user_data,
+                            plan=stream_display_plan,
+                        )
+                        enter_stage('send')
+                        with send_seconds.time():
+                            for msg in msg_list:
+                                data = await matcher.send(msg)
+                                record_reply_message_id(data['message_id'], user_info)
+
+                else:
+                    await send_display_message(
+                        bot, event, matcher, user_info, current_user_data
+                    )
+            except BingChatResponseException as exc:
+                await matcher.finish(
+                    reply_out(event, f'<调用content_simple时出错>\n{str(exc)}')
                 )
-    except BingChatResponseException as exc:
-        await matcher.finish(reply_out(event, f'<调用content_simple时出错>\n{str(exc)}'))
     finally:
-        await chatbot.close()
+        enter_stage('release')
+        # 无论这一轮怎样结束都要结束合并，否则等待相同问题的请求要等到超时
+        single_flight.discard(flight_key)
+        if is_queued:
+            await storage.release_user_lock(user_info, user_lock_token)
+            await chatbot_pool.release(user_info)
+            request_queue.release(user_info)
+
+    # 自动刷新对话要在让出该用户的队列并结束合并之后，否则重新询问时会等待自己
+    if refresh_notice is not None:
+        await matcher.send(reply_out(event, refresh_notice))
+        enter_stage('auto_refresh')
+        await bingchat_command_new_chat(
+            bot=bot, event=event, matcher=matcher, arg=arg, depth=depth
+        )
+        await matcher.finish()
 
 
-@command_new_chat.handle()
 async def bingchat_command_new_chat(
     bot: Bot,
     event: MessageEvent,
     matcher: Matcher,
-    arg: Message = CommandArg(),
+    arg: Message,
     depth: int = 1,
 ) -> None:
     # 检查用户和群组是否在名单中，如果没有则终止
@@ -204,16 +415,31 @@ async def bingchat_command_new_chat(
     except BaseBingChatException as exc:
         await matcher.finish(reply_out(event, str(exc)))
 
-    current_user_data = default_get_user_data(
-        event=event, user_data_dict=plugin_data.user_data_dict
-    )
-
-    await current_user_data.clear(
-        sender=Sender(
-            user_id=event.user_id,
-            user_name=event.sender.nickname or '<未知的的用户名>',
+    # 和对话一样排在该用户的队列里，不能在询问进行中关闭Chatbot或者清空历史记录
+    user_info = UserInfo(platform='qq', user_id=event.user_id)
+    try:
+        await request_queue.acquire_user(user_info)
+    except BaseBingChatException as exc:
+        await matcher.finish(reply_out(event, str(exc)))
+    user_lock_token = None
+    try:
+        try:
+            user_lock_token = await storage.acquire_user_lock(user_info)
+        except BaseBingChatException as exc:
+            await matcher.finish(reply_out(event, str(exc)))
+        current_user_data = await default_get_user_data(event=event)
+
+        await chatbot_pool.discard(user_info)
+        current_user_data.clear(
+            sender=Sender(
+                user_id=event.user_id,
+                user_name=event.sender.nickname or '<未知的的用户名>',
+            )
         )
-    )
+        save_user_data(user_info, current_user_data)
+    finally:
+        await storage.release_user_lock(user_info, user_lock_token)
+        request_queue.release(user_info)
 
     await matcher.send(reply_out(event, '已刷新对话'))
 
@@ -224,9 +450,8 @@ async def bingchat_command_new_chat(
         )
 
 
-@command_history_chat.handle()
 async def bingchat_command_history_chat(
-    bot: Bot, event: MessageEvent, matcher: Matcher, arg: Message = CommandArg()
+    bot: Bot, event: MessageEvent, matcher: Matcher, arg: Message
 ) -> None:
     if isinstance(event, GuildMessageEvent):
         await matcher.finish('频道不支持合并转发，无法使用该功能！')
@@ -241,9 +466,7 @@ async def bingchat_command_history_chat(
     except BaseBingChatException as exc:
         await matcher.finish(reply_out(event, str(exc)))
 
-    current_user_data = default_get_user_data(
-        event=event, user_data_dict=plugin_data.user_data_dict
-    )
+    current_user_data = await default_get_user_data(event=event)
 
     # 如果该用户没有历史记录则终止
     if not current_user_data.history:
@@ -257,25 +480,77 @@ async def bingchat_command_history_chat(
         await bot.send_private_forward_msg(user_id=event.user_id, messages=msg)
 
 
-@matcher_reply_to_continue_chat.handle()
+FILTER_HELP_MESSAGE = (
+    '查看名单：{命令}\n'
+    '重新加载filter.json：{命令} reload\n'
+    '修改名单：{命令} add/remove {名单} {id}\n'
+    '名单：group_whitelist, group_blacklist, guild_whitelist, guild_blacklist, user_blacklist\n'
+    '频道的id写作guild_id/channel_id'
+)
+
+
+async def bingchat_command_filter(
+    bot: Bot, event: MessageEvent, matcher: Matcher, arg: Message
+) -> None:
+    if event.user_id not in plugin_config.superusers:
+        await matcher.finish(reply_out(event, '您没有权限，只有超级用户可以修改名单'))
+
+    match arg.extract_plain_text().split():
+        case []:
+            await matcher.finish(
+                reply_out(
+                    event,
+                    f'过滤模式：{plugin_config.bingchat_group_filter_mode}\n'
+                    + '\n'.join(
+                        f'{name}：{num}' for name, num in permission_filter.stats.items()
+                    )
+                    + f'\n\n{FILTER_HELP_MESSAGE}',
+                ),
+            )
+        case ['reload']:
+            permission_filter.load()
+            await matcher.finish(reply_out(event, f'已重新加载名单：{permission_filter.stats}'))
+        case [('add' | 'remove') as action, name, key_text] if (
+            name in permission_filter.stats
+        ):
+            try:
+                key = parse_filter_key(name, key_text)  # type: ignore
+            except ValueError as exc:
+                await matcher.finish(reply_out(event, f'id格式错误：{exc}'))
+            if action == 'add':
+                is_changed = permission_filter.add(name, key)  # type: ignore
+            else:
+                is_changed = permission_filter.remove(name, key)  # type: ignore
+            if not is_changed:
+                await matcher.finish(reply_out(event, '名单没有变化'))
+            await asyncio.to_thread(permission_filter.write, permission_filter.dumps())
+            await matcher.finish(reply_out(event, f'已修改{name}，并写入filter.json'))
+        case _:
+            await matcher.finish(reply_out(event, FILTER_HELP_MESSAGE))
+
+
+@traced
 async def bingchat_message_all(
-    bot: Bot, event: MessageEvent, matcher: Matcher, arg: Message = EventMessage()
+    bot: Bot, event: MessageEvent, matcher: Matcher, arg: Message
 ) -> None:
     if not event.reply:
         raise Exception('这句话不应该出现')
 
+    enter_stage('load_user_data')
+    reply_user_info = await get_reply_user_info(event.reply.message_id)
+    if reply_user_info is None:
+        raise Exception('这句话不应该出现')
+
     # 检查是否回复的是自己的对话
     if (
         not plugin_config.bingchat_share_chat
-        and event.sender.user_id
-        != plugin_data.reply_message_id_dict[event.reply.message_id]
+        and event.sender.user_id != reply_user_info.user_id
     ):
         logger.error(f'用户{event.sender.user_id}试图继续别人的对话')
 
     # 获取最开始发送的用户数据
-    current_user_data = plugin_data.user_data_dict[
-        plugin_data.reply_message_id_dict[event.reply.message_id]
-    ]
+    if (current_user_data := await load_user_data(reply_user_info)) is None:
+        await matcher.finish(reply_out(event, '这个对话已经过期了，请重新开始对话'))
 
     await bingchat_command_chat(
         bot=bot,
@@ -284,3 +559,27 @@ async def bingchat_message_all(
         arg=arg,
         user_data=current_user_data,
     )
+
+
+@bingchat_matcher.handle()
+async def bingchat_dispatch(
+    bot: Bot, event: MessageEvent, matcher: Matcher, state: T_State
+) -> None:
+    arg: Message = state[ARG_KEY]
+    match state[ROUTE_KEY]:
+        case 'chat':
+            await bingchat_command_chat(bot=bot, event=event, matcher=matcher, arg=arg)
+        case 'new_chat':
+            await bingchat_command_new_chat(
+                bot=bot, event=event, matcher=matcher, arg=arg
+            )
+        case 'history':
+            await bingchat_command_history_chat(
+                bot=bot, event=event, matcher=matcher, arg=arg
+            )
+        case 'filter':
+            await bingchat_command_filter(
+                bot=bot, event=event, matcher=matcher, arg=arg
+            )
+        case 'continue':
+            await bingchat_message_all(bot=bot, event=event, matcher=matcher, arg=arg)
@@ -1,23 +1,59 @@
+import time
+import asyncio
+from typing import TYPE_CHECKING, Any, Optional
+from pathlib import Path
+
+from nonebot.log import logger
 from nonebot.rule import Rule
-from nonebot.params import EventToMe
+from nonebot.typing import T_State
+from nonebot.matcher import Matcher
 from nonebot.adapters import Bot
 from nonebot.plugin.on import on_message
 from nonebot_plugin_guild_patch import GuildMessageEvent
-from nonebot.adapters.onebot.v11 import Message, MessageEvent, MessageSegment
+from nonebot.adapters.onebot.v11 import (
+    Message,
+    MessageEvent,
+    MessageSegment,
+    GroupMessageEvent,
+    PrivateMessageEvent,
+)
 
-from ..common import plugin_data, plugin_config
-from ..common.utils import get_display_data, is_conflict_with_other_matcher
-from ..common.data_model import Sender, UserData, UserInfo, DisplayContentType
+from ..common import (
+    plugin_data,
+    chatbot_pool,
+    display_plan,
+    plugin_config,
+    command_router,
+    upstream_timer,
+)
+from ..common.utils import (
+    load_user_data,
+    get_display_data,
+    get_reply_user_info,
+    record_reply_message_id,
+)
+from ..common.stream import StreamChunker
+from ..common.cookies import (
+    choose_cookies,
+    record_cookies_usage,
+    cancel_cookies_conversation,
+)
+from ..common.display import DisplayPart
+from ..common.metrics import send_seconds, display_part_seconds
+from ..common.tracing import enter_stage
+from ..common.upstream import UpstreamAsk
+from ..common.data_model import Sender, UserData, UserInfo
+from ..common.dispatcher import ARG_KEY, ROUTE_KEY, get_command_arg
+from ..common.request_queue import PRIVATE_TENANT_PREFIX
 
-if any(i == 'image' for i, _ in plugin_config.bingchat_display_content_types):
-    from nonebot_plugin_htmlrender import md_to_pic
+if TYPE_CHECKING:
+    from EdgeGPT import Chatbot
 
 
-def default_get_user_data(
-    event: MessageEvent, user_data_dict: dict[UserInfo, UserData]
-) -> UserData:
-    return user_data_dict.setdefault(
-        UserInfo(platform='qq', user_id=event.user_id),
+async def default_get_user_data(event: MessageEvent) -> UserData:
+    user_info = UserInfo(platform='qq', user_id=event.user_id)
+    return await load_user_data(user_info) or plugin_data.user_data_dict.setdefault(
+        user_info,
         UserData(
             sender=Sender(
                 user_id=event.user_id,
@@ -27,6 +63,20 @@ def default_get_user_data(
     )
 
 
+def get_queue_tenant(event: MessageEvent) -> tuple[str, float, bool]:
+    """返回请求在等待并发名额时所属的租户、权重，以及是否走优先通道"""
+    is_priority = event.user_id in plugin_config.superusers
+    if isinstance(event, GroupMessageEvent):
+        return (
+            f'group:{event.group_id}',
+            plugin_config.bingchat_group_queue_weights.get(event.group_id, 1),
+            is_priority or event.group_id in plugin_config.bingchat_priority_groups,
+        )
+    if isinstance(event, GuildMessageEvent):
+        return f'guild:{event.guild_id}/{event.channel_id}', 1, is_priority
+    return f'{PRIVATE_TENANT_PREFIX}{event.user_id}', 1, is_priority
+
+
 def reply_out(event: MessageEvent, content: MessageSegment | Message | str) -> Message:
     """返回一个回复消息"""
     if isinstance(event, GuildMessageEvent):
@@ -54,35 +104,38 @@ def history_out(bot: Bot, user_data: UserData) -> Message:
 
 
 async def get_display_message(
-    user_data: UserData, display_content_type: DisplayContentType
+    user_data: UserData, display_part: DisplayPart
 ) -> Message:
-    """获取应该响应的信息片段"""
-    display_type, content_type_list = display_content_type
-
-    data = await get_display_data(user_data, display_content_type)
+    """获取应该响应的信息片段，并记录用时"""
+    start_time = time.perf_counter()
+    data = await get_display_data(user_data, display_part)
+    elapsed = time.perf_counter() - start_time
+    display_part_seconds.observe(elapsed, display_part.name)
+    logger.debug(f'输出{display_part.name}用时{elapsed:.2f}s')
 
-    match display_type:
+    match display_part.display_type:
         case 'text':
             return Message(MessageSegment.text(data))  # type: ignore
         case 'image':
             return Message(MessageSegment.image(data))
 
 
-async def get_display_message_list(current_user_data: UserData) -> list[Message]:
-    """获取应该响应的信息"""
-    msg_list: list[Message] = []
-    for display_content_type in plugin_config.bingchat_display_content_types:
-        msg = await get_display_message(current_user_data, display_content_type)
-        msg_list.append(msg)
-
-    return msg_list
+async def get_display_message_list(
+    current_user_data: UserData,
+    plan: tuple[DisplayPart, ...] | None = None,
+) -> list[Message]:
+    """获取应该响应的信息，各个部分同时渲染"""
+    plan = display_plan if plan is None else plan
+    msg_list = await asyncio.gather(
+        *(get_display_message(current_user_data, i) for i in plan)
+    )
+    return list(msg_list)
 
 
 async def get_display_message_forward(current_user_data: UserData) -> Message:
     """获取应该响应的信息"""
     _msg = Message()
-    for display_content_type in plugin_config.bingchat_display_content_types:
-        msg = await get_display_message(current_user_data, display_content_type)
+    for msg in await get_display_message_list(current_user_data):
         _msg += MessageSegment.node_custom(
             user_id=current_user_data.sender.user_id,
             nickname=current_user_data.sender.user_name,
@@ -91,17 +144,152 @@ async def get_display_message_forward(current_user_data: UserData) -> Message:
     return _msg
 
 
-def _rule_continue_chat(event: MessageEvent, to_me: bool = EventToMe()) -> bool:
-    return bool(
-        to_me
-        and event.reply
-        and event.reply.message_id in plugin_data.reply_message_id_dict
-        and not is_conflict_with_other_matcher(event.message.extract_plain_text())
-    )
+async def send_display_message(
+    bot: Bot,
+    event: MessageEvent,
+    matcher: Matcher,
+    user_info: UserInfo,
+    user_data: UserData,
+) -> None:
+    """按照配置以合并转发或者直接发送的方式发送回答"""
+    # 合并转发
+    if plugin_config.bingchat_display_in_forward:
+        enter_stage('render')
+        msg = await get_display_message_forward(current_user_data=user_data)
+        enter_stage('send')
+        with send_seconds.time():
+            if isinstance(event, GroupMessageEvent):
+                await bot.send_group_forward_msg(group_id=event.group_id, messages=msg)
+            elif isinstance(event, PrivateMessageEvent):
+                await bot.send_private_forward_msg(user_id=event.user_id, messages=msg)
+
+    # 直接发送
+    else:
+        enter_stage('render')
+        msg_list = await get_display_message_list(current_user_data=user_data)
+        enter_stage('send')
+        with send_seconds.time():
+            for i, msg in enumerate(msg_list):
+                data = await matcher.send(
+                    msg if i else reply_out(event=event, content=msg)
+                )
+                record_reply_message_id(data['message_id'], user_info)
+
+
+async def send_stream_chunk(
+    event: MessageEvent,
+    matcher: Matcher,
+    user_info: UserInfo,
+    chunk: str,
+    is_first: bool,
+) -> None:
+    """发送流式回答的一个片段，并记录消息id以便回复继续对话"""
+    with send_seconds.time():
+        data = await matcher.send(reply_out(event, chunk) if is_first else chunk)
+    record_reply_message_id(data['message_id'], user_info)
+
+
+async def ask_upstream(
+    event: MessageEvent,
+    matcher: Matcher,
+    user_info: UserInfo,
+    chatbot: 'Chatbot',
+    cookies_file_path: Path,
+    prompt: str,
+    can_hedge: bool,
+) -> tuple[dict[Any, Any], Optional[StreamChunker], str, Path]:
+    """在期限内向Bing请求，流式模式下边接收边分段发送回答
+
+    can_hedge为True时首帧太慢会在另一个账号上同时询问，胜出的会话放入连接池，
+    返回(响应值, 分段器, 累积文本, 实际使用的账号)
+    """
+    conversation_style = plugin_config.bingchat_conversation_style
+    hedge: Optional[UpstreamAsk] = None
+
+    async def create_hedge() -> Optional[UpstreamAsk]:
+        nonlocal hedge
+        if (
+            hedge_cookies_file_path := choose_cookies(exclude=cookies_file_path)
+        ) is None:
+            return None
+        try:
+            hedge_chatbot = await upstream_timer.connect(
+                chatbot_pool.create_detached(hedge_cookies_file_path)
+            )
+        except BaseException:
+            # 对冲被取消或者会话创建失败，不计入对话
+            cancel_cookies_conversation(hedge_cookies_file_path)
+            raise
+        hedge = upstream_timer.ask(
+            hedge_chatbot, hedge_cookies_file_path, prompt, conversation_style
+        )
+        return hedge
+
+    primary = upstream_timer.ask(chatbot, cookies_file_path, prompt, conversation_style)
+    upstream_ask: Optional[UpstreamAsk] = None
+    is_detached = False
+    try:
+        upstream_ask, (final, response) = await upstream_timer.start(
+            primary, create_hedge if can_hedge else None
+        )
+        # 用户已经不在连接池中时，对冲的会话没有地方存放，询问结束后关闭
+        if upstream_ask is not primary:
+            is_detached = not await chatbot_pool.replace(
+                user_info, upstream_ask.chatbot, upstream_ask.cookies_file_path
+            )
+
+        chunker = None
+        if plugin_config.bingchat_stream_mode:
+            chunker = StreamChunker(
+                min_chunk_size=plugin_config.bingchat_stream_min_chunk_size,
+                flush_interval=plugin_config.bingchat_stream_flush_interval,
+            )
+        text = ''
+        try:
+            while not final:
+                if chunker is not None:
+                    text = response
+                    if chunk := chunker.feed(text):
+                        await send_stream_chunk(
+                            event, matcher, user_info, chunk, chunker.num_chunks == 1
+                        )
+                final, response = await upstream_ask.next_frame()
+        finally:
+            await upstream_ask.close()
+            if is_detached:
+                await upstream_ask.chatbot.close()
+    finally:
+        # 只要问题已经发给了Bing就计入消息数，包括胜出后出错或者超时的询问
+        for i in (primary, hedge):
+            if i is not None and i.is_sent:
+                record_cookies_usage(i.cookies_file_path)
+    return response, chunker, text, upstream_ask.cookies_file_path
+
+
+async def _rule_bingchat(event: MessageEvent, state: T_State) -> bool:
+    """匹配命令或者回复机器人的回答，结果写入state交给bingchat_dispatch处理"""
+    message = event.message
+    if message and message[0].is_text():
+        text = str(message[0]).lstrip()
+        if (result := command_router.match(text)) is not None:
+            if plugin_config.bingchat_to_me and not event.to_me:
+                return False
+            state[ROUTE_KEY], prefix_length = result
+            state[ARG_KEY] = get_command_arg(message, text, prefix_length)
+            return True
+
+    # 回复机器人的回答以继续对话，先查内存中的消息id，没有再查存储
+    if not (event.to_me and event.reply):
+        return False
+    if await get_reply_user_info(event.reply.message_id) is None:
+        return False
+    state[ROUTE_KEY] = 'continue'
+    state[ARG_KEY] = message
+    return True
 
 
-matcher_reply_to_continue_chat = on_message(
-    rule=Rule(_rule_continue_chat),
+bingchat_matcher = on_message(
+    rule=Rule(_rule_bingchat),
     priority=plugin_config.bingchat_priority,
     block=plugin_config.bingchat_block,
 )